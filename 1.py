@@ -1,15 +1,12 @@
 from flask import send_file, Response
 import shutil
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, has_request_context
 import os
+import sys
 import time
 import logging
 import traceback
-import yt_dlp
-import gc
 import uuid
-import requests
-from PIL import Image
 import io
 import base64
 import json
@@ -18,6 +15,27 @@ from dotenv import load_dotenv
 from werkzeug.utils import secure_filename
 import re
 import shutil
+import hashlib
+import importlib.util
+import mimetypes
+from reaper import FileReaper
+from temp_store import PayloadTooLarge, TempStore, TempQuotaExceeded
+from http_client import Upstream, UpstreamUnavailable
+from jobs import JobScheduler, register_job_routes, submit_replay, on_job_cancel, wait_arg
+from media_pipeline import MediaPipeline, media_headers, with_ext
+from startup import Startup, lazy_import, preload
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# `python 1.py`: serve from the module proper ('1') and leave a bare __main__
+# behind. Media workers re-import __main__ and must not build a second engine
+# (stores, jobs DB, threads) of their own.
+if __name__ == '__main__':
+    import types
+    sys.modules['__main__'] = types.ModuleType('__main__')
+    importlib.import_module('1').app.run(host='0.0.0.0', port=5000, debug=False)
+    sys.exit()
 
 # Load environment variables
 load_dotenv()
@@ -31,52 +49,208 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Heavy imports (yt-dlp, Pillow, gTTS) load on first use or in the background
+# pre-warm after startup; /health/ready reports once the engine can serve.
+# READY_AFTER_PREWARM=1 also holds readiness until the pre-warm is done.
+startup = Startup('engine', wait_for_prewarm=os.getenv('READY_AFTER_PREWARM', '0') == '1')
+startup.mark('imports')
+yt_dlp = lazy_import('yt_dlp')
+
 logger.info("🚀 Running on: CPU")
 logger.info("🚀 Starting AI Engine on port 5000")
 
-# Directory for temporary files
-TEMP_DIR = os.path.join(os.getcwd(), 'temp')
-os.makedirs(TEMP_DIR, exist_ok=True)
-
-# Lock for file operations to prevent race conditions
-file_lock = threading.Lock()
+# Directory for temporary files. Our own subdirectory (the bot commands and
+# 2.py write to temp/ too), split per process: every ASGI worker gets
+# TEMP_ROOT/<pid> and a TEMP_QUOTA_MB of its own. Orphans, and the
+# directories of workers that are gone, are deleted in the background once
+# startup is done.
+TEMP_ROOT = os.getenv('TEMP_DIR', os.path.join(os.getcwd(), 'temp', 'engine'))
+
+# Deletions happen on a background thread; request threads only enqueue.
+# Every writer uses a unique path, so no lock is needed around file I/O.
+reaper = FileReaper()
+
+# Every scratch file comes from temp_store, which tracks size, owner and pins
+# and keeps TEMP_DIR under TEMP_QUOTA_MB by evicting unpinned files at once.
+temp_store = TempStore(
+    'temp',
+    TEMP_ROOT,
+    int(float(os.getenv('TEMP_QUOTA_MB', 2048)) * 1024 * 1024),
+    remove=reaper.enqueue,
+    reconcile=False,
+    per_process=True,
+)
+TEMP_DIR = temp_store.root
+startup.prewarm('temp_reconcile', temp_store.reconcile, optional=False)
+startup.mark('storage')
 
 # --- Helper Functions ---
 def cleanup_file(filepath):
+    temp_store.discard(filepath)
+
+# Generated images and audio are buffered in memory and only spill to
+# temp_store past SPILL_THRESHOLD_MB; anything over 95MB is refused mid-write.
+MAX_MEDIA_BYTES = 95 * 1024 * 1024
+SPILL_BYTES = int(float(os.getenv('SPILL_THRESHOLD_MB', 8)) * 1024 * 1024)
+
+def temp_buffer(prefix, suffix=''):
+    """A SpillBuffer owned by the current request (or thread)."""
+    owner = request.path if has_request_context() else threading.current_thread().name
+    return temp_store.buffer(prefix, suffix, owner, MAX_MEDIA_BYTES, SPILL_BYTES)
+
+def publish_buffer(store, key, buf, ext):
+    """Put a finished SpillBuffer into a MediaStore; returns the pinned entry."""
+    data = buf.getvalue()
+    if data is not None:
+        return store.publish_bytes(key, data, ext)
+    return store.publish(key, buf.detach(), ext)
+
+def storage_full(e):
+    logger.warning(f"Temp storage full: {str(e)}")
+    resp = jsonify({'error': str(e)})
+    resp.status_code = 503
+    resp.headers['Retry-After'] = '5'
+    return resp
+
+def upstream_unavailable(e):
+    logger.warning(f"Upstream unavailable: {str(e)}")
+    resp = jsonify({'error': str(e)})
+    resp.status_code = 503
+    resp.headers['Retry-After'] = str(int(e.retry_after) + 1)
+    return resp
+
+def media_url(store, media_id):
+    """Stable URL of a stored file (GET /media/<store>/<id>)."""
+    return f"/media/{store.name}/{media_id}"
+
+def serve_entry(store, entry, mimetype, download_name, headers=None):
+    """Stream a pinned store entry; it's released when the response closes.
+    Its Content-Location serves the same bytes with Range and If-None-Match
+    support until the entry is evicted."""
+    headers = dict(headers or {}, **{
+        'Content-Disposition': f'attachment; filename={download_name}',
+        'Content-Location': media_url(store, entry['key']),
+    })
+    # Not send_file: its passthrough response never fires call_on_close
     try:
-        if os.path.exists(filepath):
-            with file_lock:
-                gc.collect()
-                time.sleep(1)
-                os.remove(filepath)
-                logger.info(f"Cleaned up: {filepath}")
-    except Exception as e:
-        logger.error(f"Cleanup error for {filepath}: {str(e)}")
+        return file_response(entry['path'], mimetype, entry['key'][:32], store.name, headers,
+                             on_close=lambda: store.release(entry['key']))
+    except OSError:
+        store.release(entry['key'])
+        raise
+
+def buffer_response(buf, mimetype, download_name, headers=None):
+    """Send a SpillBuffer: from memory, or streamed from its spill file
+    (opened here, so the caller may close the buffer once this returns)."""
+    data = buf.getvalue()
+    if data is not None:
+        resp = Response(data, mimetype=mimetype, headers=headers)
+    else:
+        reader = buf.reader()
+
+        def stream():
+            with reader:
+                while chunk := reader.read(1024*1024):
+                    yield chunk
 
-def check_file_size(filepath):
-    if not os.path.exists(filepath):
-        return False, 0
-    size_mb = os.path.getsize(filepath) / (1024 * 1024)
-    return size_mb <= 95, size_mb
+        resp = Response(timed_stream(stream(), 'spill'), mimetype=mimetype, headers=headers)
+        resp.headers['Content-Length'] = str(buf.size)
+    resp.headers['Content-Disposition'] = f'attachment; filename={download_name}'
+    return resp
+
+# Pooled keep-alive clients with retries and a circuit breaker, one per upstream
+replicate_api = Upstream('replicate', timeout=60)
+replicate_cdn = Upstream('replicate_cdn', timeout=30)
+stability_api = Upstream('stability', timeout=60)
+xai_api = Upstream('xai', timeout=30)
+gemini_api = Upstream('gemini', timeout=30)
+nsfw_api = Upstream('nsfw', timeout=30)
+
+# Upstream endpoints (overridable for staging and local stubs)
+REPLICATE_API_URL = os.getenv('REPLICATE_API_URL', 'https://api.replicate.com/v1/predictions')
+STABILITY_API_URL = os.getenv('STABILITY_API_URL', 'https://api.stability.ai/v1/generation/text-to-image')
+XAI_API_URL = os.getenv('XAI_API_URL', 'https://api.x.ai/v1/chat/completions')
+GEMINI_API_URL = os.getenv('GEMINI_API_URL', 'https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent')
+NSFW_API_URL = os.getenv('NSFW_API_URL', 'https://api.example.com/nsfw/detect')
+GEMINI_STREAM_URL = os.getenv(
+    'GEMINI_STREAM_URL',
+    GEMINI_API_URL.replace(':generateContent', ':streamGenerateContent') + '?alt=sse'
+)
 
 # === REPLACE ENTIRE /yt/search IN 1.py ===
 
 from functools import lru_cache
 import threading
 
-# CLEAR CACHE ON EMPTY RESULTS
-search_cache = {}
+from ttl_cache import TTLCache
+from singleflight import SingleFlight
+from search_warmer import SearchWarmer
+from media_store import MediaStore, content_key
+from conditional import file_response
+from yt_engine import DownloadEngine, EngineError
+from tts_engine import TTSEngine
+from phash import dhash, HashIndex
+from conversations import ConversationStore, conversation_key
+from result_cache import ResultCache, cache_request
+from metrics import (REGISTRY, STAGE_SECONDS, cache_families, dir_usage, instrument, temp_families, timed,
+                     timed_stream, upstream_limit_families)
+from admission import Admission
+from sse import (DONE, SSE_MIMETYPE, NDJSON_MIMETYPE, STREAM_HEADERS, StreamMetrics, TokenRelay,
+                 gemini_delta, parse_sse_line, stream_format, xai_delta)
+
+# LRU + TTL cache, persisted to SQLite so restarts start warm.
+# Empty results are cached briefly (negative TTL) so dead queries don't hammer YouTube.
+search_cache = TTLCache(
+    'yt_search',
+    maxsize=int(os.getenv('YT_SEARCH_CACHE_SIZE', 1000)),
+    ttl=int(os.getenv('YT_SEARCH_CACHE_TTL', 6 * 3600)),
+    negative_ttl=int(os.getenv('YT_SEARCH_NEGATIVE_TTL', 60)),
+    db_path=os.getenv('YT_SEARCH_CACHE_DB', os.path.join(os.getcwd(), 'cache', 'yt_search.sqlite')),
+)
+
+# Identical searches/downloads that arrive together share one yt-dlp run
+search_flight = SingleFlight('yt_search')
+download_flight = SingleFlight('yt_download')
+
+def normalize_query(query):
+    return query.strip().lower()
+
+# Every extraction runs on this pool: it bounds concurrent searches against
+# YouTube and keeps one YoutubeDL per worker (building one costs ~100ms).
+YT_SEARCH_RESULTS = int(os.getenv('YT_SEARCH_RESULTS', 5))
+YT_SEARCH_BATCH_MAX = int(os.getenv('YT_SEARCH_BATCH_MAX', 20))
+search_pool = ThreadPoolExecutor(max_workers=int(os.getenv('YT_SEARCH_WORKERS', 8)), thread_name_prefix='yt-search')
+search_local = threading.local()
+# Batch lookups wait here for their (shared, pooled) searches
+search_batch_pool = ThreadPoolExecutor(max_workers=YT_SEARCH_BATCH_MAX, thread_name_prefix='yt-search-batch')
+
+def lookup_yt_search(query):
+    """Return ``(videos, cached)`` for a normalized query."""
+    found, cached = search_cache.get(query)
+    search_warmer.record(query, found)
+    if found:
+        logger.info(f"Cache HIT: {query}" if cached else f"Cache HIT (negative): {query}")
+        return cached, True
+    return _search_miss(query), False
+
+def _search_miss(query):
+    """Search after a cache miss; an upstream error comes back as no results."""
+    try:
+        videos, shared = search_flight.do(query, lambda: search_pool.submit(_search_youtube, query).result())
+    except Exception as e:
+        logger.error(f"Search ERROR: {str(e)}")
+        return []
+    if shared:
+        logger.info(f"Search SHARED: {query}")
+    return videos
 
 def get_yt_search(query):
-    query = query.strip().lower()
-    
-    # RETURN CACHED IF NOT EMPTY
-    if query in search_cache and search_cache[query]:
-        logger.info(f"Cache HIT: {query}")
-        return search_cache[query]
+    return lookup_yt_search(normalize_query(query))[0]
 
-    try:
-        ydl_opts = {
+def _search_ydl():
+    ydl = getattr(search_local, 'ydl', None)
+    if ydl is None:
+        ydl = search_local.ydl = yt_dlp.YoutubeDL({
             'quiet': True,
             'no_warnings': True,
             'extract_flat': True,
@@ -88,33 +262,34 @@ def get_yt_search(query):
                 'Referer': 'https://www.youtube.com/',
             },
             'retries': 3,
-        }
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            result = ydl.extract_info(f"ytsearch10:{query}", download=False, process=False)
-            entries = result.get('entries', []) if result else []
-
-        videos = [
-            {
-                'title': v.get('title', 'Unknown'),
-                'url': f"https://www.youtube.com/watch?v={v['id']}",
-                'thumbnail': v.get('thumbnails', [{}])[0].get('url'),
-                'duration': v.get('duration')
-            } for v in entries if v.get('id')
-        ][:5]  # Top 5
-
-        # ONLY CACHE IF RESULTS
-        if videos:
-            search_cache[query] = videos
-            logger.info(f"Search SUCCESS: {query} → {len(videos)} results")
-        else:
-            logger.warning(f"Search FAILED: {query} → No results (cookies?)")
+        })
+    return ydl
+
+def _search_youtube(query):
+    """Search upstream and cache the results. Errors are raised, not cached,
+    so the search warmer can tell them from an empty result."""
+    with timed('extract', 'yt_search'):
+        # Ask for exactly the results we return; entries come in lazily
+        result = _search_ydl().extract_info(f"ytsearch{YT_SEARCH_RESULTS}:{query}", download=False, process=False)
+        entries = list(result.get('entries') or [])[:YT_SEARCH_RESULTS] if result else []
+
+    videos = [
+        {
+            'title': v.get('title', 'Unknown'),
+            'url': f"https://www.youtube.com/watch?v={v['id']}",
+            'thumbnail': (v.get('thumbnails') or [{}])[0].get('url'),
+            'duration': v.get('duration')
+        } for v in entries if v.get('id')
+    ]
+
+    # Empty results get the short negative TTL
+    search_cache.set(query, videos)
+    if videos:
+        logger.info(f"Search SUCCESS: {query} → {len(videos)} results")
+    else:
+        logger.warning(f"Search FAILED: {query} → No results (cookies?)")
 
-        return videos
-
-    except Exception as e:
-        logger.error(f"Search ERROR: {str(e)}")
-        return []
+    return videos
 
 @app.route('/yt/search', methods=['GET'])
 def yt_search():
@@ -125,98 +300,513 @@ def yt_search():
     results = get_yt_search(query)
     return jsonify({'results': results})
 
+@app.route('/yt/search/batch', methods=['POST'])
+def yt_search_batch():
+    """Resolve many queries at once ({"queries": [...]}). Cache hits are
+    answered locally; misses run in parallel on the search pool."""
+    queries = (request.get_json(silent=True) or {}).get('queries')
+    if not isinstance(queries, list) or not queries or not all(isinstance(q, str) and q.strip() for q in queries):
+        return jsonify({'error': 'queries must be a non-empty list of strings'}), 400
+    if len(queries) > YT_SEARCH_BATCH_MAX:
+        return jsonify({'error': f'too many queries (max {YT_SEARCH_BATCH_MAX})'}), 400
+
+    # Repeats within a batch share one lookup
+    lookups = {}
+    for query in queries:
+        key = normalize_query(query)
+        if key not in lookups:
+            found, cached = search_cache.get(key)
+            search_warmer.record(key, found)
+            if found:
+                lookups[key] = (cached, True)
+            else:
+                lookups[key] = search_batch_pool.submit(_search_miss, key)
+    results = []
+    hits = 0
+    for index, query in enumerate(queries):
+        lookup = lookups[normalize_query(query)]
+        item = {'index': index, 'query': query}
+        try:
+            videos, cached = lookup if isinstance(lookup, tuple) else (lookup.result(), False)
+            item.update(results=videos, cached=cached)
+            hits += cached
+        except Exception as e:
+            logger.error(f"Search batch item {index} failed: {str(e)}")
+            item.update(error=str(e), status=500)
+        results.append(item)
+
+    logger.info(f"Search batch: {len(queries)} queries, {hits} cached")
+    return jsonify({'results': results, 'cached': hits, 'searched': len(queries) - hits})
+
+@app.route('/yt/search/stats', methods=['GET'])
+def yt_search_stats():
+    return jsonify(dict(search_cache.stats(), warmer=search_warmer.stats()))
+
 # --- YouTube Download Endpoint (Fixed for Duplicates and File Not Found) ---
 
+YT_ID_RE = re.compile(r'(?:v=|youtu\.be/|shorts/|embed/|live/)([\w-]{11})')
+
+def extract_video_id(url):
+    match = YT_ID_RE.search(url)
+    return match.group(1) if match else url.strip()
+
+class DownloadError(Exception):
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.status = status
+
+# Finished downloads keyed by (video id, type, format selector); repeat requests
+# stream straight from disk. YT_MEDIA_CACHE_MB=0 keeps files only while streaming.
+media_store = MediaStore(
+    'yt_media',
+    os.getenv('YT_MEDIA_CACHE_DIR', os.path.join(os.getcwd(), 'cache', 'media')),
+    int(float(os.getenv('YT_MEDIA_CACHE_MB', 2048)) * 1024 * 1024),
+)
+
+def yt_format(kind):
+    if kind == 'audio':
+        return 'bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio[ext=mp3]/bestaudio'
+    return 'best[ext=mp4][height<=480]/best[height<=480][ext=mp4]/best[ext=webm][height<=480]/best'
+
+# Options shared by every download; the engine adds format, outtmpl and hooks
+ydl_opts = {
+    'quiet': True,
+    'no_warnings': True,
+    'noprogress': True,
+    'http_headers': {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+    },
+    'retries': 3,
+    'fragment_retries': 3,
+    'socket_timeout': 12,
+    'cookiefile': 'cookies.txt' if os.path.exists('cookies.txt') else None,
+    'noplaylist': True,
+    'nooverwrites': True,
+}
+
+# Warm in-process YoutubeDL workers; YT_ENGINE_BACKEND=subprocess spawns the CLI per job.
+# yt-dlp names its own files, so they go in a subdirectory temp_store.reconcile
+# leaves alone (it only looks at files directly under TEMP_DIR) until they're
+# published; the whole directory goes with this process's TEMP_DIR.
+YT_DOWNLOAD_DIR = os.path.join(TEMP_DIR, 'yt')
+os.makedirs(YT_DOWNLOAD_DIR, exist_ok=True)
+yt_engine = DownloadEngine(
+    YT_DOWNLOAD_DIR,
+    ydl_opts,
+    backend=os.getenv('YT_ENGINE_BACKEND', 'inprocess'),
+    workers=int(os.getenv('YT_ENGINE_WORKERS', 4)),
+    timeout=int(os.getenv('YT_ENGINE_TIMEOUT', 180)),
+    wait_timeout=int(os.getenv('YT_ENGINE_WAIT_TIMEOUT', 0)) or None,  # queueing included; default 2x timeout
+)
+if os.getenv('YT_ENGINE_PREWARM', '1') == '1':
+    startup.prewarm('yt_engine', lambda: yt_engine.warm([yt_format('audio'), yt_format('video')]))
+startup.mark('yt_engine')
+
+def _download_youtube(url, key):
+    """Download via the engine, then publish into the media store (pinned once)."""
+    download = yt_engine.submit(url, key[2])
+    try:
+        # A cancelled background job stops its download, unless requests are waiting on it too
+        with on_job_cancel(lambda: download_flight.waiters(key) or download.cancel()):
+            result = download.result(yt_engine.wait_timeout)
+    except EngineError as e:
+        raise DownloadError(str(e))
+
+    actual_file, ext = result['file'], result['ext']
+    size_mb = os.path.getsize(actual_file) / (1024*1024)
+    if size_mb > 95:
+        cleanup_file(actual_file)
+        raise DownloadError(f'file too large ({size_mb:.1f}MB)', 400)
+
+    return media_store.publish(key, actual_file, ext)
+
+def _share_download(entry, participants):
+    # The leader's publish pinned once; pin for every coalesced waiter too
+    if participants > 1:
+        media_store.pin(entry['key'], participants - 1)
+
+# --- Search warm-up ---
+# Popular /yt/search queries are refreshed in the background before they
+# expire (YT_SEARCH_WARM_* settings; YT_SEARCH_WARM_QUERIES is a comma
+# separated list always kept warm). YT_SEARCH_PREFETCH_AUDIO=1 also
+# downloads the top result's audio for the most popular ones, only while
+# the download engine has nothing queued.
+def prefetch_audio(url):
+    if yt_engine.stats()['queued']:
+        return None
+    key = (extract_video_id(url), 'audio', yt_format('audio'))
+    entry = media_store.acquire(key)
+    try:
+        if entry is None:
+            entry, _ = download_flight.do(key, lambda: _download_youtube(url, key), on_done=_share_download)
+    finally:
+        # Only the file was wanted: drop the pin so it stays evictable
+        if entry is not None:
+            media_store.release(entry['key'])
+    return key
+
+def warm_search(query):
+    videos, _ = search_flight.do(query, lambda: search_pool.submit(_search_youtube, query).result())
+    return videos
+
+search_warmer = SearchWarmer(
+    search_cache,
+    warm_search,
+    interval=int(os.getenv('YT_SEARCH_WARM_INTERVAL', 60)),
+    top=int(os.getenv('YT_SEARCH_WARM_TOP', 50)),
+    min_score=float(os.getenv('YT_SEARCH_WARM_MIN_HITS', 3)),
+    half_life=int(os.getenv('YT_SEARCH_WARM_HALF_LIFE', 3600)),
+    refresh_before=int(os.getenv('YT_SEARCH_WARM_REFRESH_BEFORE', 900)),
+    per_cycle=int(os.getenv('YT_SEARCH_WARM_PER_CYCLE', 10)),
+    seed=[normalize_query(q) for q in os.getenv('YT_SEARCH_WARM_QUERIES', '').split(',') if q.strip()],
+    prefetch=prefetch_audio if os.getenv('YT_SEARCH_PREFETCH_AUDIO', '0') == '1' else None,
+    prefetch_top=int(os.getenv('YT_SEARCH_PREFETCH_TOP', 10)),
+)
+if os.getenv('YT_SEARCH_WARM', '1') == '1':
+    startup.prewarm('search_warmer', search_warmer.start, optional=False)
+
+# --- Streaming downloads ---
+# yt-dlp writes to stdout (-o -); a pump thread tees it into a growing temp file
+# and every client for the same key tails that file, so bytes reach callers as
+# soon as YouTube sends them. A complete, in-limit download is published to the
+# media store afterwards.
+
+MAX_DOWNLOAD_BYTES = 95 * 1024 * 1024
+DOWNLOAD_TIMEOUT = 180
+STREAM_CHUNK = 64 * 1024
+
+live_downloads = {}
+live_downloads_lock = threading.Lock()
+
+class LiveDownload:
+    def __init__(self, key, path):
+        self.key = key
+        self.path = path
+        self.ext = None
+        self.size = 0
+        self.done = False
+        self.error = None
+        self.readers = 0
+        self.settled = False  # published to media_store, or thrown away
+        self.cond = threading.Condition()
+
+    def settle(self):
+        with self.cond:
+            self.settled = True
+            self.cond.notify_all()
+
+def sniff_ext(head, kind):
+    """Guess the container from the first bytes yt-dlp emits."""
+    if head[4:8] == b'ftyp':
+        return 'm4a' if kind == 'audio' else 'mp4'
+    if head[:4] == b'\x1a\x45\xdf\xa3':
+        return 'webm'
+    if head[:3] == b'ID3' or (len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0):
+        return 'mp3'
+    return 'bin'
+
+def _pump_download(live, url, kind):
+    cmd = ['yt-dlp', '-f', live.key[2], '-o', '-', '--no-part', url]
+    if os.path.exists('cookies.txt'):
+        cmd += ['--cookies', 'cookies.txt']
+
+    timed_out = threading.Event()
+    started = time.perf_counter()
+    write_seconds = 0.0
+    with tempfile.TemporaryFile() as errlog, open(live.path, 'wb') as out:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errlog)
+
+        def kill_on_timeout():
+            timed_out.set()
+            proc.kill()
+
+        timer = threading.Timer(DOWNLOAD_TIMEOUT, kill_on_timeout)
+        timer.start()
+        try:
+            while chunk := proc.stdout.read1(STREAM_CHUNK):
+                write_start = time.perf_counter()
+                out.write(chunk)
+                out.flush()
+                write_seconds += time.perf_counter() - write_start
+                with live.cond:
+                    if live.ext is None:
+                        live.ext = sniff_ext(chunk, kind)
+                    live.size += len(chunk)
+                    live.cond.notify_all()
+                if live.size > MAX_DOWNLOAD_BYTES:
+                    proc.kill()
+                    live.error = DownloadError(f'file too large (>{MAX_DOWNLOAD_BYTES // (1024*1024)}MB)', 400)
+                    break
+                if not temp_store.resize(live.path, live.size):
+                    proc.kill()
+                    live.error = DownloadError('temp storage full', 503)
+                    break
+            proc.wait()
+        finally:
+            timer.cancel()
+            proc.stdout.close()
+            STAGE_SECONDS.observe(time.perf_counter() - started, 'subprocess', 'yt-dlp-stream')
+            STAGE_SECONDS.observe(write_seconds, 'file_write', 'yt-dlp-stream')
+
+        if live.error is None:
+            if timed_out.is_set():
+                live.error = DownloadError('download timeout')
+            elif proc.returncode != 0:
+                errlog.seek(0)
+                logger.error(f"yt-dlp failed: {errlog.read().decode(errors='replace')}")
+                live.error = DownloadError('download failed')
+            elif live.size == 0:
+                live.error = DownloadError('file not found')
+
+    with live_downloads_lock:
+        live_downloads.pop(live.key, None)
+    with live.cond:
+        live.done = True
+        live.cond.notify_all()
+
+    try:
+        if live.error is None:
+            try:
+                entry = media_store.publish(live.key, live.path, live.ext)
+                temp_store.forget(live.path)
+                media_store.release(entry['key'])
+                logger.info(f"Streamed download cached: {live.key[:2]} ({live.size / (1024*1024):.1f}MB)")
+                return
+            except Exception as e:
+                logger.error(f"Could not cache streamed download {live.key[:2]}: {str(e)}")
+        else:
+            logger.warning(f"Streamed download aborted: {live.key[:2]} ({str(live.error)})")
+        cleanup_file(live.path)
+    finally:
+        live.settle()
+
+def new_live_download(key):
+    """A LiveDownload backed by a fresh, empty temp file."""
+    live = LiveDownload(key, temp_store.path('yt', '.stream', '/yt/download'))
+    open(live.path, 'wb').close()
+    return live
+
+def open_live_download(url, kind, key):
+    """Join (or start) the live download for ``key``; returns (live, file handle)."""
+    with live_downloads_lock:
+        live = live_downloads.get(key)
+        if live is None:
+            live = new_live_download(key)
+            live_downloads[key] = live
+            threading.Thread(target=_pump_download, args=(live, url, kind), daemon=True).start()
+        else:
+            logger.info(f"Download SHARED (streaming): {key[:2]}")
+        # Open while registered so the pump can't publish (move) the file first
+        handle = open(live.path, 'rb')
+        live.readers += 1
+    return live, handle
+
+def tail_live_download(live, handle):
+    """Yield bytes as the pump writes them; raise if the download aborts."""
+    try:
+        while True:
+            chunk = handle.read(STREAM_CHUNK)
+            if chunk:
+                yield chunk
+                continue
+            with live.cond:
+                while not live.done and handle.tell() >= live.size:
+                    live.cond.wait(1)
+                finished = live.done and handle.tell() >= live.size
+            if live.error is not None:
+                # Drop the connection instead of ending the body, so clients see a failed transfer
+                raise live.error
+            if finished:
+                return
+    finally:
+        handle.close()
+        with live_downloads_lock:
+            live.readers -= 1
+
 @app.route('/yt/download', methods=['POST'])
 def yt_download():
     data = request.get_json() or {}
     url = data.get('url')
     kind = data.get('type', 'audio')
+    streaming = data.get('stream', os.getenv('YT_STREAM_DOWNLOADS', '0') == '1')
 
     if not url:
         return jsonify({'error': 'missing url'}), 400
 
-    unique_id = str(uuid.uuid4()).replace('-', '')
-    output_template = os.path.join(TEMP_DIR, f"yt_{unique_id}")
-
-    # === FIXED: PROPER INDENT + COLON ===
     if kind == 'audio':
-        fmt = 'bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio[ext=mp3]/bestaudio'
         mimes = {'m4a': 'audio/mp4', 'webm': 'audio/webm', 'mp3': 'audio/mpeg'}
     else:
-        fmt = 'best[ext=mp4][height<=480]/best[height<=480][ext=mp4]/best[ext=webm][height<=480]/best'
         mimes = {'mp4': 'video/mp4', 'webm': 'video/webm'}
 
-    ydl_opts = {
-        'format': fmt,
-        'outtmpl': f"{output_template}.%(ext)s",
-        'quiet': True,
-        'no_warnings': True,
-        'http_headers': {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        },
-        'retries': 3,
-        'fragment_retries': 3,
-        'socket_timeout': 12,
-        'download_timeout': 180,
-        'cookiefile': 'cookies.txt' if os.path.exists('cookies.txt') else None,
-        'noplaylist': True,
-        'nooverwrites': True,
-    }
-
     try:
-        import subprocess
-        cmd = ['yt-dlp', '--newline', '-f', fmt, '--output', f"{output_template}.%(ext)s", url]
-        if os.path.exists('cookies.txt'):
-            cmd += ['--cookies', 'cookies.txt']
-
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        try:
-            stdout, stderr = proc.communicate(timeout=180)
-        except subprocess.TimeoutExpired:
-            proc.kill()
-            return jsonify({'error': 'download timeout'}), 500
-
-        if proc.returncode != 0:
-            logger.error(f"yt-dlp failed: {stderr.decode()}")
-            return jsonify({'error': 'download failed'}), 500
-
-        actual_file = None
-        for f in os.listdir(TEMP_DIR):
-            if f.startswith(f"yt_{unique_id}."):
-                actual_file = os.path.join(TEMP_DIR, f)
-                ext = f.split('.')[-1]
-                break
-
-        if not actual_file:
-            return jsonify({'error': 'file not found'}), 500
-
-        size_mb = os.path.getsize(actual_file) / (1024*1024)
-        if size_mb > 95:
-            cleanup_file(actual_file)
-            return jsonify({'error': f'file too large ({size_mb:.1f}MB)'}), 400
-
-        def stream():
-            with open(actual_file, 'rb') as f:
-                while chunk := f.read(1024*1024):
-                    yield chunk
-
-        resp = Response(stream(), mimetype=mimes.get(ext, 'application/octet-stream'))
-        resp.headers['Content-Disposition'] = f'attachment; filename="yt_{unique_id}.{ext}"'
-
-        @resp.call_on_close
-        def cleanup():
-            time.sleep(0.5)
-            cleanup_file(actual_file)
-
-        return resp
-
+        video_id = extract_video_id(url)
+        key = (video_id, kind, yt_format(kind))
+        entry = media_store.acquire(key)
+        search_warmer.record_download(key, entry is not None)
+        if entry:
+            logger.info(f"Media cache HIT: {key[:2]}")
+        elif streaming:
+            return stream_live_download(url, kind, key, mimes)
+        else:
+            entry, shared = download_flight.do(
+                key, lambda: _download_youtube(url, key), on_done=_share_download
+            )
+            if shared:
+                logger.info(f"Download SHARED: {key[:2]}")
+        ext = entry['ext']
+        return serve_entry(media_store, entry, mimes.get(ext, 'application/octet-stream'),
+                           f'"yt_{secure_filename(video_id)}.{ext}"')
+
+    except DownloadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except TempQuotaExceeded as e:
+        return storage_full(e)
     except Exception as e:
         logger.error(f"YT ERROR: {str(e)}\n{traceback.format_exc()}")
         return jsonify({'error': str(e)}), 500
 
+def stream_live_download(url, kind, key, mimes):
+    live, handle = open_live_download(url, kind, key)
+    # Hold the response until the container is known so Content-Type is real
+    with live.cond:
+        while live.ext is None and not live.done:
+            live.cond.wait(1)
+    if live.ext is None:
+        handle.close()
+        with live_downloads_lock:
+            live.readers -= 1
+        error = live.error or DownloadError('download failed')
+        return jsonify({'error': str(error)}), error.status
+
+    ext = live.ext
+    resp = Response(timed_stream(tail_live_download(live, handle), 'yt_download_live'),
+                    mimetype=mimes.get(ext, 'application/octet-stream'))
+    resp.headers['Content-Disposition'] = f'attachment; filename="yt_{secure_filename(key[0])}.{ext}"'
+    # Where the finished file can be fetched (and resumed) once it's cached
+    resp.headers['Content-Location'] = media_url(media_store, content_key(*key))
+    return resp
+
+@app.route('/yt/inflight', methods=['GET'])
+def yt_inflight():
+    with live_downloads_lock:
+        streaming = {str(key[:2]): live.readers for key, live in live_downloads.items()}
+    return jsonify({
+        'search': search_flight.stats(),
+        'download': download_flight.stats(),
+        'streaming': streaming,
+        'engine': yt_engine.stats(),
+    })
+
+@app.route('/yt/media/stats', methods=['GET'])
+def yt_media_stats():
+    return jsonify(media_store.stats())
+
+
+# --- Media post-processing ---
+# Images leave fit to Messenger's attachment limit (MEDIA_MAX_MB) instead of
+# failing to upload, and are recompressed or downscaled on request
+# ("image_format", "max_side", "max_kb", "quality"). Encoding runs in a
+# process pool of MEDIA_WORKERS; caches keep the originals.
+media = MediaPipeline(workers=int(os.getenv('MEDIA_WORKERS', 2)), timeout=int(os.getenv('MEDIA_TIMEOUT', 30)))
+
+def image_response(name, data, options, download_name, headers=None):
+    """Send image bytes fit to ``options``; encode time and bytes saved go in X- headers."""
+    data, info = media.process(data, options, name)
+    resp = Response(data, mimetype=info['mimetype'] if info else 'image/png',
+                    headers=dict(headers or {}, **media_headers(info)))
+    resp.headers['Content-Disposition'] = f'attachment; filename={with_ext(download_name, info)}'
+    return resp
+
+@app.route('/media/stats', methods=['GET'])
+def media_stats():
+    return jsonify(media.stats())
+
+# --- Generated Image Cache ---
+# Opt-in per request: a "seed", "deterministic": true or a "cache" policy
+# (reuse / refresh / bypass / prefetch) makes (prompt, size, seed) a cache key.
+# Without a seed one is derived from the prompt, so repeats hit the cache.
+image_results = ResultCache(
+    MediaStore(
+        'images',
+        os.getenv('IMAGE_CACHE_DIR', os.path.join(os.getcwd(), 'cache', 'images')),
+        int(float(os.getenv('IMAGE_CACHE_MB', 512)) * 1024 * 1024),
+    ),
+    costs={
+        'flux': float(os.getenv('FLUX_COST_USD', 0.025)),
+        'genimage': float(os.getenv('STABILITY_COST_USD', 0.01)),
+    },
+)
+PREFETCH_PRIORITY = int(os.getenv('PREFETCH_PRIORITY', 9))
+
+def cached_image_response(name, view, data, cached, options, download_name):
+    """Answer a deterministic request without generating: queue a prefetch
+    job, or serve a cache hit. None means generate as usual."""
+    key, seed, policy = cached
+    if policy == 'prefetch':
+        resp = submit_replay(app, jobs, name, f'/{name}', view, dict(data, cache='reuse'), PREFETCH_PRIORITY)
+        resp.headers['X-Seed'] = str(seed)
+        return resp
+    entry = image_results.lookup(key, policy)
+    if entry is None:
+        return None
+    logger.info(f"{name} cache HIT (seed {seed})")
+    return entry_response(name, entry, options, download_name, {'X-Cache': 'HIT', 'X-Seed': str(seed)})
+
+def entry_response(name, entry, options, download_name, headers):
+    """Serve a pinned cache entry, through the media pipeline if it needs it."""
+    if not media.needed(options, entry['size']):
+        return serve_entry(image_results.store, entry, 'image/png', download_name, headers)
+    try:
+        with open(entry['path'], 'rb') as f:
+            data = f.read()
+    finally:
+        image_results.release(entry)
+    return image_response(name, data, options, download_name, headers)
+
+def generated_image(name, output, cached, started, download_name, options):
+    """Send a freshly generated image (a SpillBuffer), caching the original
+    first if the request asked to."""
+    headers = {}
+    location = None
+    if cached is not None:
+        key, seed, policy = cached
+        headers = {'X-Cache': 'MISS' if policy == 'reuse' else policy.upper(), 'X-Seed': str(seed)}
+        if policy != 'bypass':
+            data = output.getvalue()
+            if data is None:
+                entry = image_results.save(key, 'png', time.time() - started, path=output.detach())
+                return entry_response(name, entry, options, download_name, headers)
+            entry = image_results.save(key, 'png', time.time() - started, data=data)
+            image_results.release(entry)
+            location = media_url(image_results.store, entry['key'])
+    if media.needed(options, output.size):
+        with output.reader() as f:
+            data = f.read()
+        return image_response(name, data, options, download_name, headers)
+    if location:
+        headers['Content-Location'] = location  # the cached copy, for Range requests
+    return buffer_response(output, 'image/png', download_name, headers or None)
+
+@app.route('/images/cache/stats', methods=['GET'])
+def image_cache_stats():
+    return jsonify(image_results.stats())
 
 # --- Flux.1 Image Generation Endpoint ---
+def flux_payload(prompt, seed=None):
+    payload = {
+        'version': 'flux.1-dev',
+        'input': {
+            'prompt': prompt,
+            'num_outputs': 1,
+            'output_format': 'png',
+            'width': 512,
+            'height': 512
+        }
+    }
+    if seed is not None:
+        payload['input']['seed'] = seed
+    return payload
+
 @app.route('/flux', methods=['POST'])
 def flux_generate():
     data = request.get_json() or {}
@@ -225,62 +815,69 @@ def flux_generate():
         logger.error("Missing prompt in /flux")
         return jsonify({'error': 'missing prompt'}), 400
     try:
-        unique_id = str(uuid.uuid4()).replace('-', '')
-        output_file = os.path.join(TEMP_DIR, f"flux_{unique_id}.png")
-
+        cached = cache_request(data, 'flux', prompt, 512, 512)
+        options = media.options(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    download_name = f"flux_{secure_filename(prompt[:20])}.png"
+    if cached and (resp := cached_image_response('flux', flux_generate, data, cached, options, download_name)):
+        return resp
+    try:
+        started = time.time()
         api_key = os.getenv('FLUX_API_KEY')
         if not api_key:
             logger.error("Flux API key not set")
             return jsonify({'error': 'Flux API key not configured'}), 500
 
-        api_url = "https://api.replicate.com/v1/predictions"
-        response = requests.post(
-            api_url,
+        response = replicate_api.post(
+            REPLICATE_API_URL,
             headers={'Authorization': f'Bearer {api_key}'},
-            json={
-                'version': 'flux.1-dev',
-                'input': {
-                    'prompt': prompt,
-                    'num_outputs': 1,
-                    'output_format': 'png',
-                    'width': 512,
-                    'height': 512
-                }
-            },
-            timeout=60
+            json=flux_payload(prompt, cached and cached[1])
         )
         response.raise_for_status()
         prediction = response.json()
         image_url = prediction.get('output')[0]
 
-        with file_lock:
-            image_response = requests.get(image_url, timeout=30)
-            image_response.raise_for_status()
-            with open(output_file, 'wb') as f:
-                f.write(image_response.content)
-
-        is_valid, file_size = check_file_size(output_file)
-        logger.info(f"Flux image generated: {output_file} (size: {file_size:.2f}MB)")
-        
-        if not is_valid:
-            logger.warning(f"Image too large: {file_size:.2f}MB")
-            cleanup_file(output_file)
-            return jsonify({'error': 'image too large'}), 400
-
-        response = send_file(
-            output_file,
-            as_attachment=True,
-            mimetype='image/png',
-            download_name=f"flux_{secure_filename(prompt[:20])}.png"
-        )
-        return response
+        # Streamed into a bounded buffer; oversized images fail as they arrive
+        output = temp_buffer('flux', '.png')
+        cdn_response = replicate_cdn.get(image_url, stream=True)
+        try:
+            cdn_response.raise_for_status()
+            with timed('upstream_body', 'flux'):
+                for chunk in cdn_response.iter_content(STREAM_CHUNK):
+                    output.write(chunk)
+        finally:
+            cdn_response.close()
+        logger.info(f"Flux image generated: {output.size / (1024*1024):.2f}MB{' (spilled)' if output.spilled else ''}")
+
+        return generated_image('flux', output, cached, started, download_name, options)
+    except PayloadTooLarge:
+        logger.warning("Flux image too large")
+        return jsonify({'error': 'image too large'}), 400
+    except UpstreamUnavailable as e:
+        return upstream_unavailable(e)
+    except TempQuotaExceeded as e:
+        return storage_full(e)
     except Exception as e:
         logger.error(f"Flux generation error: {str(e)} with traceback: {traceback.format_exc()}")
         return jsonify({'error': str(e)}), 500
     finally:
-        cleanup_file(output_file if 'output_file' in locals() else None)
+        if 'output' in locals():
+            output.close()
 
 # --- General Image Generation Endpoint ---
+def genimage_payload(prompt, seed=None):
+    payload = {
+        'text_prompts': [{'text': prompt}],
+        'width': 512,
+        'height': 512,
+        'samples': 1,
+        'steps': 30
+    }
+    if seed is not None:
+        payload['seed'] = seed
+    return payload
+
 @app.route('/genimage', methods=['POST'])
 def gen_image():
     data = request.get_json() or {}
@@ -289,109 +886,260 @@ def gen_image():
         logger.error("Missing prompt in /genimage")
         return jsonify({'error': 'missing prompt'}), 400
     try:
-        unique_id = str(uuid.uuid4()).replace('-', '')
-        output_file = os.path.join(TEMP_DIR, f"genimage_{unique_id}.png")
-
+        cached = cache_request(data, 'genimage', prompt, 512, 512)
+        options = media.options(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    download_name = f"genimage_{secure_filename(prompt[:20])}.png"
+    if cached and (resp := cached_image_response('genimage', gen_image, data, cached, options, download_name)):
+        return resp
+    try:
+        started = time.time()
         api_key = os.getenv('STABLE_DIFFUSION_API_KEY')
         if not api_key:
             logger.error("Stable Diffusion API key not set")
             return jsonify({'error': 'Stable Diffusion API key not configured'}), 500
 
-        api_url = "https://api.stability.ai/v1/generation/text-to-image"
-        response = requests.post(
-            api_url,
+        response = stability_api.post(
+            STABILITY_API_URL,
             headers={'Authorization': f'Bearer {api_key}'},
-            json={
-                'text_prompts': [{'text': prompt}],
-                'width': 512,
-                'height': 512,
-                'samples': 1,
-                'steps': 30
-            },
-            timeout=60
+            json=genimage_payload(prompt, cached and cached[1])
         )
         response.raise_for_status()
         image_data = response.json().get('artifacts')[0].get('base64')
 
-        with file_lock:
-            image_bytes = base64.b64decode(image_data)
-            with open(output_file, 'wb') as f:
-                f.write(image_bytes)
-
-        is_valid, file_size = check_file_size(output_file)
-        logger.info(f"Image generated: {output_file} (size: {file_size:.2f}MB)")
-        
-        if not is_valid:
-            logger.warning(f"Image too large: {file_size:.2f}MB")
-            cleanup_file(output_file)
-            return jsonify({'error': 'image too large'}), 400
-
-        response = send_file(
-            output_file,
-            as_attachment=True,
-            mimetype='image/png',
-            download_name=f"genimage_{secure_filename(prompt[:20])}.png"
-        )
-        return response
+        # Check the decoded size before decoding
+        if len(image_data) // 4 * 3 > MAX_MEDIA_BYTES:
+            raise PayloadTooLarge(MAX_MEDIA_BYTES)
+        output = temp_buffer('genimage', '.png')
+        with timed('buffer_write', 'genimage'):
+            output.write(base64.b64decode(image_data))
+        logger.info(f"Image generated: {output.size / (1024*1024):.2f}MB{' (spilled)' if output.spilled else ''}")
+
+        return generated_image('genimage', output, cached, started, download_name, options)
+    except PayloadTooLarge:
+        logger.warning("Generated image too large")
+        return jsonify({'error': 'image too large'}), 400
+    except UpstreamUnavailable as e:
+        return upstream_unavailable(e)
+    except TempQuotaExceeded as e:
+        return storage_full(e)
     except Exception as e:
         logger.error(f"Image generation error: {str(e)} with traceback: {traceback.format_exc()}")
         return jsonify({'error': str(e)}), 500
     finally:
-        cleanup_file(output_file if 'output_file' in locals() else None)
+        if 'output' in locals():
+            output.close()
 
-# --- Text-to-Speech Endpoint ---
 # --- Text-to-Speech Endpoint (gTTS - Free Alternative) ---
+# Long texts are split at sentence boundaries and synthesized in parallel;
+# finished MP3s are cached by (text hash, lang, slow) with a disk budget.
+tts_engine = TTSEngine(
+    workers=int(os.getenv('TTS_WORKERS', 4)),
+    timeout=int(os.getenv('TTS_TIMEOUT', 30)),
+)
+tts_store = MediaStore(
+    'tts',
+    os.getenv('TTS_CACHE_DIR', os.path.join(os.getcwd(), 'cache', 'tts')),
+    int(float(os.getenv('TTS_CACHE_MB', 256)) * 1024 * 1024),
+)
+tts_flight = SingleFlight('tts')
+
+def tts_flag(value):
+    """``slow`` as a bool: JSON true/false/null, 0/1, or the same spelled as
+    a string; None for anything else."""
+    if value is None:
+        return False
+    if isinstance(value, str):
+        value = {'true': True, 'false': False, '1': True, '0': False, 'yes': True, 'no': False,
+                 '': False}.get(value.strip().lower(), value)
+    if isinstance(value, bool) or value in (0, 1):
+        return bool(value)
+    return None
+
+def tts_key(text, lang, slow):
+    return (content_key(text), lang, bool(slow))
+
+def _synthesize_tts(text, lang, slow, key):
+    output = temp_buffer('tts', '.mp3')
+    try:
+        tts_engine.synthesize(text, output, lang, slow)
+        logger.info(f"TTS generated (gTTS): {lang} {len(text)} chars (size: {output.size / (1024*1024):.2f}MB)")
+        return publish_buffer(tts_store, key, output, 'mp3')
+    except PayloadTooLarge:
+        raise DownloadError('audio too large', 400)
+    finally:
+        output.close()
+
+def _share_tts(entry, participants):
+    if participants > 1:
+        tts_store.pin(entry['key'], participants - 1)
+
+def stream_tts(text, lang, slow, key, download_name):
+    """Send segments as they finish while teeing them to a file for the cache."""
+    segments = tts_engine.segments(text, lang, slow)
+    first = next(segments)  # errors before the first byte still get a JSON response
+    output = temp_buffer('tts', '.mp3')
+
+    def generate():
+        teeing = complete = False
+        try:
+            teeing = tee(first)
+            yield first
+            for segment in segments:
+                teeing = teeing and tee(segment)
+                yield segment
+            complete = True
+        finally:
+            segments.close()
+            if complete and teeing:
+                tts_store.release(publish_buffer(tts_store, key, output, 'mp3')['key'])
+            output.close()
+
+    def tee(segment):
+        # Too large (or no room to spill) to cache: keep streaming without the copy
+        try:
+            output.write(segment)
+            return True
+        except (PayloadTooLarge, TempQuotaExceeded) as e:
+            logger.warning(f"TTS stream not cached: {str(e)}")
+            output.close()
+            return False
+
+    resp = Response(timed_stream(generate(), 'tts_stream'), mimetype='audio/mpeg')
+    resp.headers['Content-Disposition'] = f'attachment; filename={download_name}'
+    return resp
+
 @app.route('/tts', methods=['POST'])
 def tts():
     data = request.get_json() or {}
-    text = data.get('text')
+    text = ' '.join((data.get('text') or '').split())
+    requested = data.get('lang', 'en')
+    slow = tts_flag(data.get('slow', False))
     if not text:
         logger.error("Missing text in /tts")
         return jsonify({'error': 'missing text'}), 400
+    if slow is None:
+        return jsonify({'error': 'slow must be true or false'}), 400
+    lang = tts_engine.canonical(requested)
+    if lang is None:
+        return jsonify({'error': f'unsupported language: {requested}'}), 400
 
+    download_name = f"tts_{secure_filename(text[:20])}.mp3"
     try:
-        unique_id = str(uuid.uuid4()).replace('-', '')
-        output_file = os.path.join(TEMP_DIR, f"tts_{unique_id}.mp3")
-
-        # Install: pip install gtts (run in terminal)
-        from gtts import gTTS
-        tts = gTTS(text=text, lang='en', slow=False)  # lang='hi' for Hindi, etc.
-        tts.save(output_file)
-
-        is_valid, file_size = check_file_size(output_file)
-        logger.info(f"TTS generated (gTTS): {output_file} (size: {file_size:.2f}MB)")
-
-        if not is_valid:
-            cleanup_file(output_file)
-            return jsonify({'error': 'audio too large'}), 400
-
-        resp = send_file(
-            output_file,
-            as_attachment=True,
-            mimetype='audio/mpeg',
-            download_name=f"tts_{secure_filename(text[:20])}.mp3"
-        )
-
-        @resp.call_on_close
-        def _cleanup():
-            time.sleep(0.5)
-            cleanup_file(output_file)
-
-        return resp
+        key = tts_key(text, lang, slow)
+        entry = tts_store.acquire(key)
+        if entry:
+            logger.info(f"TTS cache HIT: {lang} {text[:30]}")
+        elif data.get('stream'):
+            return stream_tts(text, lang, slow, key, download_name)
+        else:
+            entry, _ = tts_flight.do(key, lambda: _synthesize_tts(text, lang, slow, key), on_done=_share_tts)
+        return serve_entry(tts_store, entry, 'audio/mpeg', download_name)
 
+    except DownloadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except TempQuotaExceeded as e:
+        return storage_full(e)
     except Exception as e:
         logger.error(f"TTS error: {str(e)}\n{traceback.format_exc()}")
         return jsonify({'error': str(e)}), 500
-    finally:
-        if 'output_file' in locals():
-            cleanup_file(output_file)
+
+@app.route('/tts/stats', methods=['GET'])
+def tts_stats():
+    return jsonify({'cache': tts_store.stats(), 'engine': tts_engine.stats(), 'inflight': tts_flight.stats()})
+
+# --- Streaming chat ---
+# `stream: true` (or Accept: text/event-stream / application/x-ndjson) relays
+# tokens as the upstream produces them: {"delta": ...} events, then a final
+# {"done": true, "response": ..., "metrics": {ttft_ms, tokens_per_s, ...}}.
+ai_stream_metrics = StreamMetrics('ai')
+gemini_stream_metrics = StreamMetrics('gemini')
+
+def relay_stream(upstream, url, headers, payload, fmt, extract, metrics, label, on_done=None, **extra):
+    """Start a streaming completion and relay it. Errors before the first
+    byte raise, so the view still answers them with a JSON error.
+    ``on_done(text)`` runs once the full reply has been received."""
+    response = upstream.post(url, headers=headers, json=payload, stream=True)
+    try:
+        response.raise_for_status()
+    except Exception:
+        response.close()
+        raise
+    relay = TokenRelay(fmt, extract, metrics)
+
+    def generate():
+        try:
+            for line in response.iter_lines(chunk_size=None):
+                chunk = parse_sse_line(line)
+                if chunk is DONE:
+                    break
+                if chunk is not None and (event := relay.feed(chunk)):
+                    yield event
+            final = relay.finish(**extra)
+            m = relay.result
+            logger.info(f"{label} stream: ttft {m['ttft_ms']}ms, {m['tokens']} tokens, {m['tokens_per_s']} tok/s")
+            if on_done is not None:
+                on_done(relay.text)
+            yield final
+        except Exception as e:
+            logger.error(f"{label} stream error: {str(e)}")
+            yield relay.error(str(e))
+        finally:
+            response.close()
+
+    mimetype = SSE_MIMETYPE if fmt == 'sse' else NDJSON_MIMETYPE
+    resp = Response(generate(), mimetype=mimetype, headers=STREAM_HEADERS)
+    # Also when the client goes away before generate() runs; frees the upstream slot
+    resp.call_on_close(response.close)
+    return resp
+
+@app.route('/ai/conversations/stats', methods=['GET'])
+def ai_conversations_stats():
+    return jsonify(conversations.stats())
+
+@app.route('/ai/conversations/<conversation_id>', methods=['GET'])
+def ai_conversation_history(conversation_id):
+    return jsonify({'conversation_id': conversation_id, 'messages': conversations.history(conversation_id)})
+
+@app.route('/ai/conversations/<conversation_id>', methods=['DELETE'])
+def ai_conversation_reset(conversation_id):
+    conversations.reset(conversation_id)
+    return jsonify({'conversation_id': conversation_id, 'reset': True})
+
+@app.route('/ai/stream/stats', methods=['GET'])
+def ai_stream_stats():
+    return jsonify({'ai': ai_stream_metrics.stats(), 'gemini': gemini_stream_metrics.stats()})
 
 # --- AI Chat Endpoint ---
+# History is kept here, keyed by conversation_id (or thread_id + sender_id), so
+# callers only send the new prompt. Idle conversations expire after CONVO_TTL.
+conversations = ConversationStore(
+    maxsize=int(os.getenv('CONVO_CACHE_SIZE', 5000)),
+    idle_ttl=int(os.getenv('CONVO_TTL', 1800)),
+    db_path=os.getenv('CONVO_DB', os.path.join(os.getcwd(), 'cache', 'conversations.sqlite')),
+    max_tokens=int(os.getenv('CONVO_MAX_TOKENS', 3000)),
+    system_prompt=os.getenv('CONVO_SYSTEM_PROMPT'),
+)
+
+def ai_payload(messages, conversation_id):
+    return {
+        'model': 'grok',
+        'messages': messages,
+        'conversation_id': conversation_id
+    }
+
+def ai_conversation(data, prompt):
+    """Resolve the conversation for an /ai request; returns (id, messages)."""
+    conversation_id = conversation_key(data.get('conversation_id'), data.get('thread_id'), data.get('sender_id'))
+    if data.get('reset'):
+        conversations.reset(conversation_id)
+    return conversation_id, conversations.messages_for(conversation_id, prompt)
+
 @app.route('/ai', methods=['POST'])
 def ai():
     data = request.get_json() or {}
     prompt = data.get('prompt')
-    conversation_id = data.get('conversation_id', None)
     if not prompt:
         logger.error("Missing prompt in /ai")
         return jsonify({'error': 'missing prompt'}), 400
@@ -401,26 +1149,33 @@ def ai():
             logger.error("AI API key not set")
             return jsonify({'error': 'AI API key not configured'}), 500
 
-        api_url = "https://api.x.ai/v1/chat/completions"
         headers = {'Authorization': f'Bearer {api_key}'}
-        payload = {
-            'model': 'grok',
-            'messages': [{'role': 'user', 'content': prompt}],
-            'conversation_id': conversation_id
-        }
-        response = requests.post(api_url, headers=headers, json=payload, timeout=30)
+        conversation_id, messages = ai_conversation(data, prompt)
+        fmt = stream_format(data, request.accept_mimetypes)
+        if fmt:
+            payload = dict(ai_payload(messages, conversation_id), stream=True, stream_options={'include_usage': True})
+            return relay_stream(xai_api, XAI_API_URL, headers, payload, fmt, xai_delta, ai_stream_metrics, 'AI',
+                                on_done=lambda text: conversations.append(conversation_id, prompt, text),
+                                conversation_id=conversation_id)
+
+        response = xai_api.post(XAI_API_URL, headers=headers, json=ai_payload(messages, conversation_id))
         response.raise_for_status()
         result = response.json()
         response_text = result.get('choices')[0].get('message').get('content')
-        new_conversation_id = result.get('conversation_id', conversation_id)
+        conversations.append(conversation_id, prompt, response_text)
 
-        logger.info(f"AI response generated for prompt: {prompt[:50]}...")
-        return jsonify({'response': response_text, 'conversation_id': new_conversation_id})
+        logger.info(f"AI response generated for prompt: {prompt[:50]}... ({len(messages)} messages sent)")
+        return jsonify({'response': response_text, 'conversation_id': conversation_id})
+    except UpstreamUnavailable as e:
+        return upstream_unavailable(e)
     except Exception as e:
         logger.error(f"AI error: {str(e)} with traceback: {traceback.format_exc()}")
         return jsonify({'error': str(e)}), 500
 
 # --- Gemini-Specific Endpoint ---
+def gemini_payload(prompt):
+    return {'contents': [{'parts': [{'text': prompt}]}]}
+
 @app.route('/gemini', methods=['POST'])
 def gemini():
     data = request.get_json() or {}
@@ -434,24 +1189,101 @@ def gemini():
             logger.error("Gemini API key not set")
             return jsonify({'error': 'Gemini API key not configured'}), 500
 
-        api_url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent"
-        response = requests.post(
-            api_url,
-            headers={'Authorization': f'Bearer {api_key}'},
-            json={'contents': [{'parts': [{'text': prompt}]}]},
-            timeout=30
-        )
+        headers = {'Authorization': f'Bearer {api_key}'}
+        fmt = stream_format(data, request.accept_mimetypes)
+        if fmt:
+            return relay_stream(gemini_api, GEMINI_STREAM_URL, headers, gemini_payload(prompt), fmt,
+                                gemini_delta, gemini_stream_metrics, 'Gemini')
+
+        response = gemini_api.post(GEMINI_API_URL, headers=headers, json=gemini_payload(prompt))
         response.raise_for_status()
         result = response.json()
         response_text = result.get('candidates')[0].get('content').get('parts')[0].get('text')
 
         logger.info(f"Gemini response generated for prompt: {prompt[:50]}...")
         return jsonify({'response': response_text})
+    except UpstreamUnavailable as e:
+        return upstream_unavailable(e)
     except Exception as e:
         logger.error(f"Gemini error: {str(e)} with traceback: {traceback.format_exc()}")
         return jsonify({'error': str(e)}), 500
 
 # --- NSFW Image Filtering Endpoint ---
+# Verdicts are cached by perceptual hash, so the same meme or sticker re-uploaded
+# elsewhere (re-encoded, resized) is answered without an upstream call.
+# Uploads are hashed straight from memory; nothing touches the disk.
+nsfi_cache = TTLCache(
+    'nsfi',
+    maxsize=int(os.getenv('NSFI_CACHE_SIZE', 50000)),
+    ttl=int(os.getenv('NSFI_CACHE_TTL', 7 * 24 * 3600)),
+    db_path=os.getenv('NSFI_CACHE_DB', os.path.join(os.getcwd(), 'cache', 'nsfi.sqlite')),
+)
+# Hashes within NSFI_HASH_DISTANCE bits (of 128) count as the same image
+nsfi_index = HashIndex(max_distance=int(os.getenv('NSFI_HASH_DISTANCE', 4)), maxsize=nsfi_cache.maxsize)
+nsfi_flight = SingleFlight('nsfi')
+nsfi_pool = ThreadPoolExecutor(max_workers=int(os.getenv('NSFI_BATCH_WORKERS', 4)), thread_name_prefix='nsfi')
+NSFI_BATCH_MAX = int(os.getenv('NSFI_BATCH_MAX', 32))
+
+def image_key(data):
+    """Cache key for an upload: its perceptual hash, snapped to a near-identical
+    hash seen before, or a SHA-256 of the bytes if Pillow can't decode it."""
+    try:
+        value = dhash(data)
+    except Exception:
+        return f"sha256:{hashlib.sha256(data).hexdigest()}"
+    match = nsfi_index.nearest(value)
+    return f"dhash:{(value if match is None else match):032x}"
+
+def cached_verdict(key):
+    found, verdict = nsfi_cache.get(key)
+    if found and key.startswith('dhash:'):
+        nsfi_index.add(int(key[6:], 16))  # e.g. loaded from disk after a restart
+    return found, verdict
+
+def remember_verdict(key, verdict):
+    nsfi_cache.set(key, verdict)
+    if key.startswith('dhash:'):
+        nsfi_index.add(int(key[6:], 16))
+
+# Uploads over NSFI_UPLOAD_KB are shrunk to a JPEG before they go upstream:
+# the classifier doesn't need full resolution, and verdicts are keyed on the
+# original's hash anyway.
+NSFI_UPLOAD_BYTES = int(os.getenv('NSFI_UPLOAD_KB', 1024)) * 1024
+NSFI_UPLOAD_OPTIONS = dict(media.defaults, format='jpeg', max_side=int(os.getenv('NSFI_MAX_SIDE', 1024)),
+                           max_bytes=NSFI_UPLOAD_BYTES)
+
+def nsfw_upload(data, filename, mimetype):
+    """The ``files`` tuple to send upstream for an upload."""
+    filename, mimetype = filename or 'image.png', mimetype or 'application/octet-stream'
+    if len(data) <= NSFI_UPLOAD_BYTES:
+        return filename, data, mimetype
+    try:
+        small, info = media.process(data, NSFI_UPLOAD_OPTIONS, 'nsfi')
+    except Exception as e:
+        logger.warning(f"NSFI upload sent as is, could not shrink it: {str(e)}")
+        return filename, data, mimetype
+    return with_ext(filename, info), small, info['mimetype']
+
+def _check_nsfw(key, data, filename, mimetype, api_key):
+    response = nsfw_api.post(
+        NSFW_API_URL,
+        headers={'Authorization': f'Bearer {api_key}'},
+        files={'image': nsfw_upload(data, filename, mimetype)}
+    )
+    response.raise_for_status()
+    verdict = {'is_safe': response.json().get('is_safe', True)}
+    remember_verdict(key, verdict)
+    return verdict
+
+def nsfw_verdict(data, filename, mimetype, api_key):
+    """Return ``(verdict, cached, key)`` for one uploaded image."""
+    key = image_key(data)
+    found, verdict = cached_verdict(key)
+    if found:
+        return verdict, True, key
+    verdict, shared = nsfi_flight.do(key, lambda: _check_nsfw(key, data, filename, mimetype, api_key))
+    return verdict, shared, key
+
 @app.route('/nsfi', methods=['POST'])
 def nsfi():
     if 'image' not in request.files:
@@ -459,56 +1291,252 @@ def nsfi():
         return jsonify({'error': 'missing image'}), 400
     image_file = request.files['image']
     try:
-        unique_id = str(uuid.uuid4()).replace('-', '')
-        output_file = os.path.join(TEMP_DIR, f"nsfi_{unique_id}.png")
-
-        with file_lock:
-            image_file.save(output_file)
-
         api_key = os.getenv('NSFW_API_KEY')
         if not api_key:
             logger.error("NSFW API key not set")
             return jsonify({'error': 'NSFW API key not configured'}), 500
 
-        with open(output_file, 'rb') as f:
-            response = requests.post(
-                "https://api.example.com/nsfw/detect",
-                headers={'Authorization': f'Bearer {api_key}'},
-                files={'image': f},
-                timeout=30
-            )
-            response.raise_for_status()
-            result = response.json()
-            is_safe = result.get('is_safe', True)
-
-        logger.info(f"NSFI check for {output_file}: {'Safe' if is_safe else 'NSFW'}")
+        verdict, cached, key = nsfw_verdict(image_file.read(), image_file.filename, image_file.mimetype, api_key)
+        is_safe = verdict['is_safe']
+        logger.info(f"NSFI check for {key}: {'Safe' if is_safe else 'NSFW'}{' (cached)' if cached else ''}")
         return jsonify({'is_safe': is_safe})
+    except UpstreamUnavailable as e:
+        return upstream_unavailable(e)
     except Exception as e:
         logger.error(f"NSFI error: {str(e)} with traceback: {traceback.format_exc()}")
         return jsonify({'error': str(e)}), 500
-    finally:
-        cleanup_file(output_file if 'output_file' in locals() else None)
 
-# --- Cleanup Old Files ---
-def cleanup_temp_directory():
-    """Periodically clean up old files in temp directory."""
-    try:
-        for filename in os.listdir(TEMP_DIR):
-            filepath = os.path.join(TEMP_DIR, filename)
-            if os.path.isfile(filepath) and time.time() - os.path.getmtime(filepath) > 3600:
-                cleanup_file(filepath)
-    except Exception as e:
-        logger.error(f"Temp directory cleanup error: {str(e)}")
-
-# Schedule periodic cleanup
-from threading import Thread
-def run_cleanup():
-    while True:
-        cleanup_temp_directory()
-        time.sleep(3600)
-
-cleanup_thread = Thread(target=run_cleanup, daemon=True)
-cleanup_thread.start()
-
-if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
+@app.route('/nsfi/batch', methods=['POST'])
+def nsfi_batch():
+    """Check many images at once (multipart field ``images``, repeated).
+    Cache hits are answered locally; only misses go upstream, in parallel."""
+    uploads = request.files.getlist('images') + request.files.getlist('image')
+    if not uploads:
+        return jsonify({'error': 'missing images'}), 400
+    if len(uploads) > NSFI_BATCH_MAX:
+        return jsonify({'error': f'too many images (max {NSFI_BATCH_MAX})'}), 400
+    api_key = os.getenv('NSFW_API_KEY')
+    if not api_key:
+        logger.error("NSFW API key not set")
+        return jsonify({'error': 'NSFW API key not configured'}), 500
+
+    futures = [
+        nsfi_pool.submit(nsfw_verdict, f.read(), f.filename, f.mimetype, api_key)
+        for f in uploads
+    ]
+    results = []
+    hits = 0
+    for index, (upload, future) in enumerate(zip(uploads, futures)):
+        item = {'index': index, 'filename': upload.filename}
+        try:
+            verdict, cached, _ = future.result()
+            item.update(is_safe=verdict['is_safe'], cached=cached)
+            hits += cached
+        except UpstreamUnavailable as e:
+            item.update(error=str(e), status=503)
+        except Exception as e:
+            logger.error(f"NSFI batch item {index} failed: {str(e)}")
+            item.update(error=str(e), status=500)
+        results.append(item)
+
+    logger.info(f"NSFI batch: {len(uploads)} images, {hits} cached")
+    return jsonify({'results': results, 'cached': hits, 'checked': len(uploads) - hits})
+
+@app.route('/nsfi/stats', methods=['GET'])
+def nsfi_stats():
+    return jsonify({'cache': nsfi_cache.stats(), 'index_size': len(nsfi_index), 'inflight': nsfi_flight.stats()})
+
+# --- Stored media by id ---
+# Every response served from a store names the file in Content-Location.
+# GET it with Range (and If-Range) to resume an interrupted transfer, or with
+# If-None-Match / If-Modified-Since to get a 304 for a copy already held.
+media_stores = {store.name: store for store in (media_store, image_results.store, tts_store)}
+
+def live_download_for(media_id):
+    with live_downloads_lock:
+        for key, live in live_downloads.items():
+            if content_key(*key) == media_id:
+                return live
+    return None
+
+@app.route('/media/<store_name>/<media_id>', methods=['GET'])
+def media_file(store_name, media_id):
+    """A stored file by id. ``?wait=N`` (up to 60s) waits for a streamed
+    download of it that is still running."""
+    store = media_stores.get(store_name)
+    if store is None or not re.fullmatch(r'[0-9a-f]{64}', media_id):
+        return jsonify({'error': 'unknown media'}), 404
+    wait = wait_arg()
+    if wait is None:
+        return jsonify({'error': 'wait must be a number of seconds'}), 400
+    entry = store.acquire_id(media_id)
+    if entry is None and store is media_store and (live := live_download_for(media_id)) is not None:
+        deadline = time.monotonic() + wait
+        with live.cond:
+            while not live.settled and (remaining := deadline - time.monotonic()) > 0:
+                live.cond.wait(remaining)
+        if not live.settled:
+            resp = jsonify({'error': 'still downloading', 'bytes': live.size})
+            resp.status_code = 202
+            resp.headers['Retry-After'] = '2'
+            return resp
+        entry = store.acquire_id(media_id)
+    if entry is None:
+        return jsonify({'error': 'not cached, or evicted'}), 404
+    mimetype = mimetypes.guess_type(f"x.{entry['ext']}")[0] or 'application/octet-stream'
+    return serve_entry(store, entry, mimetype, f"{store.name}_{media_id[:12]}.{entry['ext']}")
+
+# --- Background Jobs ---
+# POST /jobs/<name> queues the same request body for the matching endpoint and
+# returns a job id at once; clients poll GET /jobs/<id>?wait=N and fetch
+# GET /jobs/<id>/result. Full queues answer 429 with an ETA. Job state is
+# shared through JOBS_DB, so with several workers any of them can answer.
+jobs = JobScheduler(TEMP_DIR, cleanup=cleanup_file, temp=temp_store,
+                    db_path=os.getenv('JOBS_DB', os.path.join(os.getcwd(), 'cache', 'jobs.sqlite')))
+jobs.add_queue('yt_download', concurrency=4, max_queued=32)
+jobs.add_queue('flux', concurrency=2, max_queued=16)
+jobs.add_queue('genimage', concurrency=2, max_queued=16)
+jobs.add_queue('tts', concurrency=4, max_queued=64)
+register_job_routes(app, jobs, {
+    'yt_download': ('/yt/download', yt_download),
+    'flux': ('/flux', flux_generate),
+    'genimage': ('/genimage', gen_image),
+    'tts': ('/tts', tts),
+})
+
+# --- Metrics ---
+# GET /metrics (Prometheus text format): requests, status codes and latency per
+# route, per-stage timers (upstream HTTP, yt-dlp, file writes, size checks,
+# stream-out), cache hit ratios, temp-dir usage and in-flight work.
+instrument(app)
+
+@REGISTRY.collector
+def service_metrics():
+    caches = [search_cache, nsfi_cache, media_store, tts_store, image_results.store]
+    yield from cache_families([c.stats() for c in caches] + [conversations.stats()['cache']])
+    temp_files, temp_bytes = map(sum, zip(dir_usage(TEMP_DIR), dir_usage(YT_DOWNLOAD_DIR)))
+    yield 'temp_dir_bytes', 'gauge', 'Bytes in the temp directory', [({}, temp_bytes)]
+    yield 'temp_dir_files', 'gauge', 'Files in the temp directory', [({}, temp_files)]
+    yield from temp_families(temp_store.stats())
+    yield from search_warmer.families()
+    flights = [search_flight, download_flight, tts_flight, nsfi_flight]
+    yield 'singleflight_in_flight', 'gauge', 'Distinct keys being computed', [
+        ({'name': f.name}, len(f.stats()['in_flight'])) for f in flights
+    ]
+    with live_downloads_lock:
+        live = len(live_downloads)
+    engine = yt_engine.stats()
+    yield 'yt_live_downloads', 'gauge', 'Streaming downloads in progress', [({}, live)]
+    yield 'yt_engine_jobs', 'gauge', 'yt-dlp jobs by state', [
+        ({'state': 'running'}, engine['running']), ({'state': 'queued'}, engine['queued'])
+    ]
+    yield 'tts_segments_pending', 'gauge', 'TTS segments waiting for a worker', [({}, tts_engine.stats()['pending'])]
+    yield 'background_jobs', 'gauge', 'Background jobs by queue and state', [
+        ({'queue': name, 'state': state}, q[state]) for name, q in jobs.stats().items() for state in ('running', 'queued')
+    ]
+    yield 'reaper_queue_depth', 'gauge', 'Files waiting to be deleted', [({}, reaper.stats()['queue_depth'])]
+    upstreams = [replicate_api, replicate_cdn, stability_api, xai_api, gemini_api, nsfw_api]
+    yield 'upstream_circuit_open', 'gauge', '1 while an upstream circuit breaker is open or half-open', [
+        ({'upstream': u.name}, u.breaker.state != 'closed') for u in upstreams
+    ]
+    yield from upstream_limit_families(upstreams)
+
+# --- Admission control ---
+# Token buckets per caller (X-Caller-Id, else the client address) and route,
+# as (requests per minute, burst); RATE_LIMIT_<ROUTE>_PER_MIN / _BURST
+# override them. Upstream concurrency caps and shedding live in Upstream.
+admission = Admission({
+    '/flux': (6, 3),
+    '/genimage': (6, 3),
+    '/yt/download': (10, 5),
+    '/yt/search': (60, 20),
+    '/yt/search/batch': (10, 5),
+    '/tts': (20, 10),
+    '/ai': (30, 10),
+    '/gemini': (30, 10),
+    '/nsfi': (60, 20),
+    '/nsfi/batch': (10, 5),
+    '/jobs/<name>': (20, 10),
+})
+admission.install(app)
+
+# --- Health ---
+# GET /health/live: the process answers. GET /health/ready: startup is done and
+# the critical checks pass (503 otherwise, so the instance leaves rotation);
+# upstream trouble only shows up under 'warnings', since it hits every
+# instance alike. PREWARM=0 skips importing yt-dlp, Pillow and gTTS ahead of
+# the first request.
+def _prewarm_imports():
+    preload('yt_dlp', 'PIL.Image', 'gtts', 'gtts.lang')
+    tts_engine.languages
+
+def _check_temp():
+    temp = temp_store.usage()
+    writable = os.access(TEMP_DIR, os.W_OK)
+    return writable and temp['bytes'] < temp['quota_bytes'], dict(temp, writable=writable)
+
+def _check_yt_dlp():
+    backend = yt_engine.backend
+    if backend == 'inprocess':
+        ok = 'yt_dlp' in sys.modules or importlib.util.find_spec('yt_dlp') is not None
+    else:
+        ok = shutil.which('yt-dlp') is not None
+    # Streaming downloads always run the CLI
+    return ok, {'backend': backend, 'imported': 'yt_dlp' in sys.modules,
+                'cli': shutil.which('yt-dlp') is not None}
+
+def _check_cookies():
+    return ydl_opts['cookiefile'] is not None, {'cookiefile': ydl_opts['cookiefile']}
+
+def _check_upstreams():
+    upstreams = {u.name: u.stats() for u in (replicate_api, replicate_cdn, stability_api, xai_api, gemini_api, nsfw_api)}
+    down = sorted(name for name, u in upstreams.items() if u['circuit'] != 'closed')
+    return not down, {'open_circuits': down}
+
+def _check_pools():
+    engine = yt_engine.stats()
+    full = sorted(name for name, q in jobs.stats().items() if q['queued'] >= q['max_queued'])
+    # A download backlog deeper than a round of workers means new requests mostly wait
+    backlog = engine['queued'] > engine['workers']
+    return not full and not backlog, {'yt_engine_queued': engine['queued'], 'yt_engine_workers': engine['workers'],
+                                      'full_job_queues': full}
+
+startup.prewarm('imports', _prewarm_imports)
+startup.prewarm('media_pool', media.warm)
+startup.check('temp', _check_temp)
+startup.check('yt_dlp', _check_yt_dlp)
+startup.check('cookies', _check_cookies, critical=False)
+startup.check('upstreams', _check_upstreams, critical=False)
+startup.check('pools', _check_pools)
+startup.install(app)
+
+@REGISTRY.collector
+def startup_metrics():
+    return startup.families()
+
+@app.route('/health', methods=['GET'])
+def health():
+    ready, checks = startup.readiness()
+    temp = temp_store.usage()
+    return jsonify({
+        'status': 'healthy' if ready else 'degraded',
+        'temp': temp,
+        'checks': checks,
+        'startup': startup.report(),
+    })
+
+# --- Temp storage ---
+
+@app.route('/temp/stats', methods=['GET'])
+def temp_stats():
+    return jsonify(temp_store.stats())
+
+@app.route('/upstreams/stats', methods=['GET'])
+def upstreams_stats():
+    return jsonify({u.name: u.stats() for u in (replicate_api, replicate_cdn, stability_api, xai_api, gemini_api, nsfw_api)})
+
+@app.route('/cleanup/stats', methods=['GET'])
+def cleanup_stats():
+    return jsonify(reaper.stats())
+
+startup.finish(prewarm=os.getenv('PREWARM', '1') == '1')
\ No newline at end of file
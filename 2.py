@@ -1,29 +1,253 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 import requests
 import base64
 import os
 import time
+import re
 import hashlib
+import mimetypes
+from http_client import Upstream, UpstreamUnavailable
+from jobs import JobScheduler, register_job_routes, submit_replay
+from media_store import MediaStore, content_key
+from conditional import file_response
+from result_cache import ResultCache, cache_request
+from metrics import REGISTRY, cache_families, dir_usage, instrument, temp_families, timed_stream, upstream_limit_families
+from admission import Admission
+from temp_store import TempStore, TempQuotaExceeded
+from media_pipeline import MediaPipeline, media_headers
+from startup import Startup
 
+# `python 2.py`: serve from the module proper ('2') and leave a bare __main__
+# behind. Media workers re-import __main__ and must not build a second
+# service of their own.
+if __name__ == '__main__':
+    import sys
+    import types
+    import importlib
+    sys.modules['__main__'] = types.ModuleType('__main__')
+    service = importlib.import_module('2')
+    port = int(os.environ.get('PORT', 5001))  # Changed to 5001
+    print("=" * 60)
+    print("AI Engine Lite - Fast Image Generation")
+    print("=" * 60)
+    print(f"Port: {port}")
+    print("Image: Pollinations AI (Fast, Unique)")
+    print("Cinematic: Enhanced wide-format images")
+    print("=" * 60)
+    service.app.run(host='0.0.0.0', port=port, debug=False)
+    sys.exit()
 
 app = Flask(__name__)
+startup = Startup('lite', wait_for_prewarm=os.environ.get('READY_AFTER_PREWARM', '0') == '1')
+
+# Pooled keep-alive client with retries and a circuit breaker
+pollinations = Upstream('pollinations', timeout=120)
+POLLINATIONS_URL = os.environ.get('POLLINATIONS_URL', 'https://image.pollinations.ai')
+STREAM_CHUNK = 64 * 1024
+# Our own subdirectory of temp/, split per process (SPOOL_DIR/<pid>, each
+# with its own SPOOL_QUOTA_MB): orphans and the directories of workers that
+# are gone are deleted in the background once startup is done
+spool = TempStore('spool', os.environ.get('SPOOL_DIR', os.path.join(os.getcwd(), 'temp', 'lite')),
+                  int(float(os.environ.get('SPOOL_QUOTA_MB', 512)) * 1024 * 1024), reconcile=False, per_process=True)
+SPOOL_DIR = spool.root
+startup.prewarm('spool_reconcile', spool.reconcile, optional=False)
+
+# Deterministic requests ("seed", "deterministic": true or a "cache" policy)
+# are cached by (mode, prompt, size, seed); see result_cache.POLICIES.
+results = ResultCache(
+    MediaStore(
+        'images',
+        os.environ.get('IMAGE_CACHE_DIR', os.path.join(os.getcwd(), 'cache', 'generate')),
+        int(float(os.environ.get('IMAGE_CACHE_MB', 512)) * 1024 * 1024),
+    ),
+    costs={'generate': float(os.environ.get('POLLINATIONS_COST_USD', 0))},
+)
+PREFETCH_PRIORITY = int(os.environ.get('PREFETCH_PRIORITY', 9))
+
+# Images are fit to Messenger's attachment limit (MEDIA_MAX_MB) on the way
+# out and recompressed, downscaled or thumbnailed on request ("image_format",
+# "max_side", "max_kb", "quality", "thumbnail"; thumbnails in JSON only).
+# The cache keeps the originals.
+media = MediaPipeline(workers=int(os.environ.get('MEDIA_WORKERS', 2)), timeout=int(os.environ.get('MEDIA_TIMEOUT', 30)))
+startup.prewarm('media_pool', media.warm)
+
+def wants_binary(data, accept):
+    """Binary is opt-in: {"format": "binary"} or an Accept header preferring image/*."""
+    if data.get('format') in ('binary', 'json'):
+        return data['format'] == 'binary'
+    best = accept.best_match(['application/json', 'image/png', 'image/jpeg', 'image/webp'])
+    return bool(best) and best.startswith('image/')
+
+def image_ext(content_type):
+    mimetype = (content_type or 'image/jpeg').split(';')[0].strip()
+    return (mimetypes.guess_extension(mimetype) or '.jpg').lstrip('.')
+
+def stream_image(url, mode, seed, label, cached=None):
+    """Relay upstream bytes in chunks; metadata goes in X- headers.
+    With ``cached`` (a cache_request result) the bytes are also teed to a
+    file that goes into the result cache once the image is complete."""
+    started = time.time()
+    response = pollinations.get(url, stream=True)
+    if response.status_code != 200:
+        response.close()
+        return jsonify({'error': f'{label} failed'}), 500
+    content_type = response.headers.get('Content-Type', 'image/jpeg')
+    tee_path = None
+    if cached is not None and cached[2] != 'bypass':
+        try:
+            tee_path = spool.path('generate', '.part', request.path)
+        except TempQuotaExceeded as e:
+            print(f"⚠️ Not caching, {e}")
+
+    def relay():
+        out = open(tee_path, 'wb') if tee_path else None
+        complete = False
+        try:
+            for chunk in response.iter_content(STREAM_CHUNK):
+                if out is not None:
+                    out.write(chunk)
+                yield chunk
+            complete = True
+        finally:
+            response.close()
+            if out is not None:
+                out.close()
+                if complete:
+                    spool.forget(tee_path)
+                    results.release(results.save(cached[0], image_ext(content_type), time.time() - started, path=tee_path))
+                else:
+                    spool.discard(tee_path)
+
+    headers = {'X-Mode': mode, 'X-Seed': str(seed)}
+    if cached is not None:
+        headers['X-Cache'] = 'MISS' if cached[2] == 'reuse' else cached[2].upper()
+    if tee_path:
+        headers['Content-Location'] = media_url(content_key(*cached[0]))
+    if response.headers.get('Content-Length') and not response.headers.get('Content-Encoding'):
+        headers['Content-Length'] = response.headers['Content-Length']
+    print(f"✅ {label} streaming")
+    resp = Response(timed_stream(relay(), 'generate'), mimetype=content_type, headers=headers)
+
+    @resp.call_on_close
+    def _discard_unsent():
+        # The client went away before relay() ran: free the upstream slot too
+        response.close()
+        if tee_path and spool.exists(tee_path):
+            spool.discard(tee_path)
+
+    return resp
+
+def image_reply(content, content_type, mode, seed, binary, options, headers=None):
+    """Fit ``content`` to ``options`` and answer as bytes or JSON."""
+    content, info = media.process(content, options, 'generate')
+    headers = dict(headers or {}, **media_headers(info))
+    if binary:
+        headers.update({'X-Mode': mode, 'X-Seed': str(seed)})
+        return Response(content, mimetype=info['mimetype'] if info else content_type, headers=headers)
+    body = {'image': base64.b64encode(content).decode('utf-8'), 'mode': mode, 'seed': seed}
+    if info is not None:
+        body['format'] = info['format']
+        if info['thumbnail']:
+            body['thumbnail'] = base64.b64encode(info['thumbnail']).decode('utf-8')
+    return jsonify(body), 200, headers
+
+def cached_image(entry, mode, seed, binary, options):
+    """Serve a cache hit in the requested format; the entry is released afterwards."""
+    headers = {'X-Mode': mode, 'X-Seed': str(seed), 'X-Cache': 'HIT'}
+    mimetype = mimetypes.guess_type(f"x.{entry['ext']}")[0] or 'image/jpeg'
+    if not binary or media.needed(options, entry['size']):
+        try:
+            with open(entry['path'], 'rb') as f:
+                content = f.read()
+        finally:
+            results.release(entry)
+        return image_reply(content, mimetype, mode, seed, binary, options, headers)
+
+    return serve_entry(entry, mimetype, headers)
+
+def media_url(media_id):
+    """Stable URL of a cached image (GET /media/images/<id>)."""
+    return f"/media/{results.store.name}/{media_id}"
+
+def serve_entry(entry, mimetype, headers=None):
+    """Stream a pinned cache entry, released when the response closes. Its
+    Content-Location serves the same bytes with Range and If-None-Match
+    support until the entry is evicted."""
+    headers = dict(headers or {}, **{'Content-Location': media_url(entry['key'])})
+    try:
+        return file_response(entry['path'], mimetype, entry['key'][:32], 'generate_cache', headers,
+                             on_close=lambda: results.release(entry))
+    except OSError:
+        results.release(entry)
+        raise
+
+@app.route('/media/<store_name>/<media_id>', methods=['GET'])
+def media_file(store_name, media_id):
+    """A cached image by id: Range / If-Range resume a transfer,
+    If-None-Match / If-Modified-Since get a 304."""
+    if store_name != results.store.name or not re.fullmatch(r'[0-9a-f]{64}', media_id):
+        return jsonify({'error': 'unknown media'}), 404
+    entry = results.store.acquire_id(media_id)
+    if entry is None:
+        return jsonify({'error': 'not cached, or evicted'}), 404
+    return serve_entry(entry, mimetypes.guess_type(f"x.{entry['ext']}")[0] or 'image/jpeg')
 
 @app.route('/health', methods=['GET'])
 def health():
+    ready, checks = startup.readiness()
+    # Both modes are Pollinations calls: usable while its circuit is closed
+    available = pollinations.breaker.state == 'closed'
     return jsonify({
-        'status': 'healthy', 
+        'status': 'healthy' if ready and available else 'degraded',
         'device': 'API',
         'models_loaded': {
-            'image': True, 
-            'cinematic': True
-        }
+            'image': available,
+            'cinematic': available
+        },
+        'temp': spool.usage(),
+        'checks': checks,
+        'startup': startup.report(),
     })
 
+@app.route('/upstreams/stats', methods=['GET'])
+def upstreams_stats():
+    return jsonify({pollinations.name: pollinations.stats()})
+
+@app.route('/images/cache/stats', methods=['GET'])
+def image_cache_stats():
+    return jsonify(results.stats())
+
+@app.route('/media/stats', methods=['GET'])
+def media_stats():
+    return jsonify(media.stats())
+
+# mode -> (label, width, height, prompt suffix)
+MODES = {
+    'img': ('Image', 1024, 1024, ''),
+    'cinematic': ('Cinematic', 1920, 1080, ', cinematic composition, dramatic lighting, epic scene, wide angle shot, 8k resolution, professional photography, motion blur, film grain, depth of field'),
+}
+
+def generation_request(mode, prompt, seed=None):
+    """Return (pollinations url, seed) for a mode, or None if the mode is unknown."""
+    if mode not in MODES:
+        return None
+    _, width, height, suffix = MODES[mode]
+    if seed is not None:
+        unique_seed = seed
+    else:
+        # Unique seed per call so repeated prompts give new images
+        timestamp = str(time.time())
+        unique_seed = int(hashlib.md5(f"{prompt}{timestamp}".encode()).hexdigest()[:8], 16)
+    full_prompt = f"{prompt}{suffix}"
+    url = f"{POLLINATIONS_URL}/prompt/{requests.utils.quote(full_prompt)}?seed={unique_seed}&width={width}&height={height}&nologo=true&enhance=true"
+    return url, unique_seed
+
 @app.route('/generate', methods=['POST'])
 def generate():
     try:
         data = request.get_json()
         mode = data.get('mode', 'img')
+        binary = wants_binary(data, request.accept_mimetypes)
         prompt = data.get('prompt', '')
         
         if not prompt:
@@ -31,58 +255,110 @@ def generate():
         
         print(f"Request - Mode: {mode}, Prompt: {prompt}")
         
-        if mode == 'img':
-            # Standard image generation with unique seed
-            timestamp = str(time.time())
-            unique_seed = int(hashlib.md5(f"{prompt}{timestamp}".encode()).hexdigest()[:8], 16)
-            
-            url = f"https://image.pollinations.ai/prompt/{requests.utils.quote(prompt)}?seed={unique_seed}&width=1024&height=1024&nologo=true&enhance=true"
-            
-            print(f"Generating image (seed: {unique_seed})...")
-            response = requests.get(url, timeout=120)
-            
-            if response.status_code == 200:
-                img_b64 = base64.b64encode(response.content).decode('utf-8')
-                print("✅ Image generated")
-                return jsonify({'image': img_b64, 'mode': 'img'})
-            else:
-                return jsonify({'error': 'Image generation failed'}), 500
+        if mode not in MODES:
+            return jsonify({'error': f'Invalid mode: {mode}'}), 400
+        label, width, height, _ = MODES[mode]
+        try:
+            cached = cache_request(data, 'generate', mode, prompt, width, height)
+            options = media.options(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if cached:
+            key, seed, policy = cached
+            if policy == 'prefetch':
+                resp = submit_replay(app, jobs, 'generate', '/generate', generate, dict(data, cache='reuse'), PREFETCH_PRIORITY)
+                resp.headers['X-Seed'] = str(seed)
+                return resp
+            entry = results.lookup(key, policy)
+            if entry:
+                print(f"✅ {label} image from cache (seed: {seed})")
+                return cached_image(entry, mode, seed, binary, options)
+
+        url, unique_seed = generation_request(mode, prompt, cached and cached[1])
         
-        elif mode == 'cinematic':
-            # Cinematic wide-format image generation
-            timestamp = str(time.time())
-            unique_seed = int(hashlib.md5(f"{prompt}{timestamp}".encode()).hexdigest()[:8], 16)
-            
-            # Enhance prompt with cinematic keywords
-            cinematic_prompt = f"{prompt}, cinematic composition, dramatic lighting, epic scene, wide angle shot, 8k resolution, professional photography, motion blur, film grain, depth of field"
-            
-            url = f"https://image.pollinations.ai/prompt/{requests.utils.quote(cinematic_prompt)}?seed={unique_seed}&width=1920&height=1080&nologo=true&enhance=true"
-            
-            print(f"Generating cinematic image (seed: {unique_seed})...")
-            response = requests.get(url, timeout=120)
-            
-            if response.status_code == 200:
-                img_b64 = base64.b64encode(response.content).decode('utf-8')
-                print("✅ Cinematic image generated")
-                return jsonify({'image': img_b64, 'mode': 'cinematic'})
-            else:
-                return jsonify({'error': 'Cinematic generation failed'}), 500
+        print(f"Generating {label.lower()} image (seed: {unique_seed})...")
+        # Bytes are relayed as they arrive unless they have to be re-encoded
+        if binary and not media.requested(options):
+            return stream_image(url, mode, unique_seed, f'{label} generation', cached)
+        started = time.time()
+        response = pollinations.get(url)
         
+        if response.status_code == 200:
+            content_type = response.headers.get('Content-Type', 'image/jpeg')
+            print(f"✅ {label} image generated")
+            if cached is None:
+                return image_reply(response.content, content_type, mode, unique_seed, binary, options)
+            if policy != 'bypass':
+                results.release(results.save(key, image_ext(content_type), time.time() - started, data=response.content))
+            headers = {'X-Seed': str(seed), 'X-Cache': 'MISS' if policy == 'reuse' else policy.upper()}
+            return image_reply(response.content, content_type, mode, seed, binary, options, headers)
         else:
-            return jsonify({'error': f'Invalid mode: {mode}'}), 400
+            return jsonify({'error': f'{label} generation failed'}), 500
     
+    except UpstreamUnavailable as e:
+        print(f"❌ Upstream unavailable: {e}")
+        return jsonify({'error': str(e)}), 503, {'Retry-After': str(int(e.retry_after) + 1)}
     except Exception as e:
         print(f"❌ Error: {e}")
         return jsonify({'error': str(e)}), 500
     
 
-if __name__ == '__main__':
-    port = int(os.environ.get('PORT', 5001))  # Changed to 5001
-    print("=" * 60)
-    print("AI Engine Lite - Fast Image Generation")
-    print("=" * 60)
-    print(f"Port: {port}")
-    print("Image: Pollinations AI (Fast, Unique)")
-    print("Cinematic: Enhanced wide-format images")
-    print("=" * 60)
-    app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
+# Background jobs: POST /jobs/generate, then poll GET /jobs/<id>?wait=N.
+# State is shared through JOBS_DB so any worker can answer the poll.
+jobs = JobScheduler(SPOOL_DIR, cleanup=spool.discard, temp=spool,
+                    db_path=os.environ.get('JOBS_DB', os.path.join(os.getcwd(), 'cache', 'jobs_lite.sqlite')))
+jobs.add_queue('generate', concurrency=4, max_queued=32)
+register_job_routes(app, jobs, {'generate': ('/generate', generate)})
+
+# Prometheus metrics at GET /metrics
+instrument(app)
+
+@REGISTRY.collector
+def service_metrics():
+    yield from cache_families([results.store.stats()])
+    temp_files, temp_bytes = dir_usage(SPOOL_DIR)
+    yield 'temp_dir_bytes', 'gauge', 'Bytes in the temp directory', [({}, temp_bytes)]
+    yield 'temp_dir_files', 'gauge', 'Files in the temp directory', [({}, temp_files)]
+    yield from temp_families(spool.stats())
+    yield 'background_jobs', 'gauge', 'Background jobs by queue and state', [
+        ({'queue': name, 'state': state}, q[state]) for name, q in jobs.stats().items() for state in ('running', 'queued')
+    ]
+    yield 'upstream_circuit_open', 'gauge', '1 while an upstream circuit breaker is open or half-open', [
+        ({'upstream': pollinations.name}, pollinations.breaker.state != 'closed')
+    ]
+    yield from upstream_limit_families([pollinations])
+
+# Per-caller token buckets (X-Caller-Id, else the client address) as
+# (requests per minute, burst); RATE_LIMIT_<ROUTE>_PER_MIN / _BURST override
+# them. Pollinations calls are capped and shed in Upstream.
+admission = Admission({
+    '/generate': (10, 4),
+    '/jobs/<name>': (10, 4),
+})
+admission.install(app)
+
+# GET /health/live and /health/ready (503 while the spool is full or
+# unwritable, or every generate job slot is taken); an open Pollinations
+# circuit is only a warning, it's down for every instance.
+def _check_spool():
+    temp = spool.usage()
+    writable = os.access(SPOOL_DIR, os.W_OK)
+    return writable and temp['bytes'] < temp['quota_bytes'], dict(temp, writable=writable)
+
+def _check_upstream():
+    return pollinations.breaker.state == 'closed', {'circuit': pollinations.breaker.state}
+
+def _check_jobs():
+    full = sorted(name for name, q in jobs.stats().items() if q['queued'] >= q['max_queued'])
+    return not full, {'full_job_queues': full}
+
+startup.check('spool', _check_spool)
+startup.check('pollinations', _check_upstream, critical=False)
+startup.check('jobs', _check_jobs)
+startup.install(app)
+
+@REGISTRY.collector
+def startup_metrics():
+    return startup.families()
+
+startup.finish()
@@ -0,0 +1,279 @@
+import os
+import math
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+
+from flask import jsonify, request
+
+from metrics import ADMISSION_REJECTED
+
+
+def rate_setting(name, key, default, cast=float):
+    return cast(os.getenv(f"RATE_LIMIT_{name.upper()}_{key}", os.getenv(f"RATE_LIMIT_{key}", default)))
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate  # tokens per second
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        """0 if a token was taken, else seconds until one is available."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimit:
+    """A token bucket per key (caller id): ``per_min`` sustained, ``burst`` at
+    once. Only the ``max_keys`` most recently seen keys are kept; a key that
+    falls out starts again with a full bucket. ``per_min`` <= 0 disables it."""
+
+    def __init__(self, name, per_min, burst, max_keys=10000):
+        self.name = name
+        self.per_min = per_min
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'allowed': 0, 'limited': 0}
+
+    def check(self, key):
+        """0 if ``key`` may proceed, else seconds until it may."""
+        if self.per_min <= 0:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.per_min / 60, self.burst, now)
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            wait = bucket.take(now)
+            self._stats['limited' if wait else 'allowed'] += 1
+        return wait
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, callers=len(self._buckets))
+        stats.update(per_min=self.per_min, burst=self.burst)
+        return stats
+
+
+class ConcurrencyLimit:
+    """At most ``limit`` holders at once; 0 means no limit.
+
+    Callers queue for a slot, but one whose expected wait (waiters ahead x
+    average hold time / limit) is over ``target_wait`` is turned away at
+    once, and one still queued after ``target_wait`` seconds gives up. Past
+    the target, load is shed instead of queued, so the wait stays bounded.
+    ``acquire`` returns 0 for a slot, else seconds worth waiting before a
+    retry, like ``CircuitBreaker.before_request``.
+    """
+
+    def __init__(self, name, limit, target_wait=5.0):
+        self.name = name
+        self.limit = limit
+        self.target_wait = target_wait
+        self.active = 0
+        self.waiting = 0
+        self.avg_hold = None  # EWMA, seconds
+        self.avg_wait = 0.0  # EWMA of time queued, seconds
+        self._cond = threading.Condition()
+        self._stats = {'admitted': 0, 'shed': 0, 'timed_out': 0}
+
+    def try_acquire(self):
+        with self._cond:
+            if self.limit and self.active >= self.limit:
+                return False
+            self._admit(0.0)
+            return True
+
+    def acquire(self):
+        with self._cond:
+            queued = self._enter()
+            if queued is not True:
+                return queued
+            start = time.monotonic()
+            try:
+                while self.active >= self.limit:
+                    remaining = start + self.target_wait - time.monotonic()
+                    if remaining <= 0:
+                        return self._give_up()
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self._admit(time.monotonic() - start)
+            return 0
+
+    async def acquire_async(self, poll=0.05):
+        """``acquire`` for coroutines: polls rather than blocking a thread."""
+        with self._cond:
+            queued = self._enter()
+            if queued is not True:
+                return queued
+        start = time.monotonic()
+        try:
+            while True:
+                await asyncio.sleep(poll)
+                with self._cond:
+                    if self.active < self.limit:
+                        self._admit(time.monotonic() - start)
+                        return 0
+                    if time.monotonic() - start >= self.target_wait:
+                        return self._give_up()
+        finally:
+            with self._cond:
+                self.waiting -= 1
+
+    def _enter(self):
+        # Caller holds the lock. 0 when admitted, seconds when shed, True
+        # when the caller should queue (it's then counted as waiting).
+        if not self.limit or self.active < self.limit:
+            self._admit(0.0)
+            return 0
+        expected = self._expected_wait()
+        if expected is not None and expected > self.target_wait:
+            self._stats['shed'] += 1
+            return expected
+        self.waiting += 1
+        return True
+
+    def _give_up(self):
+        # Caller holds the lock
+        self._stats['timed_out'] += 1
+        return self._expected_wait() or self.target_wait
+
+    def _admit(self, waited):
+        # Caller holds the lock
+        self.active += 1
+        self.avg_wait = 0.8 * self.avg_wait + 0.2 * waited
+        self._stats['admitted'] += 1
+
+    def _expected_wait(self):
+        if self.avg_hold is None:
+            return None
+        return self.avg_hold * (self.waiting + 1) / self.limit
+
+    def release(self, held=None):
+        """Give a slot back after holding it for ``held`` seconds (None: it
+        wasn't used, so the average hold time is left alone)."""
+        with self._cond:
+            self.active = max(0, self.active - 1)
+            if held is not None:
+                self.avg_hold = held if self.avg_hold is None else 0.8 * self.avg_hold + 0.2 * held
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(limit=self.limit, active=self.active, waiting=self.waiting,
+                         target_wait=self.target_wait, avg_wait_ms=round(self.avg_wait * 1000, 1),
+                         avg_hold_s=round(self.avg_hold, 3) if self.avg_hold is not None else None)
+        return stats
+
+
+_limits = {}
+_limits_lock = threading.Lock()
+
+
+def concurrency_limit(name, limit, target_wait):
+    """The process-wide ``ConcurrencyLimit`` for ``name``, so the sync and
+    async clients of one upstream share a single cap."""
+    with _limits_lock:
+        if name not in _limits:
+            _limits[name] = ConcurrencyLimit(name, limit, target_wait)
+        return _limits[name]
+
+
+def route_name(rule):
+    """'/jobs/<name>' -> 'JOBS_NAME', for ``RATE_LIMIT_<ROUTE>_*`` settings."""
+    return '_'.join(part.strip('<>').split(':')[-1] for part in rule.strip('/').split('/')).upper() or 'ROOT'
+
+
+class Admission:
+    """Per-caller rate limits for a Flask app.
+
+    The caller is the ``X-Caller-Id`` header (the bot sends the chat id),
+    else the client address. Each route in ``limits`` (``rule -> (per_min,
+    burst)``) has its own buckets; every other POST route shares the
+    ``default`` ones. Both can be changed with ``RATE_LIMIT_<ROUTE>_PER_MIN``
+    / ``_BURST`` (``RATE_LIMIT_DEFAULT_*`` for the shared ones) or for all
+    of them with ``RATE_LIMIT_PER_MIN`` / ``RATE_LIMIT_BURST``. Callers over
+    their limit get a 429 with Retry-After before the view runs.
+    """
+
+    def __init__(self, limits, default=(60, 20), caller_header='X-Caller-Id'):
+        self.caller_header = caller_header
+        self.routes = {
+            rule: RateLimit(rule, rate_setting(route_name(rule), 'PER_MIN', per_min),
+                            rate_setting(route_name(rule), 'BURST', burst, int))
+            for rule, (per_min, burst) in limits.items()
+        }
+        self.default = RateLimit('default', rate_setting('DEFAULT', 'PER_MIN', default[0]),
+                                 rate_setting('DEFAULT', 'BURST', default[1], int))
+
+    def limit_for(self, route, method):
+        limit = self.routes.get(route)
+        if limit is None and method == 'POST':
+            limit = self.default
+        return limit
+
+    def check(self, route, method, caller):
+        """0 if the request may proceed, else whole seconds until it may."""
+        limit = self.limit_for(route, method)
+        if limit is None:
+            return 0
+        wait = limit.check(caller)
+        if not wait:
+            return 0
+        ADMISSION_REJECTED.inc(route, 'rate_limit')
+        return math.ceil(wait)
+
+    def caller(self, header, addr):
+        """Caller id from the ``caller_header`` value, else the client address."""
+        return header or addr or 'unknown'
+
+    def install(self, app):
+        """Check every request before its view. Call after ``metrics.instrument``
+        so rejected requests are still counted."""
+
+        @app.before_request
+        def _admit():
+            req = request._get_current_object()
+            if req.environ.get('admission.checked'):
+                return None  # already admitted by the ASGI front
+            if req.url_rule is None:
+                return None
+            caller = self.caller(req.headers.get(self.caller_header), req.remote_addr)
+            retry_after = self.check(req.url_rule.rule, req.method, caller)
+            if retry_after:
+                resp = jsonify({'error': f'rate limit exceeded, retry in {retry_after}s', 'retry_after': retry_after})
+                resp.status_code = 429
+                resp.headers['Retry-After'] = str(retry_after)
+                return resp
+
+        @app.route('/admission/stats', methods=['GET'])
+        def admission_stats():
+            return jsonify(self.stats())
+
+        return app
+
+    def stats(self):
+        stats = {rule: limit.stats() for rule, limit in self.routes.items()}
+        stats['default'] = self.default.stats()
+        with _limits_lock:
+            limits = list(_limits.values())
+        stats['upstreams'] = {limit.name: limit.stats() for limit in limits}
+        return stats
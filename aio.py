@@ -0,0 +1,384 @@
+"""Async building blocks for the ASGI entry point (asgi.py).
+
+``AsyncUpstream`` mirrors ``http_client.Upstream`` on top of aiohttp, and
+``AsyncApp`` is a minimal ASGI router: routes registered on it run as
+coroutines, everything else is handed to the existing Flask app through a
+bounded thread pool.
+"""
+import io
+import sys
+import json
+import time
+import asyncio
+import logging
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+from http_client import (CircuitBreaker, UpstreamUnavailable, RETRY_STATUSES, release_on_close,
+                         upstream_limit, upstream_setting, retry_after_seconds, retryable)
+from metrics import (ADMISSION_REJECTED, HTTP_IN_FLIGHT, HTTP_LATENCY, HTTP_REQUESTS, STAGE_SECONDS,
+                     UPSTREAM_RESPONSES)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncUpstream:
+    """aiohttp-based twin of ``http_client.Upstream``: keep-alive pool, retries
+    with backoff honouring Retry-After, and a circuit breaker. Reads the same
+    ``UPSTREAM_<NAME>_*`` settings and shares the sync client's concurrency cap."""
+
+    def __init__(self, name, timeout=30, pool_size=100, retries=2, backoff=0.5,
+                 max_retry_wait=10, breaker_threshold=5, breaker_reset=30, queue_target=5):
+        self.name = name
+        self.timeout = upstream_setting(name, 'TIMEOUT', timeout)
+        self.retries = upstream_setting(name, 'RETRIES', retries, int)
+        self.backoff = upstream_setting(name, 'BACKOFF', backoff)
+        self.max_retry_wait = upstream_setting(name, 'MAX_RETRY_WAIT', max_retry_wait)
+        self.pool_size = upstream_setting(name, 'ASYNC_POOL_SIZE', pool_size, int)
+        self.breaker = CircuitBreaker(
+            name,
+            upstream_setting(name, 'BREAKER_THRESHOLD', breaker_threshold, int),
+            upstream_setting(name, 'BREAKER_RESET', breaker_reset),
+        )
+        # The cap defaults to the sync client's pool size, not the (larger) async one
+        self.limit = upstream_limit(name, 10, queue_target)
+        self._session = None
+        self._stats = {'requests': 0, 'retries': 0, 'failures': 0, 'rejected': 0, 'shed': 0}
+
+    @property
+    def session(self):
+        # Created lazily so it binds to the server's event loop
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                # Same meaning as the requests timeout: connect, then gap between reads
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout),
+            )
+        return self._session
+
+    async def aclose(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def request(self, method, url, stream=False, files=None, **kwargs):
+        """Like ``Upstream.request``. The body is read before returning unless
+        ``stream=True``, in which case the caller must ``release()`` it.
+        ``files`` takes the requests-style ``{field: (filename, bytes, mimetype)}``."""
+        retry_after = 0 if self.limit.try_acquire() else await self.limit.acquire_async()
+        if retry_after:
+            self._stats['shed'] += 1
+            ADMISSION_REJECTED.inc(self.name, 'capacity')
+            raise UpstreamUnavailable(self.name, retry_after, 'at capacity')
+        retry_after, trial = self.breaker.admit()
+        if retry_after:
+            self.limit.release()
+            self._stats['rejected'] += 1
+            raise UpstreamUnavailable(self.name, retry_after)
+
+        acquired = time.monotonic()
+        try:
+            response = await self._send(method, url, stream, files, **kwargs)
+        except BaseException:
+            self.limit.release(time.monotonic() - acquired)
+            raise
+        finally:
+            if trial:
+                self.breaker.end_trial()
+        if stream:
+            release_on_close(response, 'release', self.limit, acquired)
+        else:
+            self.limit.release(time.monotonic() - acquired)
+        return response
+
+    async def _send(self, method, url, stream, files, **kwargs):
+        attempt = 0
+        while True:
+            self._stats['requests'] += 1
+            if files:
+                kwargs['data'] = _form(files)  # a FormData can only be sent once
+            start = time.perf_counter()
+            try:
+                response = await self.session.request(method, url, **kwargs)
+                if not stream:
+                    await response.read()
+            except aiohttp.ClientConnectorError:
+                # Never reached the upstream, so safe to retry whatever the method
+                self._observe(start, 'error')
+                if attempt < self.retries:
+                    attempt += 1
+                    await self._sleep_before_retry(attempt, None)
+                    continue
+                self._failed()
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                self._observe(start, 'error')
+                self._failed()
+                raise
+            self._observe(start, response.status)
+
+            if response.status in RETRY_STATUSES and attempt < self.retries:
+                wait = retry_after_seconds(response)
+                if retryable(method, response.status, wait, self.max_retry_wait):
+                    attempt += 1
+                    response.release()
+                    await self._sleep_before_retry(attempt, wait)
+                    continue
+
+            if response.status >= 500:
+                self._failed()
+            else:
+                self.breaker.record_success()
+            return response
+
+    def _observe(self, start, status):
+        STAGE_SECONDS.observe(time.perf_counter() - start, 'upstream_http', self.name)
+        UPSTREAM_RESPONSES.inc(self.name, str(status))
+
+    async def _sleep_before_retry(self, attempt, retry_after):
+        self._stats['retries'] += 1
+        delay = retry_after if retry_after is not None else self.backoff * (2 ** (attempt - 1))
+        await asyncio.sleep(min(delay, self.max_retry_wait))
+
+    def _failed(self):
+        self._stats['failures'] += 1
+        self.breaker.record_failure()
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats.update({'circuit': self.breaker.state, 'consecutive_failures': self.breaker.failures,
+                      'timeout': self.timeout, 'in_flight': self.limit.active, 'queued': self.limit.waiting})
+        return stats
+
+
+def _form(files):
+    form = aiohttp.FormData()
+    for field, (filename, content, content_type) in files.items():
+        form.add_field(field, content, filename=filename, content_type=content_type)
+    return form
+
+
+# --- Requests and responses ---
+class Request:
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.body = body
+        self.method = scope['method']
+        self.path = scope['path']
+        self.headers = {k.decode('latin1').lower(): v.decode('latin1') for k, v in scope.get('headers', [])}
+        self.args = {k: v[-1] for k, v in parse_qs(scope.get('query_string', b'').decode()).items()}
+
+    def json(self):
+        """Parsed JSON body, or None if missing or invalid."""
+        try:
+            return json.loads(self.body or b'null')
+        except ValueError:
+            return None
+
+
+class Response:
+    def __init__(self, body=b'', status=200, headers=None, media_type='application/octet-stream'):
+        self.body = body
+        self.status = status
+        self.headers = dict(headers or {})
+        self.headers.setdefault('Content-Type', media_type)
+
+    async def __call__(self, send):
+        self.headers['Content-Length'] = str(len(self.body))
+        await send({'type': 'http.response.start', 'status': self.status, 'headers': self._raw_headers()})
+        await send({'type': 'http.response.body', 'body': self.body})
+
+    def _raw_headers(self):
+        return [(k.lower().encode('latin1'), str(v).encode('latin1')) for k, v in self.headers.items()]
+
+
+class JSONResponse(Response):
+    def __init__(self, data, status=200, headers=None):
+        super().__init__(json.dumps(data).encode(), status, headers, 'application/json')
+
+
+class StreamingResponse(Response):
+    """Body is an async iterator of bytes; ``on_close`` runs when it's done."""
+
+    def __init__(self, chunks, status=200, headers=None, media_type='application/octet-stream', on_close=None):
+        super().__init__(b'', status, headers, media_type)
+        self.chunks = chunks
+        self.on_close = on_close
+
+    async def __call__(self, send):
+        try:
+            await send({'type': 'http.response.start', 'status': self.status, 'headers': self._raw_headers()})
+            async for chunk in self.chunks:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if self.on_close is not None:
+                await self.on_close()
+
+
+def error_response(message, status, headers=None):
+    return JSONResponse({'error': message}, status, headers)
+
+
+# --- Application ---
+class AsyncApp:
+    """ASGI app: native async routes first, the Flask app for the rest.
+
+    A handler may return None to hand the request (body included) over to
+    the Flask view for the same path, e.g. for modes it doesn't implement.
+    ``wsgi_threads`` bounds how many Flask requests run at once. With an
+    ``admission.Admission``, native routes are rate limited the same way as
+    the Flask ones (and not counted twice when they fall back).
+    """
+
+    def __init__(self, wsgi_app, wsgi_threads=32, on_shutdown=None, admission=None):
+        self.wsgi_app = wsgi_app
+        self.admission = admission
+        self.routes = {}
+        self.on_shutdown = on_shutdown or []
+        self._pool = ThreadPoolExecutor(max_workers=wsgi_threads, thread_name_prefix='wsgi')
+
+    def route(self, path, methods=('POST',)):
+        def decorator(handler):
+            for method in methods:
+                self.routes[(method, path)] = handler
+            return handler
+        return decorator
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        body = await _read_body(receive)
+        handler = self.routes.get((scope['method'], scope['path']))
+        admitted = False
+        if handler is not None:
+            route, method = scope['path'], scope['method']
+            start = time.perf_counter()
+            req = Request(scope, body)
+            if self.admission is not None:
+                client = scope.get('client')
+                caller = self.admission.caller(req.headers.get(self.admission.caller_header.lower()),
+                                               client[0] if client else None)
+                retry_after = self.admission.check(route, method, caller)
+                if retry_after:
+                    HTTP_REQUESTS.inc(route, method, '429')
+                    await error_response(f'rate limit exceeded, retry in {retry_after}s', 429,
+                                         {'Retry-After': str(retry_after)})(send)
+                    return
+                admitted = True
+            HTTP_IN_FLIGHT.inc(route)
+            try:
+                response = await handler(req)
+            except UpstreamUnavailable as e:
+                response = error_response(str(e), 503, {'Retry-After': str(int(e.retry_after) + 1)})
+            except Exception as e:
+                logger.error(f"Async handler error on {scope['path']}: {str(e)}")
+                response = error_response(str(e), 500)
+            finally:
+                HTTP_IN_FLIGHT.dec(route)
+            if response is not None:
+                # Same series as the Flask hooks; fallbacks are counted there
+                HTTP_REQUESTS.inc(route, method, str(response.status))
+                HTTP_LATENCY.observe(time.perf_counter() - start, route, method)
+                await response(send)
+                return
+        await self._call_wsgi(scope, body, send, admitted)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for hook in self.on_shutdown:
+                    await hook()
+                self._pool.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _call_wsgi(self, scope, body, send, admitted=False):
+        loop = asyncio.get_running_loop()
+        environ = wsgi_environ(scope, body)
+        if admitted:
+            environ['admission.checked'] = True
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(k.lower().encode('latin1'), v.encode('latin1')) for k, v in headers]
+
+        result = await loop.run_in_executor(self._pool, self.wsgi_app, environ, start_response)
+        chunks = iter(result)
+        try:
+            # The first chunk may be what calls start_response (generators)
+            chunk = await loop.run_in_executor(self._pool, next, chunks, _END)
+            await send({'type': 'http.response.start', 'status': started['status'],
+                        'headers': started['headers']})
+            while chunk is not _END:
+                # Empty chunks (flushes) are legal mid-body; only _END ends it
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await loop.run_in_executor(self._pool, next, chunks, _END)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self._pool, result.close)
+
+
+_END = object()  # end of a WSGI body
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
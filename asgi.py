@@ -0,0 +1,520 @@
+"""ASGI entry point for both services.
+
+    python asgi.py engine --port 5000 --workers 4     # 1.py (AI engine)
+    python asgi.py lite --port 5001 --workers 2       # 2.py (AI engine lite)
+
+or directly with ``uvicorn asgi:engine`` / ``uvicorn asgi:lite``.
+
+Upstream-bound routes run as coroutines on aiohttp clients, so a request that
+is waiting on Replicate, Stability, x.ai, Gemini, the NSFW API, Pollinations
+or yt-dlp holds no thread. Every other route (and any mode the async
+handlers don't implement) is served by the unchanged Flask app on a bounded
+thread pool (ASGI_WSGI_THREADS).
+"""
+import os
+import sys
+import time
+import base64
+import asyncio
+import argparse
+import tempfile
+import importlib
+
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.formparser import parse_form_data
+from werkzeug.http import parse_accept_header
+from werkzeug.utils import secure_filename
+
+from aio import (AsyncApp, AsyncUpstream, JSONResponse, Response, StreamingResponse,
+                 error_response, wsgi_environ)
+from sse import (DONE, SSE_MIMETYPE, NDJSON_MIMETYPE, STREAM_HEADERS, TokenRelay,
+                 gemini_delta, parse_sse_line, stream_format, xai_delta)
+from result_cache import wants_cache
+from singleflight import AsyncSingleFlight
+from media_pipeline import media_headers, with_ext
+
+WSGI_THREADS = int(os.getenv('ASGI_WSGI_THREADS', 32))
+
+
+def _auth(api_key):
+    return {'Authorization': f'Bearer {api_key}'}
+
+
+def _accept(req):
+    return parse_accept_header(req.headers.get('accept', ''), MIMEAccept)
+
+
+# --- 1.py: AI engine ---
+def build_engine():
+    svc = importlib.import_module('1')
+    logger = svc.logger
+
+    replicate = AsyncUpstream('replicate', timeout=60)
+    replicate_cdn = AsyncUpstream('replicate_cdn', timeout=30)
+    stability = AsyncUpstream('stability', timeout=60)
+    xai = AsyncUpstream('xai', timeout=30)
+    gemini = AsyncUpstream('gemini', timeout=30)
+    nsfw = AsyncUpstream('nsfw', timeout=30)
+    upstreams = [replicate, replicate_cdn, stability, xai, gemini, nsfw]
+
+    app = AsyncApp(svc.app, WSGI_THREADS, on_shutdown=[u.aclose for u in upstreams], admission=svc.admission)
+
+    async def image_result(content, prefix, prompt, options):
+        if content is None or len(content) > svc.MAX_MEDIA_BYTES:
+            logger.warning(f"{prefix} image too large")
+            return error_response('image too large', 400)
+        content, info = await svc.media.process_async(content, options, prefix)
+        download_name = with_ext(f"{prefix}_{secure_filename(prompt[:20])}.png", info)
+        headers = dict(media_headers(info), **{'Content-Disposition': f'attachment; filename={download_name}'})
+        return Response(content, media_type=info['mimetype'] if info else 'image/png', headers=headers)
+
+    @app.route('/flux')
+    async def flux(req):
+        data = req.json() or {}
+        if wants_cache(data):
+            return None  # deterministic requests go through the Flask view's result cache
+        prompt = data.get('prompt')
+        if not prompt:
+            return error_response('missing prompt', 400)
+        try:
+            options = svc.media.options(data)
+        except ValueError as e:
+            return error_response(str(e), 400)
+        api_key = os.getenv('FLUX_API_KEY')
+        if not api_key:
+            return error_response('Flux API key not configured', 500)
+        response = await replicate.post(svc.REPLICATE_API_URL, headers=_auth(api_key),
+                                        json=svc.flux_payload(prompt))
+        response.raise_for_status()
+        image_url = (await response.json(content_type=None)).get('output')[0]
+        cdn_response = await replicate_cdn.get(image_url, stream=True)
+        try:
+            cdn_response.raise_for_status()
+            content = await read_limited(cdn_response, svc.MAX_MEDIA_BYTES)
+        finally:
+            cdn_response.release()
+        if content is not None:
+            logger.info(f"Flux image generated (async): {len(content) / (1024*1024):.2f}MB")
+        return await image_result(content, 'flux', prompt, options)
+
+    @app.route('/genimage')
+    async def genimage(req):
+        data = req.json() or {}
+        if wants_cache(data):
+            return None  # deterministic requests go through the Flask view's result cache
+        prompt = data.get('prompt')
+        if not prompt:
+            return error_response('missing prompt', 400)
+        try:
+            options = svc.media.options(data)
+        except ValueError as e:
+            return error_response(str(e), 400)
+        api_key = os.getenv('STABLE_DIFFUSION_API_KEY')
+        if not api_key:
+            return error_response('Stable Diffusion API key not configured', 500)
+        response = await stability.post(svc.STABILITY_API_URL, headers=_auth(api_key),
+                                        json=svc.genimage_payload(prompt))
+        response.raise_for_status()
+        result = await response.json(content_type=None)
+        image_bytes = base64.b64decode(result.get('artifacts')[0].get('base64'))
+        logger.info(f"Image generated (async): {len(image_bytes) / (1024*1024):.2f}MB")
+        return await image_result(image_bytes, 'genimage', prompt, options)
+
+    @app.route('/ai')
+    async def ai(req):
+        data = req.json() or {}
+        prompt = data.get('prompt')
+        if not prompt:
+            return error_response('missing prompt', 400)
+        api_key = os.getenv('GROK_API_KEY')
+        if not api_key:
+            return error_response('AI API key not configured', 500)
+        conversation_id, messages = await asyncio.to_thread(svc.ai_conversation, data, prompt)
+        fmt = stream_format(data, _accept(req))
+        if fmt:
+            payload = dict(svc.ai_payload(messages, conversation_id), stream=True, stream_options={'include_usage': True})
+            return await relay_stream(xai, svc.XAI_API_URL, api_key, payload, fmt, xai_delta, svc.ai_stream_metrics, 'AI',
+                                      on_done=lambda text: svc.conversations.append(conversation_id, prompt, text),
+                                      conversation_id=conversation_id)
+        response = await xai.post(svc.XAI_API_URL, headers=_auth(api_key),
+                                  json=svc.ai_payload(messages, conversation_id))
+        response.raise_for_status()
+        result = await response.json(content_type=None)
+        response_text = result.get('choices')[0].get('message').get('content')
+        await asyncio.to_thread(svc.conversations.append, conversation_id, prompt, response_text)
+        logger.info(f"AI response generated for prompt: {prompt[:50]}... ({len(messages)} messages sent)")
+        return JSONResponse({'response': response_text, 'conversation_id': conversation_id})
+
+    @app.route('/gemini')
+    async def gemini_route(req):
+        data = req.json() or {}
+        prompt = data.get('prompt')
+        if not prompt:
+            return error_response('missing prompt', 400)
+        api_key = os.getenv('GEMINI_API_KEY')
+        if not api_key:
+            return error_response('Gemini API key not configured', 500)
+        fmt = stream_format(data, _accept(req))
+        if fmt:
+            return await relay_stream(gemini, svc.GEMINI_STREAM_URL, api_key, svc.gemini_payload(prompt), fmt,
+                                      gemini_delta, svc.gemini_stream_metrics, 'Gemini')
+        response = await gemini.post(svc.GEMINI_API_URL, headers=_auth(api_key),
+                                     json=svc.gemini_payload(prompt))
+        response.raise_for_status()
+        result = await response.json(content_type=None)
+        response_text = result.get('candidates')[0].get('content').get('parts')[0].get('text')
+        logger.info(f"Gemini response generated for prompt: {prompt[:50]}...")
+        return JSONResponse({'response': response_text})
+
+    async def check_nsfw(key, data, filename, mimetype, api_key):
+        upload = await asyncio.to_thread(svc.nsfw_upload, data, filename, mimetype)
+        response = await nsfw.post(svc.NSFW_API_URL, headers=_auth(api_key), files={'image': upload})
+        response.raise_for_status()
+        verdict = {'is_safe': (await response.json(content_type=None)).get('is_safe', True)}
+        await asyncio.to_thread(svc.remember_verdict, key, verdict)
+        return verdict
+
+    # Same image checked by concurrent requests: one upstream call
+    nsfi_flight = AsyncSingleFlight('nsfi_async')
+
+    @app.route('/nsfi')
+    async def nsfi(req):
+        _, _, files = parse_form_data(wsgi_environ(req.scope, req.body))
+        if 'image' not in files:
+            return error_response('missing image', 400)
+        image = files['image']
+        api_key = os.getenv('NSFW_API_KEY')
+        if not api_key:
+            return error_response('NSFW API key not configured', 500)
+        data = image.read()
+        key = await asyncio.to_thread(svc.image_key, data)
+        # The verdict cache is SQLite-backed: keep it off the event loop
+        found, verdict = await asyncio.to_thread(svc.cached_verdict, key)
+        if not found:
+            # A call shared with a concurrent request counts as cached, as in the Flask view
+            verdict, found = await nsfi_flight.do(
+                key, lambda: check_nsfw(key, data, image.filename, image.mimetype, api_key))
+        is_safe = verdict['is_safe']
+        logger.info(f"NSFI check for {key} (async): {'Safe' if is_safe else 'NSFW'}{' (cached)' if found else ''}")
+        return JSONResponse({'is_safe': is_safe})
+
+    @app.route('/yt/download')
+    async def yt_download(req):
+        """Streaming downloads only: cache hits, buffered downloads and
+        downloads another request already started go to the Flask view."""
+        data = req.json() or {}
+        url = data.get('url')
+        kind = data.get('type', 'audio')
+        if not url or not data.get('stream', os.getenv('YT_STREAM_DOWNLOADS', '0') == '1'):
+            return None
+        key = (svc.extract_video_id(url), kind, svc.yt_format(kind))
+        if svc.media_store.contains(key):
+            return None
+        with svc.live_downloads_lock:
+            if key in svc.live_downloads:
+                return None
+            try:
+                live = svc.new_live_download(key)
+            except svc.TempQuotaExceeded as e:
+                return error_response(str(e), 503)
+            # Open while registered so the pump can't publish (move) the file first
+            handle = open(live.path, 'rb')
+            live.readers += 1
+            svc.live_downloads[key] = live
+        # A miss: hits and joins go to the Flask view, which records its own
+        svc.search_warmer.record_download(key, False)
+        progress = asyncio.Condition()
+        start_live_download(svc, live, url, kind, progress)
+        return await stream_live_download(svc, live, handle, kind, progress)
+
+    async def relay_stream(upstream, url, api_key, payload, fmt, extract, metrics, label, on_done=None, **extra):
+        """Async twin of 1.py's relay_stream."""
+        response = await upstream.post(url, headers=_auth(api_key), json=payload, stream=True)
+
+        async def release():
+            response.release()
+
+        try:
+            response.raise_for_status()
+        except Exception:
+            await release()
+            raise
+        relay = TokenRelay(fmt, extract, metrics)
+
+        async def events():
+            try:
+                async for line in response.content:
+                    chunk = parse_sse_line(line)
+                    if chunk is DONE:
+                        break
+                    if chunk is not None and (event := relay.feed(chunk)):
+                        yield event.encode()
+                final = relay.finish(**extra)
+                m = relay.result
+                logger.info(f"{label} stream: ttft {m['ttft_ms']}ms, {m['tokens']} tokens, {m['tokens_per_s']} tok/s")
+                if on_done is not None:
+                    await asyncio.to_thread(on_done, relay.text)
+                yield final.encode()
+            except Exception as e:
+                logger.error(f"{label} stream error: {str(e)}")
+                yield relay.error(str(e)).encode()
+
+        media_type = SSE_MIMETYPE if fmt == 'sse' else NDJSON_MIMETYPE
+        return StreamingResponse(events(), headers=STREAM_HEADERS, media_type=media_type, on_close=release)
+
+    @app.route('/upstreams/stats', methods=('GET',))
+    async def upstreams_stats(req):
+        return JSONResponse({
+            'sync': {u.name: u.stats() for u in (svc.replicate_api, svc.replicate_cdn, svc.stability_api,
+                                                 svc.xai_api, svc.gemini_api, svc.nsfw_api)},
+            'async': {u.name: u.stats() for u in upstreams},
+        })
+
+    return app
+
+
+async def read_limited(response, limit, chunk_size=64 * 1024):
+    """The body of a streamed response, or None once it passes ``limit`` bytes."""
+    body = bytearray()
+    async for chunk in response.content.iter_chunked(chunk_size):
+        body += chunk
+        if len(body) > limit:
+            return None
+    return bytes(body)
+
+
+# Pumps run detached from the request that started them; hold references
+# so they aren't garbage collected mid-download
+_live_pumps = set()
+
+
+def start_live_download(svc, live, url, kind, progress):
+    task = asyncio.get_running_loop().create_task(pump_live_download(svc, live, url, kind, progress))
+    _live_pumps.add(task)
+    task.add_done_callback(_live_pumps.discard)
+    return task
+
+
+async def pump_live_download(svc, live, url, kind, progress):
+    """Async twin of 1.py's streaming pump: yt-dlp stdout is teed into the
+    live file, which every client tails (Flask-path followers included), so
+    the download neither waits for nor dies with any one client."""
+    cmd = ['yt-dlp', '-f', live.key[2], '-o', '-', '--no-part', url]
+    if os.path.exists('cookies.txt'):
+        cmd += ['--cookies', 'cookies.txt']
+    deadline = time.monotonic() + svc.DOWNLOAD_TIMEOUT
+    errlog = tempfile.TemporaryFile()
+    out = open(live.path, 'wb')
+    error = None
+    proc = None
+    finished = False
+    try:
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=errlog)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError
+            chunk = await asyncio.wait_for(proc.stdout.read(svc.STREAM_CHUNK), remaining)
+            if not chunk:
+                finished = True
+                break
+            out.write(chunk)
+            out.flush()
+            with live.cond:
+                if live.ext is None:
+                    live.ext = svc.sniff_ext(chunk, kind)
+                live.size += len(chunk)
+                live.cond.notify_all()
+            async with progress:
+                progress.notify_all()
+            if live.size > svc.MAX_DOWNLOAD_BYTES:
+                error = svc.DownloadError('file too large', 400)
+                break
+            if not svc.temp_store.resize(live.path, live.size):
+                error = svc.DownloadError('temp storage full', 503)
+                break
+    except asyncio.TimeoutError:
+        error = svc.DownloadError('download timeout')
+    except Exception as e:
+        error = svc.DownloadError(f'download failed: {str(e)}')
+    finally:
+        out.close()
+        if proc is not None:
+            # Only kill a pump we gave up on: kill() polls the child, and
+            # reaping it there races asyncio's watcher (exit status 255)
+            if not finished and proc.returncode is None:
+                proc.kill()
+            try:
+                await asyncio.wait_for(proc.wait(), max(1, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                error = error or svc.DownloadError('download timeout')
+    if error is None and proc.returncode != 0:
+        errlog.seek(0)
+        svc.logger.error(f"yt-dlp failed: {errlog.read().decode(errors='replace')}")
+        error = svc.DownloadError('download failed')
+    elif error is None and live.size == 0:
+        error = svc.DownloadError('file not found')
+    errlog.close()
+
+    live.error = error
+    with svc.live_downloads_lock:
+        svc.live_downloads.pop(live.key, None)
+    with live.cond:
+        live.done = True
+        live.cond.notify_all()
+    async with progress:
+        progress.notify_all()
+    try:
+        if error is None:
+            try:
+                entry = await asyncio.to_thread(svc.media_store.publish, live.key, live.path, live.ext)
+                svc.temp_store.forget(live.path)
+                svc.media_store.release(entry['key'])
+                return
+            except Exception as e:
+                svc.logger.error(f"Could not cache streamed download {live.key[:2]}: {str(e)}")
+        else:
+            svc.logger.warning(f"Streamed download aborted: {live.key[:2]} ({str(error)})")
+        svc.cleanup_file(live.path)
+    finally:
+        live.settle()
+
+
+async def stream_live_download(svc, live, handle, kind, progress):
+    """Send the live file to this client as the pump writes it."""
+    if kind == 'audio':
+        mimes = {'m4a': 'audio/mp4', 'webm': 'audio/webm', 'mp3': 'audio/mpeg'}
+    else:
+        mimes = {'mp4': 'video/mp4', 'webm': 'video/webm'}
+    released = False
+
+    async def release():
+        nonlocal released
+        if not released:
+            released = True
+            handle.close()
+            with svc.live_downloads_lock:
+                live.readers -= 1
+
+    # Hold the response until the container is known so Content-Type is real
+    async with progress:
+        await progress.wait_for(lambda: live.ext is not None or live.done)
+    if live.ext is None:
+        await release()
+        error = live.error or svc.DownloadError('download failed')
+        return error_response(str(error), error.status)
+
+    async def chunks():
+        while True:
+            chunk = handle.read(svc.STREAM_CHUNK)
+            if chunk:
+                yield chunk
+                continue
+            async with progress:
+                await progress.wait_for(lambda: live.done or handle.tell() < live.size)
+            if live.error is not None:
+                # Drop the connection so the client sees a failed transfer
+                raise live.error
+            if live.done and handle.tell() >= live.size:
+                return
+
+    return StreamingResponse(chunks(), media_type=mimes.get(live.ext, 'application/octet-stream'), headers={
+        'Content-Disposition': f'attachment; filename="yt_{secure_filename(live.key[0])}.{live.ext}"',
+        'Content-Location': svc.media_url(svc.media_store, svc.content_key(*live.key)),
+    }, on_close=release)
+
+
+# --- 2.py: AI engine lite ---
+def build_lite():
+    lite = importlib.import_module('2')
+    pollinations = AsyncUpstream('pollinations', timeout=120)
+    app = AsyncApp(lite.app, WSGI_THREADS, on_shutdown=[pollinations.aclose], admission=lite.admission)
+
+    @app.route('/generate')
+    async def generate(req):
+        data = req.json()
+        if not isinstance(data, dict) or wants_cache(data):
+            return None  # keep the Flask error behaviour and result cache
+        mode = data.get('mode', 'img')
+        prompt = data.get('prompt', '')
+        if not prompt:
+            return error_response('No prompt provided', 400)
+        generation = lite.generation_request(mode, prompt)
+        if generation is None:
+            return error_response(f'Invalid mode: {mode}', 400)
+        url, seed = generation
+        label = lite.MODES[mode][0]
+        try:
+            options = lite.media.options(data)
+        except ValueError as e:
+            return error_response(str(e), 400)
+        binary = lite.wants_binary(data, _accept(req))
+        if binary and lite.media.requested(options):
+            return None  # re-encoded binary replies are buffered by the Flask view
+
+        if binary:
+            response = await pollinations.get(url, stream=True)
+
+            async def release():
+                response.release()
+
+            if response.status != 200:
+                await release()
+                return error_response(f'{label} generation failed', 500)
+            headers = {'X-Mode': mode, 'X-Seed': str(seed)}
+            if response.headers.get('Content-Length') and not response.headers.get('Content-Encoding'):
+                headers['Content-Length'] = response.headers['Content-Length']
+            return StreamingResponse(response.content.iter_chunked(lite.STREAM_CHUNK), headers=headers,
+                                     media_type=response.headers.get('Content-Type', 'image/jpeg'),
+                                     on_close=release)
+
+        response = await pollinations.get(url)
+        if response.status != 200:
+            return error_response(f'{label} generation failed', 500)
+        image_bytes, info = await lite.media.process_async(await response.read(), options, 'generate')
+        body = {'image': base64.b64encode(image_bytes).decode('utf-8'), 'mode': mode, 'seed': seed}
+        if info is not None:
+            body['format'] = info['format']
+            if info['thumbnail']:
+                body['thumbnail'] = base64.b64encode(info['thumbnail']).decode('utf-8')
+        return JSONResponse(body, headers=media_headers(info))
+
+    @app.route('/upstreams/stats', methods=('GET',))
+    async def upstreams_stats(req):
+        return JSONResponse({'sync': {lite.pollinations.name: lite.pollinations.stats()},
+                             'async': {pollinations.name: pollinations.stats()}})
+
+    return app
+
+
+_APPS = {'engine': build_engine, 'lite': build_lite}
+
+
+def __getattr__(name):
+    # Build lazily so `uvicorn asgi:lite` never imports 1.py and vice versa
+    if name in _APPS:
+        app = _APPS[name]()
+        globals()[name] = app
+        return app
+    raise AttributeError(name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the AI engine over ASGI (uvicorn).')
+    parser.add_argument('service', choices=sorted(_APPS))
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--workers', type=int, default=int(os.getenv('ASGI_WORKERS', 1)))
+    args = parser.parse_args()
+
+    import uvicorn
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    port = args.port or int(os.getenv('PORT', 5000 if args.service == 'engine' else 5001))
+    uvicorn.run(f"asgi:{args.service}", host=args.host, port=port, workers=args.workers,
+                log_level='info', timeout_keep_alive=30)
+
+
+if __name__ == '__main__':
+    main()
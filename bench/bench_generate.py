@@ -0,0 +1,103 @@
+"""Memory and latency of 2.py /generate: base64 JSON vs. binary streaming.
+
+Drives 2.py's app through the WSGI test client against a local Pollinations
+stub (separate process) that returns ``--size-mb`` after ``--latency`` seconds,
+and measures time-to-first-byte, total latency and peak Python heap
+allocation per request for each format.
+
+    python bench/bench_generate.py --size-mb 4 --requests 10
+"""
+import os
+import sys
+import time
+import argparse
+import importlib
+import multiprocessing
+import statistics
+import tracemalloc
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def _serve_stub(size_bytes, latency, ports):
+    payload = b'\xff\xd8\xff' + os.urandom(size_bytes - 3)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    ports.put(server.server_port)
+    server.serve_forever()
+
+
+def start_stub(size_bytes, latency):
+    """Run the stub in its own process so its buffers don't count as ours."""
+    ports = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_serve_stub, args=(size_bytes, latency, ports), daemon=True)
+    proc.start()
+    return proc, ports.get(timeout=10)
+
+
+def run(client, fmt, requests):
+    body = {'mode': 'img', 'prompt': 'bench', 'format': fmt}
+    ttfb, total, peaks = [], [], []
+    for _ in range(requests):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        resp = client.post('/generate', json=body, buffered=False)
+        chunks = iter(resp.response)
+        received = len(next(chunks))
+        ttfb.append(time.perf_counter() - start)
+        for chunk in chunks:
+            received += len(chunk)
+        resp.close()
+        total.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    return {
+        'format': fmt,
+        'bytes_on_wire': received,
+        'ttfb_ms': round(statistics.median(ttfb) * 1000, 1),
+        'total_ms': round(statistics.median(total) * 1000, 1),
+        'peak_heap_mb': round(max(peaks) / (1024 * 1024), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=float, default=4)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--requests', type=int, default=10)
+    args = parser.parse_args()
+
+    stub, stub_port = start_stub(int(args.size_mb * 1024 * 1024), args.latency)
+    os.environ['POLLINATIONS_URL'] = f"http://127.0.0.1:{stub_port}"
+    lite = importlib.import_module('2')
+    # WSGI test client: no socket server in-process, so the heap numbers are the app's own
+    client = lite.app.test_client()
+
+    tracemalloc.start()
+    results = [run(client, fmt, args.requests) for fmt in ('json', 'binary')]
+    tracemalloc.stop()
+    stub.terminate()
+
+    print(f"{'format':<8}{'wire bytes':>12}{'ttfb':>10}{'total':>10}{'peak heap':>12}")
+    for r in results:
+        print(f"{r['format']:<8}{r['bytes_on_wire']:>12}{r['ttfb_ms']:>8}ms{r['total_ms']:>8}ms{r['peak_heap_mb']:>10}MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Per-request overhead of the yt-dlp engine backends.
+
+Serves a small media file from a local HTTP server and downloads it N times
+through each backend, so the numbers are dominated by per-request overhead
+(process startup, extractor import, cookie parsing) rather than YouTube.
+
+    python bench/bench_yt_engine.py --requests 20 --workers 4
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import statistics
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from yt_engine import DownloadEngine  # noqa: E402
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class QuietServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        pass  # yt-dlp closes probe connections early
+
+
+def serve(directory):
+    server = QuietServer(('127.0.0.1', 0), partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_backend(backend, url, requests, workers, out_dir):
+    opts = {'quiet': True, 'no_warnings': True, 'noprogress': True, 'noplaylist': True}
+    engine = DownloadEngine(out_dir, opts, backend=backend, workers=workers, timeout=60)
+    engine.warm(['best'])
+    time.sleep(0.5)
+
+    latencies = []
+    start = time.perf_counter()
+    jobs = []
+    for _ in range(requests):
+        jobs.append((time.perf_counter(), engine.submit(url, 'best')))
+    for submitted, job in jobs:
+        result = job.result()
+        latencies.append(time.perf_counter() - submitted)
+        os.remove(result['file'])
+    wall = time.perf_counter() - start
+    engine.shutdown()
+
+    # Sequential pass isolates per-request overhead from queueing
+    engine = DownloadEngine(out_dir, opts, backend=backend, workers=1, timeout=60)
+    engine.download(url, 'best')  # warm-up
+    sequential = []
+    for _ in range(min(requests, 10)):
+        t = time.perf_counter()
+        result = engine.download(url, 'best')
+        sequential.append(time.perf_counter() - t)
+        os.remove(result['file'])
+    engine.shutdown()
+
+    return {
+        'backend': backend,
+        'requests': requests,
+        'throughput_rps': round(requests / wall, 2),
+        'p50_ms': round(statistics.median(latencies) * 1000, 1),
+        'max_ms': round(max(latencies) * 1000, 1),
+        'per_request_ms': round(statistics.mean(sequential) * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--size-kb', type=int, default=256)
+    parser.add_argument('--backends', default='inprocess,subprocess')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as media_dir, tempfile.TemporaryDirectory() as out_dir:
+        with open(os.path.join(media_dir, 'song.mp3'), 'wb') as f:
+            f.write(b'ID3' + os.urandom(args.size_kb * 1024))
+        server = serve(media_dir)
+        url = f"http://127.0.0.1:{server.server_address[1]}/song.mp3"
+
+        results = [run_backend(b, url, args.requests, args.workers, out_dir)
+                   for b in args.backends.split(',')]
+        server.shutdown()
+
+    print(f"{'backend':<12}{'per-request':>14}{'p50':>10}{'max':>10}{'req/s':>9}")
+    for r in results:
+        print(f"{r['backend']:<12}{r['per_request_ms']:>12}ms{r['p50_ms']:>8}ms{r['max_ms']:>8}ms{r['throughput_rps']:>9}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Shared helpers for the bench scripts: ports, process sampling, load generation."""
+import os
+import time
+import socket
+import asyncio
+import threading
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=60, proc=None):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f"server exited with {proc.returncode} before listening on {port}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"nothing listening on {port}")
+
+
+def read_proc(pid):
+    """(threads, rss_mb) for ``pid`` from /proc; zeros elsewhere."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(fields['Threads']), int(fields['VmRSS'].split()[0]) / 1024
+    except (OSError, KeyError, ValueError):
+        return 0, 0.0
+
+
+def dir_bytes(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass  # deleted while walking
+    return total
+
+
+class Sampler:
+    """Tracks peak threads and RSS of ``pid`` (and optionally the bytes under
+    ``directory``) on a background thread while in a ``with`` block."""
+
+    def __init__(self, pid, directory=None, interval=0.05):
+        self.pid = pid
+        self.directory = directory
+        self.interval = interval
+        self.peak = {'threads': 0, 'rss_mb': 0.0, 'dir_bytes': 0}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            threads, rss = read_proc(self.pid)
+            self.peak['threads'] = max(self.peak['threads'], threads)
+            self.peak['rss_mb'] = max(self.peak['rss_mb'], rss)
+            if self.directory:
+                self.peak['dir_bytes'] = max(self.peak['dir_bytes'], dir_bytes(self.directory))
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+async def fire(make_request, requests, concurrency, timeout=300):
+    """Run ``requests`` calls of ``make_request(session, i)`` (an aiohttp
+    request context manager) with ``concurrency`` in flight.
+    Returns (latencies, errors, elapsed, bytes received)."""
+    latencies, errors, received = [], 0, 0
+    sem = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        async def one(i):
+            nonlocal errors, received
+            async with sem:
+                start = time.perf_counter()
+                try:
+                    async with make_request(session, i) as r:
+                        body = await r.read()
+                        if r.status >= 400:
+                            errors += 1
+                            return
+                        received += len(body)
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    errors += 1
+                    return
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(requests)))
+        elapsed = time.perf_counter() - start
+    return latencies, errors, elapsed, received
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+
+    def ms(q):
+        if not latencies:
+            return None
+        return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 1)
+
+    return {
+        'ok': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': ms(0.50),
+        'p95_ms': ms(0.95),
+        'p99_ms': ms(0.99),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None,
+    }
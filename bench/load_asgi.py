@@ -0,0 +1,107 @@
+"""Load test: Flask dev server (thread per request) vs. asgi.py under uvicorn.
+
+Points 1.py's x.ai upstream at a local stub that answers after ``--latency``
+ms, then fires ``--requests`` POST /ai calls with ``--concurrency`` in
+flight against each server and reports throughput, p50/p99 latency, the
+server's peak thread count and peak RSS.
+
+    python bench/load_asgi.py --requests 2000 --concurrency 256 --latency 500
+    python bench/load_asgi.py --servers asgi --concurrency 1000
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+import subprocess
+
+from harness import ROOT, Sampler, fire, free_port, summarize, wait_for_port
+
+STUB = """
+import asyncio, json, sys, uvicorn
+latency = float(sys.argv[2]) / 1000
+body = json.dumps({'choices': [{'message': {'content': 'stub answer'}}]}).encode()
+
+async def app(scope, receive, send):
+    if scope['type'] != 'http':
+        return
+    while (await receive()).get('more_body'):
+        pass
+    await asyncio.sleep(latency)
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'application/json')]})
+    await send({'type': 'http.response.body', 'body': body})
+
+uvicorn.run(app, port=int(sys.argv[1]), log_level='warning', backlog=4096)
+"""
+
+FLASK = """
+import sys, importlib
+from werkzeug.serving import make_server
+svc = importlib.import_module('1')
+make_server('127.0.0.1', int(sys.argv[1]), svc.app, threaded=True).serve_forever()
+"""
+
+
+def start_server(kind, port, env):
+    if kind == 'flask':
+        cmd = [sys.executable, '-c', FLASK, str(port)]
+    else:
+        cmd = [sys.executable, '-m', 'uvicorn', 'asgi:engine', '--port', str(port),
+               '--log-level', 'warning', '--backlog', '4096']
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port, proc=proc)
+    return proc
+
+
+def run(kind, args, env):
+    port = free_port()
+    proc = start_server(kind, port, env)
+
+    def ask(session, i):
+        return session.post(f"http://127.0.0.1:{port}/ai", json={'prompt': f'bench {i}'})
+
+    try:
+        with Sampler(proc.pid) as sampler:
+            warmup = min(args.concurrency, 50)
+            asyncio.run(fire(ask, warmup, warmup, timeout=120))
+            latencies, errors, elapsed, _ = asyncio.run(fire(ask, args.requests, args.concurrency, timeout=120))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    return dict(server=kind, **summarize(latencies, errors, elapsed),
+                peak_threads=sampler.peak['threads'], peak_rss_mb=round(sampler.peak['rss_mb'], 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=256)
+    parser.add_argument('--latency', type=float, default=500, help='stub upstream latency, ms')
+    parser.add_argument('--servers', default='flask,asgi')
+    args = parser.parse_args()
+
+    stub_port = free_port()
+    stub = subprocess.Popen([sys.executable, '-c', STUB, str(stub_port), str(args.latency)])
+    wait_for_port(stub_port)
+
+    env = dict(os.environ)
+    env.update({
+        'GROK_API_KEY': 'bench',
+        'XAI_API_URL': f"http://127.0.0.1:{stub_port}/v1/chat/completions",
+        'UPSTREAM_XAI_POOL_SIZE': str(args.concurrency),
+        'UPSTREAM_XAI_ASYNC_POOL_SIZE': str(args.concurrency),
+        'YT_ENGINE_PREWARM': '0',
+        'YT_SEARCH_CACHE_DB': '',
+    })
+    try:
+        for kind in args.servers.split(','):
+            print(json.dumps(run(kind.strip(), args, env)))
+    finally:
+        stub.terminate()
+        stub.wait()
+
+
+if __name__ == '__main__':
+    main()
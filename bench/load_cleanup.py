@@ -0,0 +1,110 @@
+"""Load test: request latency vs. temp-file cleanup.
+
+Runs 1.py's app on a local port with the Stability upstream stubbed out and
+hammers /genimage. ``--legacy`` swaps in the old cleanup_file (global lock,
+gc.collect(), sleep(1) on the request thread) for comparison.
+
+    python bench/load_cleanup.py --requests 200 --concurrency 16
+    python bench/load_cleanup.py --requests 200 --concurrency 16 --legacy
+"""
+import os
+import gc
+import sys
+import time
+import base64
+import argparse
+import importlib
+import tempfile
+import threading
+import statistics
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import make_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+class StubResponse:
+    def __init__(self, payload):
+        self._payload = payload
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._payload
+
+
+def load_app(image_kb, legacy):
+    os.environ.setdefault('STABLE_DIFFUSION_API_KEY', 'bench')
+    os.environ.setdefault('YT_ENGINE_PREWARM', '0')
+    engine = importlib.import_module('1')
+
+    image_b64 = base64.b64encode(os.urandom(image_kb * 1024)).decode()
+    engine.stability_api.post = lambda *a, **k: StubResponse({'artifacts': [{'base64': image_b64}]})
+
+    if legacy:
+        lock = threading.Lock()
+
+        def cleanup_file(filepath):
+            try:
+                if os.path.exists(filepath):
+                    with lock:
+                        gc.collect()
+                        time.sleep(1)
+                        os.remove(filepath)
+            except Exception:
+                pass
+
+        engine.cleanup_file = cleanup_file
+    return engine
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--image-kb', type=int, default=256)
+    parser.add_argument('--legacy', action='store_true')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='luma-bench-')
+    os.chdir(workdir)
+    engine = load_app(args.image_kb, args.legacy)
+    server = make_server('127.0.0.1', 0, engine.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/genimage"
+
+    def hit(_):
+        req = urllib.request.Request(url, data=b'{"prompt": "bench"}',
+                                     headers={'Content-Type': 'application/json'})
+        start = time.perf_counter()
+        with urllib.request.urlopen(req) as resp:
+            resp.read()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        latencies = list(pool.map(hit, range(args.requests)))
+    wall = time.perf_counter() - start
+    server.shutdown()
+
+    print(f"mode:        {'legacy cleanup' if args.legacy else 'background reaper'}")
+    print(f"requests:    {args.requests} @ concurrency {args.concurrency}")
+    print(f"throughput:  {args.requests / wall:.1f} req/s")
+    print(f"p50:         {statistics.median(latencies) * 1000:.1f}ms")
+    print(f"p95:         {percentile(latencies, 95) * 1000:.1f}ms")
+    print(f"p99:         {percentile(latencies, 99) * 1000:.1f}ms")
+    if not args.legacy:
+        print(f"reaper:      {engine.reaper.stats()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+"""Offline benchmark suite: every route of 1.py and 2.py against local stubs.
+
+Starts bench/stubs.py (fake image, LLM, NSFW and TTS APIs), then each
+service in a scratch working directory with yt-dlp replaced by
+bench/bin/yt-dlp and YouTube search answered by a fake extractor. Each
+scenario fires ``--requests`` calls at ``--concurrency`` and reports
+throughput, p50/p95/p99 latency, errors, peak RSS/threads of the service
+and peak temp-dir bytes.
+
+    python bench/run.py                                   # all scenarios, JSON on stdout
+    python bench/run.py --only flux,ai_stream --requests 500 --concurrency 64
+    python bench/run.py --server asgi --save-baseline bench/baseline.json
+    python bench/run.py --baseline bench/baseline.json    # exit 1 on regression
+
+A scenario regresses when its p95 grows, or its throughput drops, by more
+than ``--tolerance`` (p95 also needs to be ``--min-delta-ms`` worse, so
+sub-millisecond noise on cache hits doesn't count), or when it errors more.
+Baselines are machine-specific; record one on the machine you compare on.
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import aiohttp
+
+from harness import ROOT, Sampler, dir_bytes, fire, free_port, summarize, wait_for_port
+from stubs import upstream_env
+
+BENCH_DIR = os.path.join(ROOT, 'bench')
+
+# Runs in the service process: fake the network-bound bits that have no URL
+# setting (gTTS endpoint, YouTube search extractor), then serve the app.
+SERVER = """
+import os, sys, time, hashlib, importlib
+service, port, server = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+sys.path.insert(0, os.environ['BENCH_ROOT'])
+
+import gtts.tts
+tts_url = os.environ['BENCH_TTS_URL']
+gtts.tts._translate_url = lambda tld='com', path='': f"{tts_url}/{path}"
+
+import yt_dlp
+search_latency = float(os.environ.get('BENCH_SEARCH_LATENCY_MS', 300)) / 1000
+
+def extract_info(self, url, download=True, process=True, **kwargs):
+    if not url.startswith('ytsearch'):
+        raise yt_dlp.utils.DownloadError('bench: only searches are faked in-process')
+    time.sleep(search_latency)
+    count, query = url[len('ytsearch'):].split(':', 1)
+    return {'entries': [{
+        'id': hashlib.md5(f"{query}{i}".encode()).hexdigest()[:11],
+        'title': f"{query} #{i}",
+        'thumbnails': [{'url': 'http://127.0.0.1/thumb.jpg'}],
+        'duration': 200,
+    } for i in range(int(count or 1))]}
+
+yt_dlp.YoutubeDL.extract_info = extract_info
+
+if server == 'asgi':
+    import uvicorn, asgi
+    app = asgi.engine if service == '1' else asgi.lite
+    uvicorn.run(app, host='127.0.0.1', port=port, log_level='warning', backlog=4096)
+else:
+    from werkzeug.serving import make_server
+    app = importlib.import_module(service).app
+    make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+"""
+
+
+def png(i, size=64):
+    """A distinct little PNG per ``i`` so perceptual hashes differ."""
+    from PIL import Image
+    img = Image.effect_noise((size, size), 64 + i % 64).convert('RGB')
+    buf = io.BytesIO()
+    img.save(buf, 'PNG')
+    return buf.getvalue()
+
+
+def nsfi_request(session, url, i):
+    form = aiohttp.FormData()
+    form.add_field('image', png(i), filename=f'bench{i}.png', content_type='image/png')
+    return session.post(url, data=form)
+
+
+# name -> (service, method, path, request body for call i, requests scale)
+SCENARIOS = {
+    'yt_search_miss': ('1', 'GET', lambda i: f"/yt/search?q=bench+miss+{i}", None, 1),
+    'yt_search_hit': ('1', 'GET', lambda i: "/yt/search?q=bench+hit", None, 1),
+    'yt_search_batch': ('1', 'POST', '/yt/search/batch',
+                        lambda i: {'queries': [f"bench batch {i} {j}" for j in range(5)]}, 0.25),
+    'yt_download': ('1', 'POST', '/yt/download', lambda i: {'url': f"https://youtu.be/dl{i:09d}"}, 0.25),
+    'yt_download_cached': ('1', 'POST', '/yt/download', lambda i: {'url': 'https://youtu.be/cached00001'}, 0.25),
+    'yt_download_stream': ('1', 'POST', '/yt/download',
+                           lambda i: {'url': f"https://youtu.be/st{i:09d}", 'stream': True}, 0.25),
+    'flux': ('1', 'POST', '/flux', lambda i: {'prompt': f"bench flux {i}"}, 1),
+    'flux_cached': ('1', 'POST', '/flux', lambda i: {'prompt': 'bench flux', 'deterministic': True}, 1),
+    'genimage': ('1', 'POST', '/genimage', lambda i: {'prompt': f"bench genimage {i}"}, 1),
+    'tts': ('1', 'POST', '/tts', lambda i: {'text': f"Benchmark sentence number {i}. " * 8}, 1),
+    'tts_stream': ('1', 'POST', '/tts', lambda i: {'text': f"Streamed sentence {i}. " * 8, 'stream': True}, 1),
+    'ai': ('1', 'POST', '/ai', lambda i: {'prompt': f"bench {i}"}, 1),
+    'ai_stream': ('1', 'POST', '/ai', lambda i: {'prompt': f"bench {i}", 'stream': True}, 1),
+    'gemini': ('1', 'POST', '/gemini', lambda i: {'prompt': f"bench {i}"}, 1),
+    'gemini_stream': ('1', 'POST', '/gemini', lambda i: {'prompt': f"bench {i}", 'stream': True}, 1),
+    'nsfi': ('1', 'POST', '/nsfi', nsfi_request, 1),
+    'generate': ('2', 'POST', '/generate', lambda i: {'prompt': f"bench {i}"}, 1),
+    'generate_binary': ('2', 'POST', '/generate', lambda i: {'prompt': f"bench {i}", 'format': 'binary'}, 1),
+    'generate_cached': ('2', 'POST', '/generate', lambda i: {'prompt': 'bench', 'deterministic': True}, 1),
+}
+
+
+def request_factory(base, method, path, body):
+    if body is nsfi_request:
+        return lambda session, i: nsfi_request(session, base + path, i)
+    if method == 'GET':
+        return lambda session, i: session.get(base + path(i))
+    return lambda session, i: session.post(base + path, json=body(i))
+
+
+class Service:
+    """One service process in its own scratch directory."""
+
+    def __init__(self, name, server, env):
+        self.name = name
+        self.workdir = tempfile.mkdtemp(prefix=f"bench{name}_")
+        self.port = free_port()
+        self.base = f"http://127.0.0.1:{self.port}"
+        self.log = open(os.path.join(self.workdir, 'server.log'), 'wb')
+        self.proc = subprocess.Popen([sys.executable, '-c', SERVER, name, str(self.port), server],
+                                     cwd=self.workdir, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+        wait_for_port(self.port, proc=self.proc)
+
+    @property
+    def temp_dir(self):
+        return os.path.join(self.workdir, 'temp')
+
+    def stop(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        self.log.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def run_scenario(service, name, args):
+    _, method, path, body, scale = SCENARIOS[name]
+    make_request = request_factory(service.base, method, path, body)
+    requests = max(1, int(args.requests * scale))
+    concurrency = max(1, min(args.concurrency, requests))
+    with Sampler(service.proc.pid, service.temp_dir) as sampler:
+        latencies, errors, elapsed, received = asyncio.run(fire(make_request, requests, concurrency))
+    result = summarize(latencies, errors, elapsed)
+    result.update(
+        requests=requests,
+        concurrency=concurrency,
+        mb_received=round(received / (1024 * 1024), 2),
+        peak_rss_mb=round(sampler.peak['rss_mb'], 1),
+        peak_threads=sampler.peak['threads'],
+        peak_temp_mb=round(sampler.peak['dir_bytes'] / (1024 * 1024), 2),
+        temp_mb_after=round(dir_bytes(service.temp_dir) / (1024 * 1024), 2),
+    )
+    return result
+
+
+def compare(results, baseline, tolerance, min_delta_ms):
+    """Regression messages for scenarios present in both runs."""
+    problems = []
+    for name, now in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        if now['errors'] > before['errors']:
+            problems.append(f"{name}: errors {before['errors']} -> {now['errors']}")
+        if now['p95_ms'] is not None and before['p95_ms'] is not None:
+            limit = max(before['p95_ms'] * (1 + tolerance), before['p95_ms'] + min_delta_ms)
+            if now['p95_ms'] > limit:
+                problems.append(f"{name}: p95 {before['p95_ms']}ms -> {now['p95_ms']}ms")
+        if now['throughput_rps'] < before['throughput_rps'] * (1 - tolerance):
+            problems.append(f"{name}: throughput {before['throughput_rps']} -> {now['throughput_rps']} rps")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', help='comma-separated scenario names (default: all)')
+    parser.add_argument('--server', choices=('flask', 'asgi'), default='flask')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=200, help='stub API latency, ms')
+    parser.add_argument('--image-bytes', type=int, default=300_000)
+    parser.add_argument('--tokens', type=int, default=50)
+    parser.add_argument('--token-delay', type=float, default=10, help='ms between streamed tokens')
+    parser.add_argument('--yt-bytes', type=int, default=3_000_000, help='fake yt-dlp media size')
+    parser.add_argument('--yt-latency', type=float, default=300, help='fake yt-dlp startup, ms')
+    parser.add_argument('--output', help='write the JSON report here as well as to stdout')
+    parser.add_argument('--save-baseline', help='write the results as a baseline file')
+    parser.add_argument('--baseline', help='compare against this baseline; exit 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--min-delta-ms', type=float, default=20)
+    args = parser.parse_args()
+
+    names = args.only.split(',') if args.only else list(SCENARIOS)
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+
+    stub_port = free_port()
+    stub = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'stubs.py'), '--port', str(stub_port),
+                             '--latency', str(args.latency), '--image-bytes', str(args.image_bytes),
+                             '--tokens', str(args.tokens), '--token-delay', str(args.token_delay)])
+    wait_for_port(stub_port, proc=stub)
+
+    env = dict(os.environ)
+    env.update(upstream_env(f"http://127.0.0.1:{stub_port}"))
+    env.update({
+        'BENCH_ROOT': ROOT,
+        'BENCH_YT_BYTES': str(args.yt_bytes),
+        'BENCH_YT_LATENCY_MS': str(args.yt_latency),
+        'BENCH_SEARCH_LATENCY_MS': str(args.latency),
+        'PATH': os.path.join(BENCH_DIR, 'bin') + os.pathsep + env.get('PATH', ''),
+        'PYTHONPATH': ROOT,
+        'YT_ENGINE_BACKEND': 'subprocess',
+        'YT_ENGINE_PREWARM': '0',
+        'YT_SEARCH_CACHE_DB': '',
+        'NSFI_CACHE_DB': '',
+        'CONVO_DB': '',
+        'RATE_LIMIT_PER_MIN': '0',  # every request comes from one caller
+        'UPSTREAM_POOL_SIZE': str(max(10, args.concurrency)),
+        'UPSTREAM_ASYNC_POOL_SIZE': str(max(10, args.concurrency)),
+    })
+
+    results = {}
+    services = {}
+    try:
+        for name in names:
+            svc_name = SCENARIOS[name][0]
+            if svc_name not in services:
+                services[svc_name] = Service(svc_name, args.server, env)
+            started = time.time()
+            results[name] = run_scenario(services[svc_name], name, args)
+            r = results[name]
+            print(f"{name:20s} {r['throughput_rps']:8.1f} rps  p50 {r['p50_ms']}ms  p95 {r['p95_ms']}ms  "
+                  f"p99 {r['p99_ms']}ms  errors {r['errors']}  rss {r['peak_rss_mb']}MB  "
+                  f"temp {r['peak_temp_mb']}MB  ({time.time() - started:.1f}s)", file=sys.stderr)
+    finally:
+        for service in services.values():
+            service.stop()
+        stub.terminate()
+        stub.wait()
+
+    report = {
+        'meta': {
+            'server': args.server, 'requests': args.requests, 'concurrency': args.concurrency,
+            'latency_ms': args.latency, 'image_bytes': args.image_bytes, 'tokens': args.tokens,
+            'token_delay_ms': args.token_delay, 'yt_bytes': args.yt_bytes, 'yt_latency_ms': args.yt_latency,
+            'python': platform.python_version(), 'cpus': os.cpu_count(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        },
+        'scenarios': results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    print(text)
+    for path in filter(None, (args.output, args.save_baseline)):
+        with open(path, 'w') as f:
+            f.write(text + '\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        settings = ('server', 'requests', 'concurrency', 'latency_ms', 'image_bytes', 'tokens', 'token_delay_ms',
+                    'yt_bytes', 'yt_latency_ms', 'cpus')
+        differs = [k for k in settings if baseline['meta'].get(k) != report['meta'][k]]
+        if differs:
+            print(f"warning: baseline was recorded with different {', '.join(differs)}", file=sys.stderr)
+        problems = compare(results, baseline['scenarios'], args.tolerance, args.min_delta_ms)
+        for problem in problems:
+            print(f"REGRESSION {problem}", file=sys.stderr)
+        if problems:
+            sys.exit(1)
+        print(f"no regressions against {args.baseline}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
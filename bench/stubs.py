@@ -0,0 +1,133 @@
+"""Local stand-ins for every upstream the two services call.
+
+One aiohttp server answers as Replicate (+ its CDN), Stability, x.ai,
+Gemini, the NSFW API, Pollinations and Google Translate TTS, after
+``--latency`` ms and with ``--image-bytes`` of image payload. The LLM
+routes stream ``--tokens`` SSE chunks ``--token-delay`` ms apart when the
+request asks for a stream.
+
+    python bench/stubs.py --port 9100 --latency 200 --image-bytes 300000
+
+``upstream_env(base)`` gives the environment that points 1.py and 2.py here.
+"""
+import os
+import json
+import base64
+import asyncio
+import argparse
+
+from aiohttp import web
+
+PNG_HEADER = b'\x89PNG\r\n\x1a\n'
+
+
+def upstream_env(base):
+    """Environment overrides that send 1.py and 2.py to the stub at ``base``."""
+    return {
+        'REPLICATE_API_URL': f"{base}/replicate/predictions",
+        'STABILITY_API_URL': f"{base}/stability/text-to-image",
+        'XAI_API_URL': f"{base}/xai/chat/completions",
+        'GEMINI_API_URL': f"{base}/gemini/models/gemini-pro:generateContent",
+        'GEMINI_STREAM_URL': f"{base}/gemini/models/gemini-pro:streamGenerateContent?alt=sse",
+        'NSFW_API_URL': f"{base}/nsfw/detect",
+        'POLLINATIONS_URL': f"{base}/pollinations",
+        'BENCH_TTS_URL': f"{base}/tts",
+        'FLUX_API_KEY': 'bench',
+        'STABLE_DIFFUSION_API_KEY': 'bench',
+        'GROK_API_KEY': 'bench',
+        'GEMINI_API_KEY': 'bench',
+        'NSFW_API_KEY': 'bench',
+    }
+
+
+def build_app(latency, image_bytes, tokens, token_delay):
+    image = PNG_HEADER + os.urandom(max(0, image_bytes - len(PNG_HEADER)))
+    image_b64 = base64.b64encode(image).decode()
+    # gTTS pulls base64 MP3 out of a batchexecute line tagged jQ1olc
+    mp3 = base64.b64encode(b'\xff\xfb\x90\x00' + os.urandom(4096)).decode()
+    tts_body = f')]}}\'\n\n[["wrb.fr","jQ1olc","[\\"{mp3}\\"]",null,null,null,"generic"]]\n'
+    words = [f"token{i} " for i in range(tokens)]
+
+    async def wait():
+        if latency:
+            await asyncio.sleep(latency / 1000)
+
+    async def replicate(request):
+        await request.read()
+        await wait()
+        return web.json_response({'output': [f"{request.scheme}://{request.host}/cdn/image.png"]})
+
+    async def cdn(request):
+        return web.Response(body=image, content_type='image/png')
+
+    async def stability(request):
+        await request.read()
+        await wait()
+        return web.json_response({'artifacts': [{'base64': image_b64}]})
+
+    async def sse(request, chunk):
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for i, word in enumerate(words):
+            if i and token_delay:
+                await asyncio.sleep(token_delay / 1000)
+            await response.write(f"data: {json.dumps(chunk(word))}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def xai(request):
+        payload = await request.json()
+        await wait()
+        if payload.get('stream'):
+            return await sse(request, lambda word: {'choices': [{'delta': {'content': word}}]})
+        return web.json_response({'choices': [{'message': {'content': ''.join(words)}}],
+                                  'usage': {'completion_tokens': tokens}})
+
+    async def gemini(request):
+        await request.read()
+        await wait()
+        if request.match_info['method'] == 'streamGenerateContent':
+            return await sse(request, lambda word: {'candidates': [{'content': {'parts': [{'text': word}]}}]})
+        return web.json_response({'candidates': [{'content': {'parts': [{'text': ''.join(words)}]}}]})
+
+    async def nsfw(request):
+        await request.read()
+        await wait()
+        return web.json_response({'is_safe': True})
+
+    async def pollinations(request):
+        await wait()
+        return web.Response(body=image, content_type='image/png')
+
+    async def tts(request):
+        await request.read()
+        await wait()
+        return web.Response(text=tts_body, content_type='application/json')
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post('/replicate/predictions', replicate)
+    app.router.add_get('/cdn/image.png', cdn)
+    app.router.add_post('/stability/text-to-image', stability)
+    app.router.add_post('/xai/chat/completions', xai)
+    app.router.add_post('/gemini/models/gemini-pro:{method}', gemini)
+    app.router.add_post('/nsfw/detect', nsfw)
+    app.router.add_get('/pollinations/prompt/{prompt:.*}', pollinations)
+    app.router.add_post('/tts/{path:.*}', tts)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--latency', type=float, default=200, help='ms before each API answers')
+    parser.add_argument('--image-bytes', type=int, default=300_000)
+    parser.add_argument('--tokens', type=int, default=50)
+    parser.add_argument('--token-delay', type=float, default=10, help='ms between streamed tokens')
+    args = parser.parse_args()
+    app = build_app(args.latency, args.image_bytes, args.tokens, args.token_delay)
+    web.run_app(app, host='127.0.0.1', port=args.port, print=None, access_log=None, backlog=4096)
+
+
+if __name__ == '__main__':
+    main()
@@ -87,7 +87,8 @@ async function generateAI(api, event, args, state) {
       mode: mode,
       prompt: prompt
     }, {
-      timeout: 420000 // 7 minutes timeout
+      timeout: 420000, // 7 minutes timeout
+      headers: { 'X-Caller-Id': threadID } // rate limited per chat
     });
 
     if (mode === 'txt') {
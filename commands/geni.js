@@ -38,13 +38,14 @@ async function generateImage(api, event, args, state) {
   api.setMessageReaction('⏳', messageID, () => {}, true);
 
   try {
+    // Ask for raw image bytes instead of base64 JSON
     const response = await axios.post(`${AI_ENGINE_LITE_URL}/generate`, {
       mode: 'img',
-      prompt: prompt
-    }, { timeout: 120000 });
+      prompt: prompt,
+      format: 'binary'
+    }, { timeout: 120000, responseType: 'arraybuffer', headers: { 'X-Caller-Id': threadID } });
 
-    const imageBase64 = response.data.image;
-    const imageBuffer = Buffer.from(imageBase64, 'base64');
+    const imageBuffer = Buffer.from(response.data);
     
     const timestamp = Date.now();
     const tempFilePath = path.join(TEMP_DIR, `geni_${senderID}_${timestamp}.png`);
@@ -71,7 +72,11 @@ async function generateImage(api, event, args, state) {
     if (error.code === 'ECONNREFUSED') {
       errorMsg += 'AI Lite Engine not running. Start: python ai_engine_lite.py';
     } else {
-      errorMsg += error.response?.data?.error || error.message;
+      let errorData = error.response?.data;
+      if (errorData && !errorData.error) {
+        try { errorData = JSON.parse(Buffer.from(errorData).toString()); } catch (_) {}
+      }
+      errorMsg += errorData?.error || error.message;
     }
     api.sendMessage(errorMsg, threadID, messageID);
   } finally {
@@ -44,7 +44,7 @@ module.exports = async function handleHelp(api, event, state, config) {
 • <agi <question> - Ask AGI
 • <geni <prompt> - Generate image
 • <cinematic <prompt> - Generate cinematic AI image
-• <tts (text) - Text to speech
+• <tts [lang=hi] (text) - Text to speech
 
 🔧 TOOLS
 • <pfp [@user] - Get profile picture
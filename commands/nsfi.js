@@ -21,7 +21,7 @@ module.exports = async function handleNSFI(api, event, args, state, config) {
     const res = await axios.post(`${AI_ENGINE_URL}/generate`, {
       mode: 'img',
       prompt
-    }, { timeout: 480000 }); // 8 min
+    }, { timeout: 480000, headers: { 'X-Caller-Id': threadID } }); // 8 min
 
     const b64 = res.data && res.data.image;
     if (!b64) throw new Error('No image returned');
@@ -5,9 +5,16 @@ const AI_ENGINE_URL = process.env.AI_ENGINE_URL || 'http://localhost:5000';
 
 module.exports = async function handleTTS(api, event, args, state) {
   const { threadID, messageID } = event;
-  const text = args.slice(1).join(' ').trim();
+  let words = args.slice(1);
+  let lang = 'en';
+  const langArg = /^lang=([a-zA-Z-]+)$/.exec(words[0] || '');
+  if (langArg) {
+    lang = langArg[1].toLowerCase();
+    words = words.slice(1);
+  }
+  const text = words.join(' ').trim();
   if (!text) {
-    return api.sendMessage('❌ Usage: <tts your text', threadID, messageID);
+    return api.sendMessage('❌ Usage: <tts [lang=hi] your text', threadID, messageID);
   }
 
   api.setMessageReaction('⏳', messageID, () => {}, true);
@@ -15,8 +22,13 @@ module.exports = async function handleTTS(api, event, args, state) {
   try {
     const res = await axios.post(`${AI_ENGINE_URL}/tts`, {
       text: text,
+      lang: lang,
       voice: 'hi-IN-SwaraNeural'
-    }, { responseType: 'arraybuffer', timeout: 120000 });
+    }, {
+      responseType: 'arraybuffer',
+      timeout: 120000,
+      headers: { 'X-Caller-Id': threadID } // rate limited per chat
+    });
 
     const tempDir = path.join(__dirname, '..', 'temp');
     if (!fs.existsSync(tempDir)) fs.mkdirSync(tempDir, { recursive: true });
@@ -30,6 +42,11 @@ module.exports = async function handleTTS(api, event, args, state) {
     api.setMessageReaction('✅', messageID, () => {}, true);
   } catch (e) {
     api.setMessageReaction('❌', messageID, () => {}, true);
+    if (e.response && e.response.status === 400) {
+      let msg = 'bad request';
+      try { msg = JSON.parse(Buffer.from(e.response.data).toString()).error || msg; } catch (_) {}
+      return api.sendMessage(`❌ TTS failed: ${msg}`, threadID, messageID);
+    }
     api.sendMessage('❌ TTS failed.', threadID, messageID);
   }
 };
@@ -3,6 +3,37 @@ const axios = require('axios');
 const fs = require('fs');
 const path = require('path');
 
+const BASE = 'http://localhost:5000';
+
+// Pipe a streamed response into filePath (appending when resuming). Rejects
+// once the file is closed, so its size is what actually arrived.
+function saveTo(res, filePath, append) {
+  return new Promise((resolve, reject) => {
+    const out = fs.createWriteStream(filePath, { flags: append ? 'a' : 'w' });
+    let received = 0;
+    let settled = false;
+    const fail = (err) => {
+      if (settled) return;
+      settled = true;
+      res.data.unpipe(out);
+      out.end();
+      if (out.closed) reject(err);
+      else out.once('close', () => reject(err));
+    };
+    res.data.on('data', (chunk) => { received += chunk.length; });
+    res.data.on('aborted', () => fail(new Error('transfer aborted')));
+    res.data.on('error', fail);
+    out.on('error', fail);
+    out.on('finish', () => {
+      const expected = Number(res.headers['content-length']);
+      if (expected && received < expected) return fail(new Error('transfer cut short'));
+      settled = true;
+      resolve();
+    });
+    res.data.pipe(out);
+  });
+}
+
 module.exports = async function yta(api, event, args, state, sendAndStoreMessage) {
   const { threadID, messageID } = event;
   const query = args.slice(1).join(' ').trim();
@@ -13,10 +44,13 @@ module.exports = async function yta(api, event, args, state, sendAndStoreMessage
 
   api.setMessageReaction('Searching', messageID);
 
+  let partPath = null;
+  const caller = { 'X-Caller-Id': threadID }; // rate limited per chat
   try {
     // SEARCH
     const searchRes = await axios.get('http://localhost:5000/yt/search', {
       params: { q: query },
+      headers: caller,
       timeout: 45000
     }).catch(() => ({ data: { results: [] } }));
 
@@ -27,32 +61,54 @@ module.exports = async function yta(api, event, args, state, sendAndStoreMessage
 
     api.setMessageReaction('Downloading', messageID);
 
-    // DOWNLOAD WITH FALLBACK
-    let downloadRes;
+    const tempDir = path.join(__dirname, '..', 'temp');
+    fs.mkdirSync(tempDir, { recursive: true });
+    partPath = path.join(tempDir, `yta_${Date.now()}.part`);
+
+    // DOWNLOAD WITH RESUME AND FALLBACK
+    let downloadRes = null;
+    let location = null;
     try {
       downloadRes = await axios.post(
-        'http://localhost:5000/yt/download',
-        { url: video.url, type: 'audio' },
-        { responseType: 'arraybuffer', timeout: 180000 }
+        `${BASE}/yt/download`,
+        { url: video.url, type: 'audio', stream: true },
+        { responseType: 'stream', timeout: 180000, headers: caller }
       );
+      location = downloadRes.headers['content-location'];
+      await saveTo(downloadRes, partPath, false);
     } catch (e) {
-      // FALLBACK: Try lower quality
-      downloadRes = await axios.post(
-        'http://localhost:5000/yt/download',
-        { url: video.url, type: 'audio' },
-        { responseType: 'arraybuffer', timeout: 180000 }
-      );
+      downloadRes = null;
+      const have = fs.existsSync(partPath) ? fs.statSync(partPath).size : 0;
+      if (location && have > 0) {
+        // RESUME: the server finishes the download anyway; fetch the rest
+        try {
+          downloadRes = await axios.get(`${BASE}${location}`, {
+            params: { wait: 60 },
+            headers: { ...caller, Range: `bytes=${have}-` },
+            responseType: 'stream',
+            timeout: 180000,
+            validateStatus: (status) => status === 200 || status === 206
+          });
+          await saveTo(downloadRes, partPath, downloadRes.status === 206);
+        } catch (err) {
+          downloadRes = null;
+        }
+      }
+      if (!downloadRes) {
+        // FALLBACK: Retry as a regular (non-streamed) download
+        downloadRes = await axios.post(
+          `${BASE}/yt/download`,
+          { url: video.url, type: 'audio' },
+          { responseType: 'stream', timeout: 180000, headers: caller }
+        );
+        await saveTo(downloadRes, partPath, false);
+      }
     }
 
-    const buffer = Buffer.from(downloadRes.data);
-    const tempDir = path.join(__dirname, '..', 'temp');
-    fs.mkdirSync(tempDir, { recursive: true });
-
     const contentType = downloadRes.headers['content-type'] || '';
     const ext = /webm/i.test(contentType) ? 'webm' : /mpeg/i.test(contentType) ? 'mp3' : 'm4a';
-    const filePath = path.join(tempDir, `yta_${Date.now()}.${ext}`);
-
-    fs.writeFileSync(filePath, buffer);
+    const filePath = partPath.replace(/\.part$/, `.${ext}`);
+    fs.renameSync(partPath, filePath);
 
     // SEND SAFELY
     const stream = fs.createReadStream(filePath);
@@ -66,6 +122,7 @@ module.exports = async function yta(api, event, args, state, sendAndStoreMessage
 
   } catch (err) {
     console.error('YTA ERROR:', err.message);
+    if (partPath) fs.unlink(partPath, () => {});
     api.setMessageReaction('Error', messageID);
     api.sendMessage(`YTA Failed: ${err.message}`, threadID);
   }
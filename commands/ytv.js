@@ -17,6 +17,7 @@ module.exports = async function ytv(api, event, args, state, sendAndStoreMessage
     // === 1. SEARCH ===
     const searchRes = await axios.get('http://localhost:5000/yt/search', {
       params: { q: query },
+      headers: { 'X-Caller-Id': threadID }, // rate limited per chat
       timeout: 45000
     }).catch(() => ({ data: { results: [] } }));
 
@@ -30,8 +31,8 @@ module.exports = async function ytv(api, event, args, state, sendAndStoreMessage
     // === 2. DOWNLOAD VIDEO ===
     const downloadRes = await axios.post(
       'http://localhost:5000/yt/download',
-      { url: video.url, type: 'video' },
-      { responseType: 'arraybuffer', timeout: 180000 }
+      { url: video.url, type: 'video', stream: true },
+      { responseType: 'arraybuffer', timeout: 180000, headers: { 'X-Caller-Id': threadID } }
     );
 
     const buffer = Buffer.from(downloadRes.data);
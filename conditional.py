@@ -0,0 +1,97 @@
+import os
+from datetime import datetime, timezone
+
+from flask import Response, request
+
+from metrics import timed_stream
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_etag(tag, stat):
+    """Strong ETag for a file: ``tag`` plus its mtime and size. Stores
+    replace files rather than rewrite them, so new content means new values."""
+    return f"{tag}-{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+
+def not_modified(etag, last_modified):
+    """True if the client's copy is current (If-None-Match, else If-Modified-Since)."""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    return since is not None and last_modified <= since
+
+
+def byte_range(etag, last_modified, size):
+    """``(start, stop)`` for a single satisfiable byte range, None to send the
+    whole file (no Range, several ranges, or a stale If-Range), False if the
+    range can't be satisfied."""
+    requested = request.range
+    if requested is None or requested.units != 'bytes' or len(requested.ranges) != 1 or not size:
+        return None
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and if_range.date != last_modified:
+        return None
+    return requested.range_for_length(size) or False
+
+
+def file_response(path, mimetype, tag, name, headers=None, on_close=None):
+    """Stream ``path`` with ETag and Last-Modified. GET and HEAD requests also
+    get 304s (If-None-Match / If-Modified-Since) and single-range 206s (Range,
+    If-Range); other methods always get the whole file. ``on_close`` runs
+    once the response is done, whatever was sent. Raises OSError if the file
+    can't be opened."""
+    f = open(path, 'rb')
+    try:
+        stat = os.fstat(f.fileno())
+    except OSError:
+        f.close()
+        raise
+    size = stat.st_size
+    etag = file_etag(tag, stat)
+    last_modified = datetime.fromtimestamp(int(stat.st_mtime), timezone.utc)
+    start, stop = 0, size
+    status = 200
+    if request.method in ('GET', 'HEAD'):
+        if not_modified(etag, last_modified):
+            status = 304
+        else:
+            found = byte_range(etag, last_modified, size)
+            if found is False:
+                status = 416
+            elif found is not None:
+                status = 206
+                start, stop = found
+
+    def stream():
+        with f:
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0 and (chunk := f.read(min(CHUNK_SIZE, remaining))):
+                remaining -= len(chunk)
+                yield chunk
+
+    if status in (304, 416):
+        f.close()
+        resp = Response(status=status, headers=headers)
+        if status == 416:
+            resp.headers['Content-Range'] = f"bytes */{size}"
+    else:
+        resp = Response(timed_stream(stream(), name), status=status, mimetype=mimetype, headers=headers)
+        resp.headers['Content-Length'] = str(stop - start)
+        if status == 206:
+            resp.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+    resp.set_etag(etag)
+    resp.last_modified = last_modified
+    if request.method in ('GET', 'HEAD'):
+        resp.headers['Accept-Ranges'] = 'bytes'
+
+    @resp.call_on_close
+    def _close():
+        f.close()  # never iterated, e.g. HEAD
+        if on_close is not None:
+            on_close()
+
+    return resp
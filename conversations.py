@@ -0,0 +1,81 @@
+import math
+import uuid
+import threading
+
+from ttl_cache import TTLCache
+
+MESSAGE_OVERHEAD = 4  # role and separators, roughly, per message
+
+
+def estimate_tokens(text):
+    """Cheap token estimate: ~4 bytes of UTF-8 per token. Counting bytes rather
+    than characters keeps Bengali/Hindi text from being badly undercounted."""
+    return math.ceil(len(text.encode('utf-8')) / 4) + MESSAGE_OVERHEAD
+
+
+def conversation_key(conversation_id=None, thread_id=None, sender_id=None):
+    """Explicit id first, then thread + sender; otherwise a new id."""
+    if conversation_id:
+        return str(conversation_id)
+    if thread_id:
+        return f"{thread_id}:{sender_id}" if sender_id else str(thread_id)
+    return uuid.uuid4().hex
+
+
+class ConversationStore:
+    """Chat histories keyed by conversation id.
+
+    Active conversations live in an LRU of ``maxsize`` entries (optionally
+    persisted to SQLite) and expire after ``idle_ttl`` seconds without a new
+    turn. Each history is trimmed oldest-turn-first to ``max_tokens``, so the
+    prompt sent upstream stays the same size however long a chat runs.
+    """
+
+    def __init__(self, maxsize=5000, idle_ttl=1800, db_path=None, max_tokens=3000, system_prompt=None):
+        self.max_tokens = max_tokens
+        self.system_prompt = system_prompt or None
+        self._cache = TTLCache('conversations', maxsize=maxsize, ttl=idle_ttl, db_path=db_path)
+        self._lock = threading.Lock()
+        self._stats = {'turns': 0, 'trimmed_messages': 0}
+
+    def history(self, key):
+        found, convo = self._cache.get(key)
+        return list(convo['messages']) if found and convo else []
+
+    def messages_for(self, key, prompt):
+        """Upstream ``messages``: system prompt, the stored history and ``prompt``,
+        dropping the oldest turns if the total would go over the budget."""
+        head = [{'role': 'system', 'content': self.system_prompt}] if self.system_prompt else []
+        turn = [{'role': 'user', 'content': prompt}]
+        budget = self.max_tokens - sum(estimate_tokens(m['content']) for m in head + turn)
+        return head + self._trim(self.history(key), budget) + turn
+
+    def append(self, key, prompt, reply):
+        with self._lock:
+            history = self.history(key)
+            history += [{'role': 'user', 'content': prompt}, {'role': 'assistant', 'content': reply}]
+            kept = self._trim(history, self.max_tokens)
+            self._stats['turns'] += 1
+            self._stats['trimmed_messages'] += len(history) - len(kept)
+            self._cache.set(key, {'messages': kept})
+        return len(kept)
+
+    def reset(self, key):
+        self._cache.delete(key)
+
+    @staticmethod
+    def _trim(messages, budget):
+        # Drop whole user/assistant pairs from the front until it fits
+        costs = [estimate_tokens(m['content']) for m in messages]
+        start, total = 0, sum(costs)
+        while total > budget and start < len(messages):
+            drop = 2 if start + 1 < len(messages) else 1
+            total -= sum(costs[start:start + drop])
+            start += drop
+        return messages[start:]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(max_tokens=self.max_tokens, cache=self._cache.stats())
+        return stats
@@ -0,0 +1,294 @@
+import os
+import time
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from admission import concurrency_limit
+from metrics import ADMISSION_REJECTED, STAGE_SECONDS, UPSTREAM_RESPONSES
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+# A POST may have been acted on already; retry it only when the upstream
+# says it wasn't (these, with a Retry-After)
+POST_RETRY_STATUSES = {429, 503}
+
+
+class UpstreamUnavailable(Exception):
+    """Raised without touching the network while an upstream's circuit is
+    open, or while it's at its concurrency cap (``reason='at capacity'``)."""
+
+    def __init__(self, name, retry_after, reason='unavailable'):
+        super().__init__(f"{name} is {reason}, retry in {int(retry_after) + 1}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Opens after ``threshold`` consecutive failures; after ``reset_timeout``
+    seconds one trial request is let through (half-open) to probe recovery."""
+
+    def __init__(self, name, threshold=5, reset_timeout=30):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        """Return 0 if the call may proceed, else seconds until the next probe."""
+        return self.admit()[0]
+
+    def admit(self):
+        """``before_request`` plus whether the call is the half-open trial,
+        which must end with ``record_*`` or ``end_trial``."""
+        with self._lock:
+            if self.state == 'closed':
+                return 0, False
+            remaining = self.opened_at + self.reset_timeout - time.time()
+            if remaining > 0:
+                return remaining, False
+            if self._trial_in_flight:
+                return 1, False
+            self.state = 'half_open'
+            self._trial_in_flight = True
+            return 0, True
+
+    def end_trial(self):
+        """Let another call probe if the trial ended without an outcome
+        (an unexpected error, a cancelled coroutine)."""
+        with self._lock:
+            if self.state == 'half_open':
+                self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == 'half_open' or self.failures >= self.threshold:
+                if self.state != 'open':
+                    logger.warning(f"{self.name}: circuit opened after {self.failures} failure(s)")
+                self.state = 'open'
+                self.opened_at = time.time()
+
+
+def upstream_setting(name, key, default, cast=float):
+    return cast(os.getenv(f"UPSTREAM_{name.upper()}_{key}", os.getenv(f"UPSTREAM_{key}", default)))
+
+
+class Upstream:
+    """Keep-alive HTTP client for one upstream API.
+
+    Wraps a ``requests.Session`` with its own connection pool, a default
+    timeout, retries with exponential backoff on connection errors and
+    429/5xx (honouring ``Retry-After`` up to ``max_retry_wait``; a POST only
+    when it never got through, or on 429/503 with ``Retry-After``), and a
+    circuit breaker. At most MAX_CONCURRENCY calls (default: the pool size)
+    are in flight; past that, callers queue for up to QUEUE_TARGET seconds
+    or are shed with ``UpstreamUnavailable`` (see ``ConcurrencyLimit``). A
+    ``stream=True`` response holds its slot until it's closed.
+
+    Every knob can be overridden per upstream through
+    ``UPSTREAM_<NAME>_<KNOB>`` or for all upstreams through ``UPSTREAM_<KNOB>``
+    (TIMEOUT, POOL_SIZE, RETRIES, BACKOFF, MAX_RETRY_WAIT,
+    BREAKER_THRESHOLD, BREAKER_RESET, MAX_CONCURRENCY, QUEUE_TARGET).
+    """
+
+    def __init__(self, name, timeout=30, pool_size=10, retries=2, backoff=0.5,
+                 max_retry_wait=10, breaker_threshold=5, breaker_reset=30, queue_target=5):
+        self.name = name
+        self.timeout = upstream_setting(name, 'TIMEOUT', timeout)
+        self.retries = upstream_setting(name, 'RETRIES', retries, int)
+        self.backoff = upstream_setting(name, 'BACKOFF', backoff)
+        self.max_retry_wait = upstream_setting(name, 'MAX_RETRY_WAIT', max_retry_wait)
+        pool_size = upstream_setting(name, 'POOL_SIZE', pool_size, int)
+        self.breaker = CircuitBreaker(
+            name,
+            upstream_setting(name, 'BREAKER_THRESHOLD', breaker_threshold, int),
+            upstream_setting(name, 'BREAKER_RESET', breaker_reset),
+        )
+        self.limit = upstream_limit(name, pool_size, queue_target)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'retries': 0, 'failures': 0, 'rejected': 0, 'shed': 0}
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        retry_after = self.limit.acquire()
+        if retry_after:
+            with self._lock:
+                self._stats['shed'] += 1
+            ADMISSION_REJECTED.inc(self.name, 'capacity')
+            raise UpstreamUnavailable(self.name, retry_after, 'at capacity')
+        retry_after, trial = self.breaker.admit()
+        if retry_after:
+            self.limit.release()
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise UpstreamUnavailable(self.name, retry_after)
+
+        acquired = time.monotonic()
+        try:
+            response = self._send(method, url, **kwargs)
+        except BaseException:
+            self.limit.release(time.monotonic() - acquired)
+            raise
+        finally:
+            if trial:
+                self.breaker.end_trial()
+        if kwargs.get('stream'):
+            release_on_close(response, 'close', self.limit, acquired)
+        else:
+            self.limit.release(time.monotonic() - acquired)
+        return response
+
+    def _send(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            with self._lock:
+                self._stats['requests'] += 1
+            _rewind_files(kwargs)
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.ConnectionError as e:
+                self._observe(start, 'error')
+                # Timeouts are not retried: that would multiply the worst case.
+                # A POST only is when it never reached the upstream.
+                if attempt < self.retries and not isinstance(e, requests.Timeout) and \
+                        (method.upper() in IDEMPOTENT or _never_sent(e)):
+                    attempt += 1
+                    self._sleep_before_retry(attempt, None)
+                    continue
+                self._failed()
+                raise
+            except requests.RequestException:
+                self._observe(start, 'error')
+                self._failed()
+                raise
+            self._observe(start, response.status_code)
+
+            if response.status_code in RETRY_STATUSES and attempt < self.retries:
+                wait = retry_after_seconds(response)
+                if retryable(method, response.status_code, wait, self.max_retry_wait):
+                    attempt += 1
+                    response.close()
+                    self._sleep_before_retry(attempt, wait)
+                    continue
+
+            if response.status_code >= 500:
+                self._failed()
+            else:
+                self.breaker.record_success()
+            return response
+
+    def _observe(self, start, status):
+        STAGE_SECONDS.observe(time.perf_counter() - start, 'upstream_http', self.name)
+        UPSTREAM_RESPONSES.inc(self.name, str(status))
+
+    def _sleep_before_retry(self, attempt, retry_after):
+        with self._lock:
+            self._stats['retries'] += 1
+        delay = retry_after if retry_after is not None else self.backoff * (2 ** (attempt - 1))
+        time.sleep(min(delay, self.max_retry_wait))
+
+    def _failed(self):
+        with self._lock:
+            self._stats['failures'] += 1
+        self.breaker.record_failure()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update({'circuit': self.breaker.state, 'consecutive_failures': self.breaker.failures,
+                      'timeout': self.timeout, 'in_flight': self.limit.active, 'queued': self.limit.waiting})
+        return stats
+
+
+def upstream_limit(name, pool_size, queue_target):
+    """The concurrency cap for upstream ``name``, shared with ``AsyncUpstream``."""
+    return concurrency_limit(
+        name,
+        upstream_setting(name, 'MAX_CONCURRENCY', upstream_setting(name, 'POOL_SIZE', pool_size, int), int),
+        upstream_setting(name, 'QUEUE_TARGET', queue_target),
+    )
+
+
+def release_on_close(response, method, limit, acquired):
+    """Hold ``limit``'s slot until ``response.<method>()`` is first called."""
+    close = getattr(response, method)
+    released = False
+
+    def close_and_release(*args, **kwargs):
+        nonlocal released
+        try:
+            return close(*args, **kwargs)
+        finally:
+            if not released:
+                released = True
+                limit.release(time.monotonic() - acquired)
+
+    setattr(response, method, close_and_release)
+
+
+def retryable(method, status, retry_after, max_retry_wait):
+    """Whether a retryable ``status`` answer to ``method`` is worth another
+    attempt: not when Retry-After is too far off, nor for a non-idempotent
+    request unless the upstream asked for the retry."""
+    if retry_after is not None and retry_after > max_retry_wait:
+        return False
+    if method.upper() in IDEMPOTENT:
+        return True
+    return status in POST_RETRY_STATUSES and retry_after is not None
+
+
+def _never_sent(e):
+    # requests wraps urllib3's MaxRetryError, whose reason says what failed
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def retry_after_seconds(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _rewind_files(kwargs):
+    # Retries must resend file uploads from the start
+    for value in (kwargs.get('files') or {}).values():
+        fileobj = value[1] if isinstance(value, tuple) else value
+        if hasattr(fileobj, 'seek'):
+            fileobj.seek(0)
@@ -0,0 +1,533 @@
+import os
+import json
+import math
+import time
+import uuid
+import heapq
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+
+from flask import request, jsonify, send_file
+
+from temp_store import TempQuotaExceeded, pid_alive
+
+logger = logging.getLogger(__name__)
+
+FINISHED = ('done', 'failed', 'cancelled', 'expired')
+
+_current = threading.local()  # .job: the Job whose handler runs on this thread
+
+
+class QueueFull(Exception):
+    def __init__(self, queue, eta):
+        super().__init__(f"{queue} queue is full")
+        self.queue = queue
+        self.eta = eta
+
+
+class Job:
+    def __init__(self, queue, fn, priority):
+        self.id = uuid.uuid4().hex
+        self.queue = queue
+        self.fn = fn
+        self.priority = priority
+        self.status = 'queued'
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None  # {'path', 'mimetype', 'headers'} once done
+        self.error = None
+        self.status_code = None
+        self.owner = None  # pid of the worker running it, when that isn't this one
+        self.done = threading.Event()
+        self.cancel_hooks = []
+
+    @classmethod
+    def restore(cls, info, result, owner):
+        """Read-only copy of a job another worker runs, from its stored state."""
+        job = cls(info['queue'], None, info['priority'])
+        job.id = info['job_id']
+        for field in ('status', 'created', 'started', 'finished'):
+            setattr(job, field, info[field])
+        job.error = info.get('error')
+        job.status_code = info.get('status_code')
+        job.result = result
+        job.owner = owner
+        if job.status in FINISHED:
+            job.done.set()
+        return job
+
+    @property
+    def cancelled(self):
+        return self.status == 'cancelled'
+
+    def to_dict(self, eta=None):
+        info = {
+            'job_id': self.id,
+            'queue': self.queue,
+            'status': self.status,
+            'priority': self.priority,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+        if self.error is not None:
+            info['error'] = self.error
+            info['status_code'] = self.status_code
+        if eta is not None:
+            info['eta'] = eta
+        return info
+
+
+class JobQueue:
+    """Priority queue with its own fixed set of worker threads."""
+
+    def __init__(self, scheduler, name, concurrency, max_queued):
+        self.scheduler = scheduler
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        self.running = 0
+        self.avg_duration = None  # EWMA of run time, seconds
+        self.stats = {'submitted': 0, 'rejected': 0, 'done': 0, 'failed': 0, 'cancelled': 0, 'expired': 0}
+        self._heap = []
+        self._seq = 0
+        self._cond = threading.Condition(scheduler.lock)
+        for i in range(concurrency):
+            threading.Thread(target=self._work, name=f"jobs-{name}-{i}", daemon=True).start()
+
+    def eta(self, position=None):
+        """Rough seconds until a job at ``position`` (default: the back) finishes."""
+        avg = self.avg_duration or 30.0
+        ahead = len(self._heap) if position is None else position
+        return round((ahead // self.concurrency + 1) * avg, 1)
+
+    def push(self, job):
+        # Caller holds the scheduler lock
+        if len(self._heap) >= self.max_queued:
+            self.stats['rejected'] += 1
+            raise QueueFull(self.name, self.eta())
+        self._seq += 1
+        heapq.heappush(self._heap, (job.priority, self._seq, job))
+        self.stats['submitted'] += 1
+        self._cond.notify()
+
+    def discard(self, job):
+        # Caller holds the scheduler lock. Cancelled and expired jobs leave
+        # the heap right away so they don't count against max_queued or ETAs.
+        self._heap = [item for item in self._heap if item[2] is not job]
+        heapq.heapify(self._heap)
+
+    def position(self, job):
+        ranked = sorted(self._heap)
+        for i, (_, _, queued) in enumerate(ranked):
+            if queued is job:
+                return i
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                _, _, job = heapq.heappop(self._heap)
+                if job.status != 'queued':
+                    continue  # cancelled or expired while waiting
+                job.status = 'running'
+                job.started = time.time()
+                self.running += 1
+                self.scheduler._save(job)
+            self.scheduler._execute(self, job)
+
+
+class JobScheduler:
+    """Runs slow request handlers in the background.
+
+    Each queue has a fixed concurrency and a cap on waiting jobs; submitting
+    to a full queue raises ``QueueFull`` with an ETA instead of blocking.
+    Results are spooled to ``spool_dir`` (or to ``temp``, a ``TempStore``,
+    where they count against its quota and may be evicted once unread) and
+    kept for ``result_ttl`` seconds; jobs still queued after
+    ``queue_timeout`` seconds expire.
+
+    With ``db_path`` every job's state is also written to SQLite, so workers
+    sharing the file can answer polls and result fetches for each other's
+    jobs; cancelling one is passed on to the worker running it.
+    """
+
+    def __init__(self, spool_dir, result_ttl=600, queue_timeout=300, cleanup=None, temp=None, db_path=None):
+        self.spool_dir = spool_dir
+        self.temp = temp
+        self.result_ttl = result_ttl
+        self.queue_timeout = queue_timeout
+        self.cleanup = cleanup or _remove
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.jobs = {}
+        self.db_path = db_path or None
+        self._db = None
+        self._db_lock = threading.Lock()
+        if self.db_path:
+            self._open_db()
+        threading.Thread(target=self._janitor, name='jobs-janitor', daemon=True).start()
+        if self._db is not None:
+            threading.Thread(target=self._watch_cancels, name='jobs-cancels', daemon=True).start()
+
+    # --- Shared state (SQLite) ---
+    def _open_db(self):
+        try:
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id TEXT PRIMARY KEY, pid INTEGER NOT NULL, info TEXT NOT NULL, result TEXT, '
+                'cancel INTEGER NOT NULL DEFAULT 0, updated REAL NOT NULL)'
+            )
+            # Left by an earlier process that had our pid
+            self._db.execute('DELETE FROM jobs WHERE pid = ?', (os.getpid(),))
+            self._db.commit()
+            logger.info(f"Jobs: shared state at {self.db_path}")
+        except Exception as e:
+            logger.error(f"Jobs: disabling shared state ({str(e)})")
+            self._db = None
+
+    def _query(self, sql, args=()):
+        if self._db is None:
+            return []
+        try:
+            with self._db_lock:
+                rows = self._db.execute(sql, args).fetchall()
+                self._db.commit()
+            return rows
+        except Exception as e:
+            logger.error(f"Jobs: shared state error: {str(e)}")
+            return []
+
+    def _save(self, job):
+        # Caller holds the scheduler lock, so saves land in order. Keeps a
+        # pending cancel request from another worker.
+        self._query(
+            'INSERT INTO jobs (id, pid, info, result, updated) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT(id) DO UPDATE SET info = excluded.info, result = excluded.result, updated = excluded.updated',
+            (job.id, os.getpid(), json.dumps(job.to_dict()), json.dumps(job.result), time.time())
+        )
+
+    def _load(self, job_id):
+        rows = self._query('SELECT pid, info, result FROM jobs WHERE id = ?', (job_id,))
+        if not rows:
+            return None
+        pid, info, result = rows[0]
+        job = Job.restore(json.loads(info), json.loads(result), pid)
+        if job.status not in FINISHED and not pid_alive(pid):
+            job.status = 'failed'
+            job.error = 'the worker running this job exited'
+            job.status_code = 503
+            job.done.set()
+        return job
+
+    def _watch_cancels(self):
+        # Cancels sent to other workers for jobs running here
+        while True:
+            time.sleep(1)
+            with self.lock:
+                pending = any(job.status not in FINISHED for job in self.jobs.values())
+            if not pending:
+                continue
+            for (job_id,) in self._query('SELECT id FROM jobs WHERE pid = ? AND cancel = 1', (os.getpid(),)):
+                job = self.get(job_id)
+                if job is not None and job.owner is None:
+                    self.cancel(job)
+
+    def add_queue(self, name, concurrency, max_queued):
+        concurrency = int(os.getenv(f"JOBS_{name.upper()}_CONCURRENCY", concurrency))
+        max_queued = int(os.getenv(f"JOBS_{name.upper()}_QUEUE", max_queued))
+        with self.lock:
+            self.queues[name] = JobQueue(self, name, concurrency, max_queued)
+
+    def submit(self, queue, fn, priority=5):
+        """Queue ``fn(job)``; it must return a Flask response."""
+        job = Job(queue, fn, priority)
+        with self.lock:
+            self.queues[queue].push(job)
+            self.jobs[job.id] = job
+            self._save(job)
+        return job
+
+    def get(self, job_id):
+        """The job, or a snapshot of it if another worker runs it."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            job = self._load(job_id)
+        return job
+
+    def wait(self, job, timeout):
+        """Wait up to ``timeout`` seconds for ``job`` to finish; returns its latest state."""
+        if job.owner is None:
+            job.done.wait(timeout)
+            return job
+        deadline = time.time() + timeout
+        while job.status not in FINISHED and time.time() < deadline:
+            time.sleep(min(0.5, deadline - time.time()))
+            job = self._load(job.id) or job
+        return job
+
+    def cancel(self, job):
+        if job.owner is not None:
+            if job.status in FINISHED:
+                return False
+            self._query('UPDATE jobs SET cancel = 1 WHERE id = ?', (job.id,))
+            return True
+        with self.lock:
+            if job.status in FINISHED:
+                return False
+            was_running = job.status == 'running'
+            job.status = 'cancelled'
+            job.finished = time.time()
+            if not was_running:
+                self.queues[job.queue].discard(job)
+            self.queues[job.queue].stats['cancelled'] += 1
+            self._save(job)
+            hooks = list(job.cancel_hooks)
+        if not was_running:
+            job.done.set()
+        for hook in hooks:
+            try:
+                hook()
+            except Exception as e:
+                logger.error(f"Job {job.id} cancel hook failed: {str(e)}")
+        return True
+
+    def eta(self, job):
+        if job.owner is not None:
+            return None
+        with self.lock:
+            queue = self.queues[job.queue]
+            if job.status == 'queued':
+                return queue.eta(queue.position(job))
+            if job.status == 'running' and queue.avg_duration:
+                return round(max(0.0, job.started + queue.avg_duration - time.time()), 1)
+        return None
+
+    def _execute(self, queue, job):
+        spool_path = None
+        _current.job = job
+        try:
+            response = job.fn(job)
+            try:
+                if response.status_code >= 400:
+                    body = response.get_json(silent=True) or {}
+                    job.error = body.get('error') or response.status
+                    job.status_code = response.status_code
+                else:
+                    if self.temp is not None:
+                        spool_path = self.temp.path('job', owner=f"jobs/{queue.name}")
+                    else:
+                        spool_path = os.path.join(self.spool_dir, f"job_{job.id}")
+                    with open(spool_path, 'wb') as f:
+                        for chunk in response.response:
+                            if job.cancelled:
+                                break
+                            f.write(chunk)
+                    if self.temp is not None:
+                        self.temp.resize(spool_path)
+                        self.temp.unpin(spool_path)
+                    job.result = {
+                        'path': spool_path,
+                        'mimetype': response.mimetype,
+                        'headers': {k: v for k, v in response.headers.items()
+                                    if k == 'Content-Disposition' or k.startswith('X-')},
+                    }
+            finally:
+                response.close()
+        except TempQuotaExceeded as e:
+            logger.warning(f"Job {job.id} ({queue.name}) could not spool its result: {str(e)}")
+            job.error = str(e)
+            job.status_code = 503
+        except Exception as e:
+            logger.error(f"Job {job.id} ({queue.name}) crashed: {str(e)}")
+            job.error = str(e)
+            job.status_code = 500
+        finally:
+            _current.job = None
+
+        with self.lock:
+            queue.running -= 1
+            duration = time.time() - job.started
+            queue.avg_duration = duration if queue.avg_duration is None else \
+                0.8 * queue.avg_duration + 0.2 * duration
+            if job.status == 'cancelled':
+                discard = spool_path
+                job.result = None
+            else:
+                # A spool file left behind by a failed job is never served
+                discard = spool_path if job.error is not None else None
+                job.status = 'failed' if job.error is not None else 'done'
+                job.finished = time.time()
+                queue.stats[job.status] += 1
+            self._save(job)
+        if discard:
+            self.cleanup(discard)
+        job.done.set()
+        logger.info(f"Job {job.id} ({queue.name}) {job.status} in {duration:.1f}s")
+
+    def _janitor(self):
+        while True:
+            time.sleep(15)
+            now = time.time()
+            discard = []
+            forgotten = []
+            with self.lock:
+                for job_id, job in list(self.jobs.items()):
+                    if job.status == 'queued' and now - job.created > self.queue_timeout:
+                        job.status = 'expired'
+                        job.finished = now
+                        self.queues[job.queue].discard(job)
+                        self.queues[job.queue].stats['expired'] += 1
+                        job.done.set()
+                        self._save(job)
+                    elif job.status in FINISHED and now - job.finished > self.result_ttl:
+                        del self.jobs[job_id]
+                        forgotten.append(job_id)
+                        if job.result:
+                            discard.append(job.result['path'])
+            for job_id in forgotten:
+                self._query('DELETE FROM jobs WHERE id = ?', (job_id,))
+            # Rows left behind by workers that exited
+            self._query('DELETE FROM jobs WHERE updated < ?', (now - 86400,))
+            for path in discard:
+                self.cleanup(path)
+
+    def stats(self):
+        with self.lock:
+            return {
+                name: dict(q.stats, queued=len(q._heap), running=q.running, concurrency=q.concurrency,
+                           max_queued=q.max_queued, avg_duration=q.avg_duration)
+                for name, q in self.queues.items()
+            }
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+@contextmanager
+def on_job_cancel(hook):
+    """Call ``hook()`` if the background job running this block is cancelled
+    meanwhile. Outside a job it does nothing."""
+    job = getattr(_current, 'job', None)
+    if job is None:
+        yield
+        return
+    job.cancel_hooks.append(hook)
+    try:
+        if job.cancelled:
+            hook()
+        yield
+    finally:
+        job.cancel_hooks.remove(hook)
+
+
+def wait_arg():
+    """``?wait=`` in seconds (capped at 60), or None if it isn't a number."""
+    try:
+        wait = float(request.args.get('wait', 0) or 0)
+    except ValueError:
+        return None
+    if math.isnan(wait):
+        return None
+    return min(max(wait, 0.0), 60.0)
+
+
+def submit_replay(app, scheduler, name, path, view, data, priority=5):
+    """Queue ``data`` to be replayed as a POST against ``view`` on the ``name``
+    queue. Returns the 202 response (with the job) or a 429 if the queue is full."""
+
+    def run(job):
+        with app.test_request_context(path, method='POST', json=data):
+            return app.make_response(view())
+
+    try:
+        job = scheduler.submit(name, run, priority)
+    except QueueFull as e:
+        resp = jsonify({'error': str(e), 'eta': e.eta})
+        resp.status_code = 429
+        resp.headers['Retry-After'] = str(int(e.eta) + 1)
+        return resp
+    resp = jsonify(job.to_dict(eta=scheduler.eta(job)))
+    resp.status_code = 202
+    resp.headers['Location'] = f"/jobs/{job.id}"
+    return resp
+
+
+def register_job_routes(app, scheduler, endpoints):
+    """Expose ``POST /jobs/<name>`` for each ``name -> view`` in ``endpoints``
+    plus status, long-poll, result and cancel routes. A job replays the
+    submitted JSON body against the regular view, so behaviour is identical
+    to the synchronous endpoint."""
+
+    @app.route('/jobs/<name>', methods=['POST'])
+    def submit_job(name):
+        if name not in endpoints:
+            return jsonify({'error': f'unknown job type: {name}'}), 404
+        data = request.get_json(silent=True) or {}
+        path, view = endpoints[name]
+        try:
+            priority = int(data.get('priority', request.headers.get('X-Priority', 5)))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'priority must be an integer'}), 400
+        return submit_replay(app, scheduler, name, path, view, data, priority)
+
+    @app.route('/jobs/<job_id>', methods=['GET'])
+    def job_status(job_id):
+        wait = wait_arg()
+        if wait is None:
+            return jsonify({'error': 'wait must be a number of seconds'}), 400
+        job = scheduler.get(job_id)
+        if job is None:
+            return jsonify({'error': 'unknown or expired job'}), 404
+        if wait > 0:
+            job = scheduler.wait(job, wait)
+        return jsonify(job.to_dict(eta=scheduler.eta(job)))
+
+    @app.route('/jobs/<job_id>/result', methods=['GET'])
+    def job_result(job_id):
+        wait = wait_arg()
+        if wait is None:
+            return jsonify({'error': 'wait must be a number of seconds'}), 400
+        job = scheduler.get(job_id)
+        if job is None:
+            return jsonify({'error': 'unknown or expired job'}), 404
+        if wait > 0:
+            job = scheduler.wait(job, wait)
+        if job.status == 'failed':
+            return jsonify({'error': job.error}), job.status_code or 500
+        if job.status != 'done':
+            return jsonify(job.to_dict(eta=scheduler.eta(job))), 409 if job.status in FINISHED else 202
+        if not os.path.exists(job.result['path']):
+            return jsonify({'error': 'result was evicted to free temp space'}), 410
+        resp = send_file(job.result['path'], mimetype=job.result['mimetype'])
+        resp.headers.update(job.result['headers'])
+        return resp
+
+    @app.route('/jobs/<job_id>', methods=['DELETE'])
+    def cancel_job(job_id):
+        job = scheduler.get(job_id)
+        if job is None:
+            return jsonify({'error': 'unknown or expired job'}), 404
+        if scheduler.cancel(job) and job.owner is not None:
+            # The worker running it picks the request up within a second or so
+            job = scheduler.wait(job, 2)
+        return jsonify(job.to_dict())
+
+    @app.route('/jobs/stats', methods=['GET'])
+    def jobs_stats():
+        return jsonify(scheduler.stats())
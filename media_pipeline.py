@@ -0,0 +1,334 @@
+import io
+import os
+import time
+import asyncio
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from metrics import MEDIA_BYTES_SAVED, MEDIA_ENCODED, STAGE_SECONDS
+from startup import lazy_import, preload
+
+Image = lazy_import('PIL.Image')
+
+logger = logging.getLogger(__name__)
+
+# format -> (Pillow format, mimetype, file extension)
+FORMATS = {
+    'png': ('PNG', 'image/png', 'png'),
+    'jpeg': ('JPEG', 'image/jpeg', 'jpg'),
+    'webp': ('WEBP', 'image/webp', 'webp'),
+}
+ALIASES = {'jpg': 'jpeg', 'original': 'original'}
+MIN_QUALITY = 40
+MIN_SIDE = 16
+
+
+def parse_options(data, defaults):
+    """Post-processing options from a request body, over ``defaults``:
+    ``image_format`` (original / png / jpeg / webp), ``max_side`` (pixels,
+    0: any), ``max_kb`` (can only lower the default budget), ``quality``
+    (1-100) and ``thumbnail`` (true or a side in pixels). ValueError on
+    anything else."""
+    options = dict(defaults)
+    fmt = data.get('image_format')
+    if fmt is not None:
+        fmt = ALIASES.get(str(fmt).lower(), str(fmt).lower())
+        if fmt != 'original' and fmt not in FORMATS:
+            raise ValueError(f"image_format must be one of original, {', '.join(FORMATS)}")
+        options['format'] = fmt
+    if data.get('max_side') is not None:
+        options['max_side'] = _int_option(data, 'max_side', 0, 8192)
+        if 0 < options['max_side'] < MIN_SIDE:
+            raise ValueError(f"max_side must be 0 or at least {MIN_SIDE}")
+    if data.get('max_kb') is not None:
+        options['max_bytes'] = min(options['max_bytes'], _int_option(data, 'max_kb', 1, 1 << 20) * 1024)
+    if data.get('quality') is not None:
+        options['quality'] = _int_option(data, 'quality', 1, 100)
+    thumbnail = data.get('thumbnail')
+    if thumbnail is True:
+        options['thumbnail'] = defaults['thumbnail_side']
+    elif thumbnail not in (None, False):
+        options['thumbnail'] = _int_option(data, 'thumbnail', 0, 1024)
+    return options
+
+
+def _int_option(data, name, low, high):
+    value = data[name]
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"{name} must be an integer")
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer") from None
+    if not low <= value <= high:
+        raise ValueError(f"{name} must be between {low} and {high}")
+    return value
+
+
+def requested(options):
+    """True if the options change the image whatever its size."""
+    return options['format'] != 'original' or bool(options['max_side']) or bool(options.get('thumbnail'))
+
+
+def needed(options, size):
+    """True if an image of ``size`` bytes has to go through the pipeline."""
+    return requested(options) or size > options['max_bytes']
+
+
+def _encode(img, fmt, quality):
+    out = io.BytesIO()
+    if fmt == 'jpeg':
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.save(out, 'JPEG', quality=quality, optimize=True, progressive=True)
+    elif fmt == 'webp':
+        img.save(out, 'WEBP', quality=quality, method=4)
+    else:
+        img.save(out, 'PNG', optimize=True)
+    return out.getvalue()
+
+
+def process_image(data, options):
+    """Re-encode ``data`` per ``options``; runs in a pool worker.
+
+    The image is scaled down to ``max_side``, encoded, and then, while it's
+    over ``max_bytes``, re-encoded at a lower quality (lossy formats, down to
+    MIN_QUALITY) and after that at a smaller scale. An image that needs no
+    change comes back as the original bytes. Returns ``(bytes, info)``.
+    """
+    with Image.open(io.BytesIO(data)) as source:
+        source_format = (source.format or '').lower()
+        fmt = options['format']
+        if fmt == 'original':
+            fmt = source_format if source_format in FORMATS else 'png'
+        max_side = options['max_side']
+        original_size = source.size
+        if max_side:
+            source.draft('RGB', (max_side, max_side))  # JPEG: decode at reduced scale
+        source.load()
+        width, height = source.size
+        scale = min(1.0, max_side / max(width, height)) if max_side else 1.0
+        img = _scaled(source, scale)
+        quality = options['quality']
+
+        if fmt == source_format and img.size == original_size and len(data) <= options['max_bytes']:
+            encoded = data
+        else:
+            encoded = _encode(img, fmt, quality)
+        while len(encoded) > options['max_bytes']:
+            if fmt != 'png' and quality > MIN_QUALITY:
+                quality = max(MIN_QUALITY, quality - 10)
+            else:
+                # Area shrinks with the square of the scale; aim a little under budget
+                scale *= max(0.5, min(0.9, (options['max_bytes'] / len(encoded)) ** 0.5 * 0.95))
+                if min(width, height) * scale < MIN_SIDE:
+                    break
+                img = _scaled(source, scale)
+            encoded = _encode(img, fmt, quality)
+
+        thumbnail = None
+        if options.get('thumbnail'):
+            thumb = img.copy()
+            thumb.thumbnail((options['thumbnail'], options['thumbnail']), Image.Resampling.LANCZOS)
+            thumbnail = _encode(thumb, 'jpeg', 80)
+
+    return encoded, {
+        'format': fmt,
+        'mimetype': FORMATS[fmt][1],
+        'ext': FORMATS[fmt][2],
+        'width': img.width,
+        'height': img.height,
+        'quality': quality if fmt != 'png' else None,
+        'thumbnail': thumbnail,
+    }
+
+
+def _scaled(img, scale):
+    if scale >= 1.0:
+        return img
+    size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    return img.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+
+def _init_worker():
+    # Workers start from a clean interpreter: load Pillow before the first job
+    preload('PIL.Image')
+    threading.Thread(target=_exit_with_parent, name='media-parent-watch', daemon=True).start()
+
+
+def _exit_with_parent():
+    # A service killed before it shut the pool down would leave its workers
+    # (and the forkserver) behind
+    multiprocessing.parent_process().join()
+    os._exit(0)
+
+
+class MediaPipeline:
+    """Recompresses and downscales generated images to fit a byte budget.
+
+    Encoding runs in a process pool of ``workers`` (0: in the calling
+    thread), so a big WebP or JPEG encode doesn't hold the GIL while other
+    requests are relaying upstream bytes. Workers come from a forkserver
+    (spawn where there is none) rather than being forked from this
+    multithreaded process, which can deadlock on a lock another thread
+    held. Each worker imports ``__main__``, so the service scripts leave a
+    bare one behind when run directly (see 1.py and 2.py). ``warm`` starts
+    the workers ahead of the first encode. ``defaults`` come from
+    ``MEDIA_*`` settings and are what ``options`` starts from.
+    """
+
+    def __init__(self, workers=2, timeout=30, defaults=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.defaults = defaults or settings()
+        self._pool = None
+        self._lock = threading.Lock()
+        self._stats = {'processed': 0, 'passed_through': 0, 'failed': 0, 'bytes_in': 0, 'bytes_out': 0,
+                       'encode_seconds': 0.0}
+
+    def options(self, data):
+        return parse_options(data, self.defaults)
+
+    def requested(self, options):
+        return requested(options)
+
+    def needed(self, options, size):
+        return needed(options, size)
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                if 'forkserver' in multiprocessing.get_all_start_methods():
+                    context = multiprocessing.get_context('forkserver')
+                    context.set_forkserver_preload(['media_pipeline'])
+                else:
+                    context = multiprocessing.get_context('spawn')
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                                 initializer=_init_worker)
+            return self._pool
+
+    def warm(self):
+        """Start every worker now instead of on the first encodes."""
+        if not self.workers:
+            return
+        pool = self._executor()
+        for future in [pool.submit(os.getpid) for _ in range(self.workers)]:
+            future.result(timeout=self.timeout)
+
+    def _submit(self, data, options):
+        try:
+            return self._executor().submit(process_image, data, options)
+        except BrokenProcessPool:
+            self._reset()
+            return self._executor().submit(process_image, data, options)
+
+    def _reset(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+            logger.warning("Media pool broken, starting a new one")
+
+    def process(self, data, options, name):
+        """``(data, info)`` with ``data`` fit to ``options``; ``info`` is None
+        when the image was sent as it came."""
+        if not needed(options, len(data)):
+            return self._passed(data)
+        start = time.perf_counter()
+        try:
+            if self.workers:
+                future = self._submit(data, options)
+                try:
+                    encoded, info = future.result(timeout=self.timeout)
+                except BrokenProcessPool:
+                    self._reset()
+                    raise
+            else:
+                encoded, info = process_image(data, options)
+        except Exception:
+            with self._lock:
+                self._stats['failed'] += 1
+            raise
+        return encoded, self._record(name, data, encoded, info, time.perf_counter() - start)
+
+    async def process_async(self, data, options, name):
+        """``process`` for coroutines: awaits the pool instead of blocking."""
+        if not needed(options, len(data)):
+            return self._passed(data)
+        if not self.workers:
+            return await asyncio.to_thread(self.process, data, options, name)
+        start = time.perf_counter()
+        try:
+            future = self._submit(data, options)
+            try:
+                encoded, info = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+            except BrokenProcessPool:
+                self._reset()
+                raise
+        except Exception:
+            with self._lock:
+                self._stats['failed'] += 1
+            raise
+        return encoded, self._record(name, data, encoded, info, time.perf_counter() - start)
+
+    def _passed(self, data):
+        with self._lock:
+            self._stats['passed_through'] += 1
+        return data, None
+
+    def _record(self, name, data, encoded, info, elapsed):
+        saved = len(data) - len(encoded)
+        STAGE_SECONDS.observe(elapsed, 'encode', name)
+        MEDIA_ENCODED.inc(name, info['format'])
+        MEDIA_BYTES_SAVED.inc(name, value=max(0, saved))
+        with self._lock:
+            self._stats['processed'] += 1
+            self._stats['bytes_in'] += len(data)
+            self._stats['bytes_out'] += len(encoded)
+            self._stats['encode_seconds'] += elapsed
+        info.update(encode_ms=round(elapsed * 1000, 1), bytes_in=len(data), bytes_out=len(encoded), bytes_saved=saved)
+        logger.info(f"{name} image: {info['format']} {info['width']}x{info['height']}, "
+                    f"{len(data) / 1024:.0f}KB -> {len(encoded) / 1024:.0f}KB in {info['encode_ms']}ms")
+        return info
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['encode_seconds'] = round(stats['encode_seconds'], 3)
+        stats.update(workers=self.workers, defaults=self.defaults)
+        return stats
+
+
+def settings():
+    """Pipeline defaults from MEDIA_FORMAT, MEDIA_MAX_SIDE, MEDIA_MAX_MB (the
+    Messenger attachment limit), MEDIA_QUALITY and MEDIA_THUMBNAIL_SIDE."""
+    fmt = os.getenv('MEDIA_FORMAT', 'original').lower()
+    return {
+        'format': ALIASES.get(fmt, fmt),
+        'max_side': int(os.getenv('MEDIA_MAX_SIDE', 0)),
+        'max_bytes': int(float(os.getenv('MEDIA_MAX_MB', 25)) * 1024 * 1024),
+        'quality': int(os.getenv('MEDIA_QUALITY', 85)),
+        'thumbnail': 0,
+        'thumbnail_side': int(os.getenv('MEDIA_THUMBNAIL_SIDE', 256)),
+    }
+
+
+def media_headers(info):
+    """Response headers describing a processed image."""
+    if info is None:
+        return {}
+    return {
+        'X-Encode-Ms': str(info['encode_ms']),
+        'X-Bytes-Saved': str(info['bytes_saved']),
+        'X-Image-Size': f"{info['width']}x{info['height']}",
+    }
+
+
+def with_ext(filename, info):
+    """``filename`` with the extension of the processed format."""
+    if info is None:
+        return filename
+    return f"{os.path.splitext(filename)[0]}.{info['ext']}"
@@ -0,0 +1,343 @@
+import os
+import glob
+import stat
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from temp_store import pid_alive
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: open files can't be deleted there anyway
+
+logger = logging.getLogger(__name__)
+
+
+def content_key(*parts):
+    """Stable hex key for a tuple of key parts."""
+    return hashlib.sha256('\x1f'.join(str(p) for p in parts).encode('utf-8')).hexdigest()
+
+
+class MediaStore:
+    """Content-addressed file cache with a disk budget and LRU eviction.
+
+    Files are stored as ``<sha256 of key>.<ext>`` under ``root``. Publishing is
+    atomic (write to a hidden temp name, then ``os.replace``) so readers never
+    see half-written files. Entries handed out by ``acquire``/``publish`` are
+    pinned until ``release`` is called and are never evicted while pinned.
+    A budget of 0 keeps nothing once the last reader lets go. Republishing a
+    pinned key under another extension leaves the old file to its readers
+    until the last one lets go.
+
+    Several processes (ASGI workers) can share ``root``: the directory, not
+    one process's index, is the truth. Misses look on disk for files another
+    process published, each publish rescans the root so the budget covers all
+    of it, and pinned files carry a shared ``flock`` that keeps the other
+    processes from evicting them.
+    """
+
+    def __init__(self, name, root, budget_bytes):
+        self.name = name
+        self.root = root
+        self.budget_bytes = budget_bytes
+        self._entries = OrderedDict()  # digest -> {'path', 'ext', 'size', 'refs', 'stale', 'held'}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'published': 0}
+        os.makedirs(self.root, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """Clear out interrupted publishes and index what's on disk."""
+        for filename in os.listdir(self.root):
+            # Leftover from an interrupted publish, unless another live
+            # process sharing the root is still writing it
+            if filename.startswith('.') and self._tmp_owner_gone(filename):
+                try:
+                    os.remove(os.path.join(self.root, filename))
+                except OSError:
+                    pass
+        files = self._scan()
+        with self._lock:
+            self._merge(files)
+            self._evict()
+        if files:
+            logger.info(f"{self.name} store: loaded {len(self._entries)} files ({self._bytes / (1024*1024):.1f}MB)")
+
+    def _scan(self, pattern='*'):
+        """Files on disk by digest: [(ctime, atime, path, ext, size)], the
+        latest publish (rename) last."""
+        files = {}
+        for path in glob.glob(os.path.join(glob.escape(self.root), pattern)):
+            digest, _, ext = os.path.basename(path).partition('.')
+            if len(digest) != 64:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue  # evicted meanwhile
+            if stat.S_ISREG(st.st_mode):
+                files.setdefault(digest, []).append((st.st_ctime, st.st_atime, path, ext, st.st_size))
+        for found in files.values():
+            found.sort()
+        return files
+
+    def _merge(self, files, complete=True):
+        # Caller holds the lock. Adopt what other processes published, follow
+        # their republishes and, for a full scan, forget what they evicted;
+        # then reorder by access time (``release`` bumps it) for the LRU.
+        order = []
+        for digest, found in files.items():
+            _, atime, path, ext, size = found[-1]
+            entry = self._entries.pop(digest, None) or {'refs': 0, 'stale': [], 'held': {}}
+            if entry.get('path', path) != path:
+                entry['stale'].append(entry['path'])
+            # Older extensions of a key that was republished
+            entry['stale'].extend(p for _, _, p, _, _ in found[:-1] if p not in entry['stale'])
+            entry.update(path=path, ext=ext, size=size)
+            if entry['refs'] == 0:
+                self._remove_stale(entry)
+            order.append((atime, digest, entry))
+        if complete:
+            for digest, entry in list(self._entries.items()):
+                if entry['refs'] == 0:
+                    self._drop(digest)
+        self._entries.update(OrderedDict((d, e) for _, d, e in sorted(order, key=lambda t: t[0])))
+        for digest in list(self._entries):
+            if self._entries[digest]['refs']:
+                self._entries.move_to_end(digest)
+        self._bytes = sum(e['size'] for e in self._entries.values())
+
+    @staticmethod
+    def _tmp_owner_gone(filename):
+        # .<digest>.<pid>.<tid>.tmp
+        parts = filename.split('.')
+        try:
+            pid = int(parts[2])
+        except (IndexError, ValueError):
+            return True
+        return pid == os.getpid() or not pid_alive(pid)
+
+    def acquire(self, key, count=1):
+        """Pin and return the entry for ``key`` or None on a miss."""
+        return self.acquire_id(content_key(*key), count)
+
+    def acquire_id(self, digest, count=1):
+        """``acquire`` by the entry's id (its ``key`` field), e.g. from a URL."""
+        for adopted in (False, True):
+            with self._lock:
+                entry = self._entries.get(digest)
+                if entry is not None and self._hold(entry):
+                    entry['refs'] += count
+                    self._entries.move_to_end(digest)
+                    self._stats['hits'] += 1
+                    return dict(entry, key=digest)
+                if entry is not None:
+                    self._drop(digest)
+                if adopted:
+                    break
+            # Another process sharing the root may have published it
+            files = self._scan(f"{digest}.*")
+            if not files:
+                break
+            with self._lock:
+                self._merge(files, complete=False)
+        with self._lock:
+            self._stats['misses'] += 1
+        return None
+
+    def contains(self, key):
+        """True if ``key`` is cached; doesn't pin or touch the stats."""
+        digest = content_key(*key)
+        with self._lock:
+            if digest in self._entries:
+                return True
+        return bool(self._scan(f"{digest}.*"))
+
+    def publish(self, key, src_path, ext):
+        """Move ``src_path`` into the store and return the pinned entry."""
+        digest = content_key(*key)
+        tmp_path = self._tmp_path(digest)
+        try:
+            os.replace(src_path, tmp_path)
+        except OSError:
+            # Different filesystem: copy, then drop the source
+            shutil.copyfile(src_path, tmp_path)
+            os.remove(src_path)
+        return self._commit(digest, tmp_path, ext)
+
+    def publish_bytes(self, key, data, ext):
+        """Like ``publish`` for content already in memory."""
+        digest = content_key(*key)
+        tmp_path = self._tmp_path(digest)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        return self._commit(digest, tmp_path, ext)
+
+    def _tmp_path(self, digest):
+        return os.path.join(self.root, f".{digest}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+    def _commit(self, digest, tmp_path, ext):
+        final_path = os.path.join(self.root, f"{digest}.{ext}")
+        size = os.path.getsize(tmp_path)
+        files = self._scan()
+        with self._lock:
+            self._merge(files)
+            old = self._entries.get(digest)
+            if old is not None and old['path'] != final_path and old['refs'] == 0:
+                self._drop(digest, remove=True)
+            os.replace(tmp_path, final_path)
+            entry = self._entries.get(digest)
+            if entry is None:
+                entry = {'path': final_path, 'ext': ext, 'size': size, 'refs': 0, 'stale': [], 'held': {}}
+                self._entries[digest] = entry
+                self._bytes += size
+            else:
+                if entry['path'] != final_path:
+                    # Readers still hold the old file: delete it once they're done
+                    entry['stale'].append(entry['path'])
+                if final_path in entry['stale']:
+                    entry['stale'].remove(final_path)
+                self._bytes += size - entry['size']
+                entry.update(path=final_path, ext=ext, size=size)
+                # A handle on the file just replaced doesn't hold the new one
+                fd = entry['held'].pop(final_path, None)
+                if fd is not None:
+                    os.close(fd)
+            self._hold(entry)
+            entry['refs'] += 1
+            self._entries.move_to_end(digest)
+            self._stats['published'] += 1
+            self._evict()
+            return dict(entry, key=digest)
+
+    def pin(self, digest, count=1):
+        """Add references to an entry already handed out."""
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                self._hold(entry)
+                entry['refs'] += count
+
+    def release(self, digest, count=1):
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return
+            entry['refs'] = max(0, entry['refs'] - count)
+            if entry['refs'] == 0:
+                self._unhold(entry)
+                self._remove_stale(entry)
+                self._entries.move_to_end(digest)
+                try:
+                    # Bump the access time only: mtime is part of the ETag
+                    os.utime(entry['path'], ns=(time.time_ns(), os.stat(entry['path']).st_mtime_ns))
+                except OSError:
+                    pass
+            self._evict()
+
+    def is_pinned(self, path):
+        with self._lock:
+            return any(e['refs'] > 0 and (e['path'] == path or path in e['stale']) for e in self._entries.values())
+
+    def _evict(self):
+        # Caller holds the lock. Oldest unpinned entries go first; files
+        # another process has pinned are skipped.
+        for digest in list(self._entries):
+            if self._bytes <= self.budget_bytes:
+                break
+            entry = self._entries[digest]
+            if entry['refs']:
+                continue
+            try:
+                if not _remove_unheld(entry['path']):
+                    continue
+            except OSError as e:
+                logger.error(f"{self.name} store: could not remove {entry['path']}: {str(e)}")
+            self._drop(digest)
+            self._stats['evictions'] += 1
+
+    def _drop(self, digest, remove=False):
+        entry = self._entries.pop(digest)
+        self._bytes -= entry['size']
+        self._unhold(entry)
+        if remove:
+            entry['stale'].append(entry['path'])
+        self._remove_stale(entry)
+
+    def _remove_stale(self, entry):
+        # Any still held by another process are picked up by a later scan
+        for path in entry['stale']:
+            try:
+                _remove_unheld(path)
+            except OSError as e:
+                logger.error(f"{self.name} store: could not remove {path}: {str(e)}")
+        entry['stale'] = []
+
+    def _hold(self, entry):
+        """Take a shared lock on the entry's file so other processes leave it
+        alone while it's pinned; False if it's gone."""
+        fd = entry['held'].get(entry['path'])
+        if fd is not None:
+            if os.fstat(fd).st_nlink:
+                return True
+            # Another process republished the file under the same name
+            os.close(entry['held'].pop(entry['path']))
+        try:
+            fd = os.open(entry['path'], os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            if os.fstat(fd).st_nlink == 0:
+                # Evicted while we waited for the lock
+                os.close(fd)
+                return False
+        entry['held'][entry['path']] = fd
+        return True
+
+    def _unhold(self, entry):
+        for fd in entry['held'].values():
+            os.close(fd)
+        entry['held'] = {}
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                'files': len(self._entries),
+                'bytes': self._bytes,
+                'budget_bytes': self.budget_bytes,
+                'pinned': sum(1 for e in self._entries.values() if e['refs'] > 0),
+            })
+        lookups = stats['hits'] + stats['misses']
+        stats['name'] = self.name
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+def _remove_unheld(path):
+    """Delete ``path`` unless another process holds a lock on it (see
+    ``MediaStore._hold``); True if it's gone."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return True
+    try:
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return True
+    finally:
+        os.close(fd)
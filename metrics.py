@@ -0,0 +1,277 @@
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+from flask import Response, g, request
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, value=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, dict(zip(self.labelnames, labels)), value) for labels, value in values]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def dec(self, *labels, value=1):
+        self.inc(*labels, value=-value)
+
+
+class Histogram(Counter):
+    """Cumulative buckets, ``_sum`` and ``_count`` per label set. ``observe`` is
+    a bisect and three additions under a lock, cheap enough for every request."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        samples = []
+        for labels, counts, total in values:
+            base = dict(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", dict(base, le=_format_value(bound)), cumulative))
+            samples.append((f"{self.name}_sum", base, total))
+            samples.append((f"{self.name}_count", base, cumulative))
+        return samples
+
+
+class Registry:
+    """Metrics plus collectors, rendered in the Prometheus text format.
+
+    Collectors are called at scrape time and return ``(name, kind, help,
+    [(labels, value), ...])`` families, so components that already keep a
+    ``stats()`` dict are exported without touching their hot paths.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        self._collectors.append(fn)
+        return fn
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            _render_family(lines, metric.name, metric.kind, metric.help, metric.samples())
+        for collect in self._collectors:
+            for name, kind, help, samples in collect():
+                _render_family(lines, name, kind, help, [(name, labels, value) for labels, value in samples])
+        return '\n'.join(lines) + '\n'
+
+
+def _render_family(lines, name, kind, help, samples):
+    lines.append(f"# HELP {name} {help}")
+    lines.append(f"# TYPE {name} {kind}")
+    for sample_name, labels, value in samples:
+        if labels:
+            pairs = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+            lines.append(f"{sample_name}{{{pairs}}} {_format_value(value)}")
+        else:
+            lines.append(f"{sample_name} {_format_value(value)}")
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# --- Shared metrics ---
+# One registry per process; both services and the shared modules record here.
+REGISTRY = Registry()
+HTTP_REQUESTS = REGISTRY.counter('http_requests_total', 'Requests by route, method and status',
+                                 ('route', 'method', 'status'))
+HTTP_LATENCY = REGISTRY.histogram('http_request_duration_seconds',
+                                  'Time until the response headers, by route', ('route', 'method'))
+HTTP_IN_FLIGHT = REGISTRY.gauge('http_requests_in_flight', 'Requests being handled, by route', ('route',))
+STAGE_SECONDS = REGISTRY.histogram('stage_seconds',
+                                   'Time per request stage: upstream_http, upstream_body, subprocess, '
+                                   'extract, file_write, buffer_write, encode, stream_out', ('stage', 'name'))
+UPSTREAM_RESPONSES = REGISTRY.counter('upstream_responses_total', 'Upstream HTTP attempts by status',
+                                      ('upstream', 'status'))
+STREAM_BYTES = REGISTRY.counter('stream_out_bytes_total', 'Response body bytes streamed', ('name',))
+ADMISSION_REJECTED = REGISTRY.counter('admission_rejected_total',
+                                      'Requests turned away: rate_limit (by route) or capacity (by upstream)',
+                                      ('name', 'reason'))
+MEDIA_ENCODED = REGISTRY.counter('media_encoded_total', 'Images re-encoded by the media pipeline, by output format',
+                                 ('name', 'format'))
+MEDIA_BYTES_SAVED = REGISTRY.counter('media_bytes_saved_total', 'Bytes cut from images by the media pipeline',
+                                     ('name',))
+
+
+def timed(stage, name):
+    """``with timed('file_write', 'flux'):`` records the block in ``stage_seconds``."""
+    return STAGE_SECONDS.time(stage, name)
+
+
+def timed_stream(chunks, name):
+    """Yield from ``chunks``, recording the time until the last one was taken
+    (stage ``stream_out``) and the bytes sent."""
+    start = time.perf_counter()
+    sent = 0
+    try:
+        for chunk in chunks:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, 'stream_out', name)
+        STREAM_BYTES.inc(name, value=sent)
+
+
+def dir_usage(path):
+    """(files, bytes) directly under ``path``."""
+    files = size = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file(follow_symlinks=False):
+                        files += 1
+                        size += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass  # deleted while scanning
+    except OSError:
+        pass
+    return files, size
+
+
+def cache_families(stats):
+    """Hit/miss/ratio/size families from ``TTLCache``/``MediaStore`` stats dicts."""
+    families = [
+        ('cache_hits_total', 'counter', 'Cache hits', [({'cache': s['name']}, s['hits']) for s in stats]),
+        ('cache_misses_total', 'counter', 'Cache misses', [({'cache': s['name']}, s['misses']) for s in stats]),
+        ('cache_hit_ratio', 'gauge', 'Cache hits / lookups since start',
+         [({'cache': s['name']}, s['hit_ratio']) for s in stats]),
+        ('cache_entries', 'gauge', 'Entries held', [({'cache': s['name']}, s.get('size', s.get('files', 0))) for s in stats]),
+    ]
+    stores = [s for s in stats if 'bytes' in s]
+    if stores:
+        families.append(('cache_bytes', 'gauge', 'Bytes on disk', [({'cache': s['name']}, s['bytes']) for s in stores]))
+    return families
+
+
+def temp_families(stats):
+    """Quota, pin and eviction families from a ``TempStore`` stats dict."""
+    return [
+        ('temp_store_bytes', 'gauge', 'Bytes tracked by the temp store', [({}, stats['bytes'])]),
+        ('temp_store_quota_bytes', 'gauge', 'Temp store byte quota', [({}, stats['quota_bytes'])]),
+        ('temp_store_pinned_files', 'gauge', 'Temp files in use', [({}, stats['pinned'])]),
+        ('temp_store_evictions_total', 'counter', 'Unpinned temp files evicted to stay under quota',
+         [({}, stats['evictions'])]),
+        ('temp_store_rejected_total', 'counter', 'Temp files refused because the quota was full',
+         [({}, stats['rejected'])]),
+    ]
+
+
+def upstream_limit_families(upstreams):
+    """In-flight and queued calls per upstream, against its concurrency cap."""
+    limits = [dict(u.limit.stats(), upstream=u.name) for u in upstreams]
+    return [
+        ('upstream_in_flight', 'gauge', 'Calls holding an upstream slot',
+         [({'upstream': s['upstream']}, s['active']) for s in limits]),
+        ('upstream_queued', 'gauge', 'Calls waiting for an upstream slot',
+         [({'upstream': s['upstream']}, s['waiting']) for s in limits]),
+        ('upstream_concurrency_limit', 'gauge', 'Upstream concurrency cap (0: none)',
+         [({'upstream': s['upstream']}, s['limit']) for s in limits]),
+    ]
+
+
+def instrument(app, path='/metrics'):
+    """Count and time every request to a Flask ``app`` and serve ``REGISTRY`` at ``path``."""
+
+    @app.before_request
+    def _start_timer():
+        req = request._get_current_object()
+        route = req.url_rule.rule if req.url_rule else 'unmatched'
+        g._metrics = (route, req.method, time.perf_counter())
+        HTTP_IN_FLIGHT.inc(route)
+
+    @app.after_request
+    def _record(response):
+        started = g.get('_metrics')
+        if started is not None:
+            route, method, start = started
+            HTTP_REQUESTS.inc(route, method, str(response.status_code))
+            HTTP_LATENCY.observe(time.perf_counter() - start, route, method)
+        return response
+
+    @app.teardown_request
+    def _done(exc):
+        started = g.pop('_metrics', None)
+        if started is not None:
+            HTTP_IN_FLIGHT.dec(started[0])
+
+    @app.route(path, methods=['GET'])
+    def metrics():
+        return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+    return app
@@ -0,0 +1,93 @@
+import io
+import threading
+from collections import OrderedDict
+
+from startup import lazy_import
+
+Image = lazy_import('PIL.Image')
+
+HASH_SIZE = 8
+HASH_BITS = 2 * HASH_SIZE * HASH_SIZE
+
+
+def dhash(data, hash_size=HASH_SIZE):
+    """Difference hash of an encoded image: row and column gradients of a
+    tiny grayscale thumbnail, packed into a ``2 * hash_size**2`` bit int.
+    Re-encoding, rescaling and light recompression barely move it."""
+    with Image.open(io.BytesIO(data)) as img:
+        img.draft('L', (hash_size * 8, hash_size * 8))  # JPEG: decode at reduced scale
+        gray = img.convert('L').resize((hash_size + 1, hash_size + 1), Image.Resampling.BOX, reducing_gap=2.0)
+        px = gray.load()
+    bits = 0
+    for y in range(hash_size):
+        for x in range(hash_size):
+            bits = (bits << 2) | (px[x, y] > px[x + 1, y]) << 1 | (px[x, y] > px[x, y + 1])
+    return bits
+
+
+class HashIndex:
+    """Finds a stored hash within ``max_distance`` bits of a query.
+
+    Hashes are cut into ``max_distance + 1`` bands; two hashes that differ
+    in at most ``max_distance`` bits must agree on at least one band, so only
+    hashes sharing a band are compared. Holds at most ``maxsize`` hashes,
+    least recently matched dropped first.
+    """
+
+    def __init__(self, max_distance=4, bits=HASH_BITS, maxsize=50000):
+        self.max_distance = max_distance
+        self.maxsize = maxsize
+        bands = max_distance + 1
+        step = -(-bits // bands)
+        self._bands = [(lo, (1 << min(step, bits - lo)) - 1) for lo in range(0, bits, step)]
+        self._tables = [{} for _ in self._bands]
+        self._hashes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _keys(self, value):
+        return [(value >> lo) & mask for lo, mask in self._bands]
+
+    def add(self, value):
+        with self._lock:
+            if value in self._hashes:
+                self._hashes.move_to_end(value)
+                return
+            self._hashes[value] = None
+            for table, band in zip(self._tables, self._keys(value)):
+                table.setdefault(band, set()).add(value)
+            while len(self._hashes) > self.maxsize:
+                self._remove(next(iter(self._hashes)))
+
+    def discard(self, value):
+        with self._lock:
+            if value in self._hashes:
+                self._remove(value)
+
+    def _remove(self, value):
+        del self._hashes[value]
+        for table, band in zip(self._tables, self._keys(value)):
+            bucket = table.get(band)
+            if bucket is not None:
+                bucket.discard(value)
+                if not bucket:
+                    del table[band]
+
+    def nearest(self, value):
+        """Closest stored hash within ``max_distance`` (``value`` itself if
+        stored), or None."""
+        with self._lock:
+            if value in self._hashes:
+                self._hashes.move_to_end(value)
+                return value
+            best, best_distance = None, self.max_distance + 1
+            for table, band in zip(self._tables, self._keys(value)):
+                for candidate in table.get(band, ()):
+                    distance = (candidate ^ value).bit_count()
+                    if distance < best_distance:
+                        best, best_distance = candidate, distance
+            if best is not None:
+                self._hashes.move_to_end(best)
+            return best
+
+    def __len__(self):
+        return len(self._hashes)
@@ -0,0 +1,88 @@
+import os
+import time
+import queue
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class FileReaper:
+    """Background deletion queue.
+
+    ``enqueue`` never blocks the caller. A daemon thread drains the queue in
+    batches and unlinks files; files that can't be removed yet (still open on
+    Windows, busy network share) are retried with backoff up to
+    ``max_attempts`` times.
+    """
+
+    def __init__(self, batch_size=64, interval=0.5, max_attempts=8, retry_delay=1.0):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._queue = queue.Queue()
+        self._retries = []  # (not_before, attempts, path)
+        self._lock = threading.Lock()
+        self._stats = {'enqueued': 0, 'deleted': 0, 'missing': 0, 'retried': 0, 'failed': 0, 'batches': 0}
+        self._thread = threading.Thread(target=self._run, name='file-reaper', daemon=True)
+        self._thread.start()
+
+    def enqueue(self, filepath):
+        if not filepath:
+            return
+        self._queue.put(filepath)
+        with self._lock:
+            self._stats['enqueued'] += 1
+
+    def _run(self):
+        while True:
+            batch = []
+            try:
+                batch.append((1, self._queue.get(timeout=self.interval)))
+                while len(batch) < self.batch_size:
+                    batch.append((1, self._queue.get_nowait()))
+            except queue.Empty:
+                pass
+
+            now = time.time()
+            with self._lock:
+                due = [(attempts, path) for not_before, attempts, path in self._retries if not_before <= now]
+                self._retries = [r for r in self._retries if r[0] > now]
+            batch.extend(due)
+            if batch:
+                self._reap(batch)
+
+    def _reap(self, batch):
+        deleted = missing = 0
+        retry = []
+        failed = 0
+        for attempts, path in batch:
+            try:
+                os.remove(path)
+                deleted += 1
+            except FileNotFoundError:
+                missing += 1
+            except OSError as e:
+                if attempts >= self.max_attempts:
+                    failed += 1
+                    logger.error(f"Cleanup gave up on {path}: {str(e)}")
+                else:
+                    delay = self.retry_delay * (2 ** (attempts - 1))
+                    retry.append((time.time() + delay, attempts + 1, path))
+        with self._lock:
+            self._retries.extend(retry)
+            self._stats['deleted'] += deleted
+            self._stats['missing'] += missing
+            self._stats['retried'] += len(retry)
+            self._stats['failed'] += failed
+            self._stats['batches'] += 1
+        if deleted:
+            logger.info(f"Cleaned up {deleted} file(s)")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending_retries'] = len(self._retries)
+        stats['queue_depth'] = self._queue.qsize()
+        return stats
@@ -0,0 +1,106 @@
+import hashlib
+import threading
+
+MAX_SEED = 2**31 - 1
+
+# reuse:    serve the cached image, else generate and cache it
+# refresh:  always generate, replacing the cached image
+# bypass:   generate without touching the cache (the seed still applies)
+# prefetch: queue a background "reuse" and answer at once
+POLICIES = ('reuse', 'refresh', 'bypass', 'prefetch')
+
+
+def derive_seed(*params):
+    """Stable seed for a set of generation parameters."""
+    digest = hashlib.sha256('\x1f'.join(str(p) for p in params).encode('utf-8')).digest()
+    return int.from_bytes(digest[:4], 'big') & MAX_SEED
+
+
+def wants_cache(data):
+    """True if the request body opts into deterministic, cacheable generation."""
+    return data.get('seed') is not None or data.get('cache') is not None or bool(data.get('deterministic'))
+
+
+def cache_request(data, endpoint, *params):
+    """``(key, seed, policy)`` for a deterministic request, None otherwise.
+
+    A request is deterministic if it carries a ``seed``, ``deterministic:
+    true`` or a ``cache`` policy; without an explicit seed one is derived from
+    ``params`` (prompt, mode, size...), so the same request always maps to the
+    same key. Raises ValueError for a bad seed or policy.
+    """
+    if not wants_cache(data):
+        return None
+    seed, policy = data.get('seed'), data.get('cache')
+    policy = policy or 'reuse'
+    if policy not in POLICIES:
+        raise ValueError(f"cache must be one of: {', '.join(POLICIES)}")
+    if seed is None:
+        seed = derive_seed(*params)
+    else:
+        try:
+            seed = int(seed)
+        except (TypeError, ValueError):
+            raise ValueError('seed must be an integer') from None
+        if not 0 <= seed <= MAX_SEED:
+            raise ValueError(f'seed must be between 0 and {MAX_SEED}')
+    return (endpoint, *params, seed), seed, policy
+
+
+class ResultCache:
+    """Generated images in a ``MediaStore``, keyed by ``cache_request`` keys.
+
+    Counts hits, misses and generations per endpoint; every hit is one paid
+    upstream call avoided, priced at ``costs[endpoint]`` and timed at that
+    endpoint's average generation time.
+    """
+
+    def __init__(self, store, costs=None):
+        self.store = store
+        self.costs = costs or {}
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _count(self, endpoint, name, seconds=0.0):
+        with self._lock:
+            stats = self._stats.setdefault(endpoint, {
+                'hits': 0, 'misses': 0, 'refresh': 0, 'bypass': 0, 'generated': 0, 'generation_seconds': 0.0,
+            })
+            stats[name] += 1
+            stats['generation_seconds'] += seconds
+
+    def lookup(self, key, policy):
+        """Pinned entry for ``key`` if the policy allows reuse and it's cached."""
+        if policy != 'reuse':
+            self._count(key[0], policy)
+            return None
+        entry = self.store.acquire(key)
+        self._count(key[0], 'hits' if entry else 'misses')
+        return entry
+
+    def save(self, key, ext, seconds, path=None, data=None):
+        """Cache a fresh generation (a file to move in, or bytes); returns the pinned entry."""
+        self._count(key[0], 'generated', seconds)
+        if path is not None:
+            return self.store.publish(key, path, ext)
+        return self.store.publish_bytes(key, data, ext)
+
+    def release(self, entry):
+        self.store.release(entry['key'])
+
+    def stats(self):
+        with self._lock:
+            endpoints = {name: dict(stats) for name, stats in self._stats.items()}
+        for name, stats in endpoints.items():
+            lookups = stats['hits'] + stats['misses']
+            cost = self.costs.get(name, 0.0)
+            seconds = stats.pop('generation_seconds')
+            avg = seconds / stats['generated'] if stats['generated'] else None
+            stats.update(
+                hit_rate=round(stats['hits'] / lookups, 3) if lookups else None,
+                cost_per_generation=cost,
+                cost_avoided=round(stats['hits'] * cost, 4),
+                avg_generation_s=round(avg, 2) if avg is not None else None,
+                seconds_avoided=round(stats['hits'] * avg, 1) if avg is not None else None,
+            )
+        return {'endpoints': endpoints, 'store': self.store.stats()}
@@ -0,0 +1,200 @@
+import time
+import heapq
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class SearchWarmer:
+    """Keeps popular searches in ``cache`` before anyone waits for them.
+
+    ``record`` counts every search under an exponentially decaying score
+    (``half_life`` seconds), so last week's hits fade out. Every
+    ``interval`` seconds a daemon thread takes the ``top`` queries scoring
+    at least ``min_score``, plus the ``seed`` queries, and re-runs through
+    ``search(query)`` those missing from the cache or expiring within
+    ``refresh_before`` seconds, at most ``per_cycle`` per pass and one at a
+    time, so warming never holds more than one search slot. Queries whose
+    last result was empty are left alone until someone searches them again.
+
+    With ``prefetch``, the top result of the ``prefetch_top`` most popular
+    queries is handed to ``prefetch(url)`` once (e.g. an audio download into
+    the media store); it returns the media key, or None if it skipped. Cache
+    hits on entries the warmer filled and downloads of prefetched media are
+    reported back through ``record`` / ``record_download`` and counted as
+    the hits the warmer produced, next to what the warming cost.
+    """
+
+    def __init__(self, cache, search, interval=60, top=50, min_score=3, half_life=3600, refresh_before=900,
+                 per_cycle=10, seed=(), prefetch=None, prefetch_top=10, max_tracked=5000):
+        self.cache = cache
+        self.search = search
+        self.interval = interval
+        self.top = top
+        self.min_score = min_score
+        self.half_life = half_life
+        self.refresh_before = refresh_before
+        self.per_cycle = per_cycle
+        self.seed = list(seed)
+        self.prefetch = prefetch
+        self.prefetch_top = prefetch_top
+        self.max_tracked = max_tracked
+        self._scores = {}  # query -> (score, updated)
+        self._warmed = set()  # queries whose cache entry the warmer filled
+        self._prefetched = {}  # media key -> query
+        self._attempted = set()  # top-result urls handed to prefetch
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {'searches': 0, 'search_seconds': 0.0, 'empty': 0, 'errors': 0, 'hits': 0,
+                       'prefetches': 0, 'prefetch_seconds': 0.0, 'prefetch_skipped': 0, 'prefetch_errors': 0,
+                       'prefetch_hits': 0, 'cycles': 0}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='search-warmer', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _score(self, query, now):
+        # Caller holds the lock
+        score, updated = self._scores.get(query, (0.0, now))
+        return score * 0.5 ** ((now - updated) / self.half_life)
+
+    def record(self, query, hit):
+        """Count a search for ``query``; ``hit`` if the cache answered it."""
+        now = time.time()
+        with self._lock:
+            self._scores[query] = (self._score(query, now) + 1, now)
+            if hit and query in self._warmed:
+                self._stats['hits'] += 1
+            elif not hit:
+                self._warmed.discard(query)  # filled by a caller from here on
+            if len(self._scores) > self.max_tracked:
+                self._prune(now)
+
+    def record_download(self, key, hit):
+        """Count a download of ``key``; ``hit`` if it came from the cache."""
+        with self._lock:
+            if key in self._prefetched:
+                if hit:
+                    self._stats['prefetch_hits'] += 1
+                else:
+                    del self._prefetched[key]  # evicted since; downloaded again
+
+    def _prune(self, now):
+        # Caller holds the lock. Keep the better-scoring half.
+        keep = heapq.nlargest(self.max_tracked // 2, self._scores, key=lambda q: self._score(q, now))
+        self._scores = {q: (self._score(q, now), now) for q in keep}
+        self._warmed &= set(keep)
+
+    def popular(self, limit=None):
+        """``[(query, score)]`` for the most searched queries, best first."""
+        now = time.time()
+        with self._lock:
+            scored = [(q, self._score(q, now)) for q in self._scores]
+        scored = [(q, s) for q, s in scored if s >= self.min_score]
+        return heapq.nlargest(limit or self.top, scored, key=lambda item: item[1])
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Search warmer cycle failed: {str(e)}")
+
+    def run_once(self):
+        """One warming pass; returns the number of searches it ran."""
+        popular = [q for q, _ in self.popular()]
+        queries = self.seed + [q for q in popular if q not in self.seed]
+        refreshed = 0
+        for query in queries:
+            if refreshed >= self.per_cycle or self._stop.is_set():
+                break
+            cached = self.cache.peek(query)
+            if cached is not None and (cached[1] > self.refresh_before or not cached[0]):
+                continue
+            self._warm(query)
+            refreshed += 1
+        if self.prefetch is not None:
+            for query in popular[:self.prefetch_top]:
+                if self._stop.is_set():
+                    break
+                cached = self.cache.peek(query)
+                if cached and cached[0]:
+                    self._prefetch(query, cached[0][0]['url'])
+        with self._lock:
+            self._stats['cycles'] += 1
+        if refreshed:
+            logger.info(f"Search warmer: refreshed {refreshed} of {len(queries)} popular queries")
+        return refreshed
+
+    def _warm(self, query):
+        start = time.perf_counter()
+        try:
+            results = self.search(query)
+            error = False
+        except Exception as e:
+            logger.error(f"Search warmer: {query} failed: {str(e)}")
+            results, error = None, True
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._stats['searches'] += 1
+            self._stats['search_seconds'] += elapsed
+            self._stats['errors'] += error
+            self._stats['empty'] += results == []
+            if results:
+                self._warmed.add(query)
+
+    def _prefetch(self, query, url):
+        with self._lock:
+            if url in self._attempted:
+                return
+            self._attempted.add(url)
+        start = time.perf_counter()
+        try:
+            key = self.prefetch(url)
+            error = False
+        except Exception as e:
+            logger.error(f"Search warmer: prefetch of {url} failed: {str(e)}")
+            key, error = None, True
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            if key is None:
+                self._attempted.discard(url)  # try again next pass
+                self._stats['prefetch_errors' if error else 'prefetch_skipped'] += 1
+            else:
+                self._prefetched[key] = query
+                self._stats['prefetches'] += 1
+                self._stats['prefetch_seconds'] += elapsed
+            if len(self._attempted) > self.max_tracked:
+                self._attempted = {url}
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(tracked=len(self._scores), warmed=len(self._warmed), prefetched=len(self._prefetched))
+        stats['search_seconds'] = round(stats['search_seconds'], 3)
+        stats['prefetch_seconds'] = round(stats['prefetch_seconds'], 3)
+        stats.update(running=self._thread is not None and not self._stop.is_set(), interval=self.interval,
+                     popular=[{'query': q, 'score': round(s, 2)} for q, s in self.popular(10)])
+        return stats
+
+    def families(self):
+        """Prometheus families: what warming cost and the hits it produced."""
+        s = self.stats()
+        return [
+            ('search_warm_runs_total', 'counter', 'Searches and media prefetches run by the search warmer',
+             [({'kind': 'search'}, s['searches']), ({'kind': 'prefetch'}, s['prefetches'])]),
+            ('search_warm_seconds_total', 'counter', 'Time the search warmer spent searching and prefetching',
+             [({'kind': 'search'}, s['search_seconds']), ({'kind': 'prefetch'}, s['prefetch_seconds'])]),
+            ('search_warm_errors_total', 'counter', 'Failed warm searches and prefetches',
+             [({'kind': 'search'}, s['errors']), ({'kind': 'prefetch'}, s['prefetch_errors'])]),
+            ('search_warm_hits_total', 'counter', 'Cache hits served from entries the search warmer filled',
+             [({'kind': 'search'}, s['hits']), ({'kind': 'prefetch'}, s['prefetch_hits'])]),
+            ('search_warm_tracked_queries', 'gauge', 'Queries with a popularity score', [({}, s['tracked'])]),
+        ]
@@ -0,0 +1,123 @@
+import asyncio
+import threading
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Collapse concurrent calls for the same key into one execution.
+
+    The first caller for a key (the leader) runs ``fn``; callers that arrive
+    while it is running block and receive the same result or exception.
+    Once the call finishes the key is forgotten, so results are never cached
+    here - pair it with a cache if that is wanted.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._stats = {'executions': 0, 'coalesced': 0, 'errors': 0}
+
+    def do(self, key, fn, on_done=None):
+        """Run ``fn()`` once per in-flight ``key`` and return ``(result, shared)``.
+
+        ``shared`` is False for the leader and True for callers that piggybacked.
+        ``on_done(result, participants)`` runs in the leader after ``fn`` succeeds
+        and before any waiter wakes up; ``participants`` is final at that point,
+        which lets callers hand out per-consumer references safely.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.waiters += 1
+                self._stats['coalesced'] += 1
+                leader = False
+            else:
+                flight = _Flight()
+                self._flights[key] = flight
+                self._stats['executions'] += 1
+                leader = True
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+        with self._lock:
+            del self._flights[key]
+            participants = 1 + flight.waiters
+            if flight.error is not None:
+                self._stats['errors'] += 1
+        try:
+            if flight.error is None and on_done is not None:
+                on_done(flight.result, participants)
+        finally:
+            flight.done.set()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result, False
+
+    def waiters(self, key):
+        """Callers piggybacking on the in-flight call for ``key``."""
+        with self._lock:
+            flight = self._flights.get(key)
+            return flight.waiters if flight is not None else 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = {str(key): f.waiters for key, f in self._flights.items()}
+        stats['name'] = self.name
+        return stats
+
+
+class AsyncSingleFlight:
+    """``SingleFlight`` for coroutines on one event loop.
+
+    The first caller for a key starts ``fn()`` as a task; callers that arrive
+    while it runs await the same task. A caller that is cancelled doesn't
+    cancel the shared call.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._flights = {}  # key -> [task, waiters]
+        self._stats = {'executions': 0, 'coalesced': 0, 'errors': 0}
+
+    async def do(self, key, fn):
+        """Await ``fn()`` once per in-flight ``key``; returns ``(result, shared)``."""
+        flight = self._flights.get(key)
+        if flight is not None:
+            flight[1] += 1
+            self._stats['coalesced'] += 1
+            return await asyncio.shield(flight[0]), True
+
+        task = asyncio.ensure_future(fn())
+        self._flights[key] = [task, 0]
+        self._stats['executions'] += 1
+
+        def _done(task):
+            self._flights.pop(key, None)
+            if task.cancelled() or task.exception() is not None:
+                self._stats['errors'] += 1
+
+        task.add_done_callback(_done)
+        return await asyncio.shield(task), False
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['in_flight'] = {str(key): waiters for key, (_, waiters) in self._flights.items()}
+        stats['name'] = self.name
+        return stats
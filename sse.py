@@ -0,0 +1,151 @@
+import json
+import time
+import threading
+from collections import deque
+
+DONE = object()
+
+SSE_MIMETYPE = 'text/event-stream'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+
+def stream_format(data, accept):
+    """'sse', 'ndjson' or None (not streaming) for a request body and Accept header."""
+    fmt = data.get('format')
+    if fmt in ('sse', 'ndjson'):
+        return fmt
+    if data.get('stream') is False:
+        return None
+    if accept.best == NDJSON_MIMETYPE:
+        return 'ndjson'
+    if accept.best == SSE_MIMETYPE or data.get('stream'):
+        return 'sse'
+    return None
+
+
+def parse_sse_line(line):
+    """JSON payload of an upstream ``data:`` line, ``DONE`` for ``[DONE]``,
+    None for anything else (comments, event names, blank separators)."""
+    if isinstance(line, bytes):
+        line = line.decode('utf-8', errors='replace')
+    if not line.startswith('data:'):
+        return None
+    payload = line[5:].strip()
+    if payload == '[DONE]':
+        return DONE
+    try:
+        return json.loads(payload)
+    except ValueError:
+        return None
+
+
+def xai_delta(payload):
+    """(text, completion tokens or None) from an OpenAI-style chat chunk."""
+    choices = payload.get('choices') or [{}]
+    text = (choices[0].get('delta') or {}).get('content') or ''
+    usage = payload.get('usage') or {}
+    return text, usage.get('completion_tokens')
+
+
+def gemini_delta(payload):
+    """(text, candidate tokens or None) from a streamGenerateContent chunk."""
+    candidates = payload.get('candidates') or [{}]
+    parts = (candidates[0].get('content') or {}).get('parts') or []
+    text = ''.join(part.get('text', '') for part in parts)
+    usage = payload.get('usageMetadata') or {}
+    return text, usage.get('candidatesTokenCount')
+
+
+class TokenRelay:
+    """Turns upstream chunks into client events and times the generation.
+
+    ``feed`` returns the event to send for a chunk (or None if it carried no
+    text); ``finish`` returns the closing event, which includes the full text
+    and the request's metrics, and records them in ``metrics``.
+    Without a token count from the upstream, text chunks are counted instead.
+    """
+
+    def __init__(self, fmt, extract, metrics):
+        self.fmt = fmt
+        self.extract = extract
+        self.metrics = metrics
+        self.started = time.perf_counter()
+        self.first_token = None
+        self.parts = []
+        self.tokens = None
+        self.result = None
+
+    def event(self, data):
+        body = json.dumps(data, ensure_ascii=False)
+        return f"data: {body}\n\n" if self.fmt == 'sse' else f"{body}\n"
+
+    def feed(self, payload):
+        text, tokens = self.extract(payload)
+        if tokens is not None:
+            self.tokens = tokens
+        if not text:
+            return None
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+        self.parts.append(text)
+        return self.event({'delta': text})
+
+    @property
+    def text(self):
+        return ''.join(self.parts)
+
+    def finish(self, **extra):
+        now = time.perf_counter()
+        tokens = self.tokens if self.tokens is not None else len(self.parts)
+        first = self.first_token or now
+        generation = now - first
+        result = {
+            'ttft_ms': round((first - self.started) * 1000, 1),
+            'total_ms': round((now - self.started) * 1000, 1),
+            'tokens': tokens,
+            'tokens_per_s': round(tokens / generation, 1) if generation > 0 else None,
+        }
+        self.result = result
+        self.metrics.record(result)
+        return self.event(dict(extra, done=True, response=self.text, metrics=result))
+
+    def error(self, message):
+        self.metrics.record_error()
+        return self.event({'error': message, 'done': True})
+
+
+class StreamMetrics:
+    """Rolling time-to-first-token and tokens/s over the last ``window`` streams."""
+
+    def __init__(self, name, window=500):
+        self.name = name
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._streams = 0
+        self._errors = 0
+
+    def record(self, result):
+        with self._lock:
+            self._streams += 1
+            self._samples.append(result)
+
+    def record_error(self):
+        with self._lock:
+            self._errors += 1
+
+    def stats(self):
+        with self._lock:
+            samples = list(self._samples)
+            stats = {'name': self.name, 'streams': self._streams, 'errors': self._errors, 'window': len(samples)}
+        ttft = sorted(s['ttft_ms'] for s in samples)
+        rates = sorted(s['tokens_per_s'] for s in samples if s['tokens_per_s'] is not None)
+        if ttft:
+            stats['ttft_ms'] = {'p50': _pct(ttft, 0.5), 'p95': _pct(ttft, 0.95), 'avg': round(sum(ttft) / len(ttft), 1)}
+        if rates:
+            stats['tokens_per_s'] = {'p50': _pct(rates, 0.5), 'avg': round(sum(rates) / len(rates), 1)}
+        return stats
+
+
+def _pct(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
@@ -0,0 +1,210 @@
+import os
+import sys
+import time
+import logging
+import importlib
+import threading
+
+from flask import jsonify
+
+logger = logging.getLogger(__name__)
+
+
+def process_started():
+    """Wall-clock time the process was started (from /proc), else now."""
+    try:
+        with open('/proc/self/stat') as f:
+            # Fields after the parenthesised command name; starttime is field 22
+            ticks = int(f.read().rpartition(')')[2].split()[19])
+        with open('/proc/stat') as f:
+            boot = next(int(line.split()[1]) for line in f if line.startswith('btime '))
+        return boot + ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, StopIteration):
+        return time.time()
+
+
+class LazyModule:
+    """Stands in for a module until an attribute is first used, then imports
+    it (once, under a lock) and records how long that took."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._seconds = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    start = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    self._seconds = time.perf_counter() - start
+                    self._module = module
+                    logger.info(f"Imported {self._name} in {self._seconds * 1000:.0f}ms")
+        return self._module
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def __repr__(self):
+        return f"<lazy module {self._name!r}{' (loaded)' if self.loaded else ''}>"
+
+
+_lazy = {}
+_lazy_lock = threading.Lock()
+
+
+def lazy_import(name):
+    """A shared ``LazyModule`` for ``name`` (the module itself if it's
+    already imported)."""
+    if name in sys.modules:
+        return sys.modules[name]
+    with _lazy_lock:
+        if name not in _lazy:
+            _lazy[name] = LazyModule(name)
+        return _lazy[name]
+
+
+def preload(*names):
+    """Import lazy modules now (e.g. from a pre-warm task), timing each."""
+    for name in names:
+        module = lazy_import(name)
+        if isinstance(module, LazyModule):
+            module.load()
+
+
+def lazy_modules():
+    """name -> import seconds (None while not imported) for every lazy module."""
+    with _lazy_lock:
+        modules = dict(_lazy)
+    return {name: module._seconds for name, module in modules.items()}
+
+
+class Startup:
+    """Startup timing, background pre-warming and health probes for a service.
+
+    ``mark`` records how far into startup each phase finished, ``finish``
+    ends startup and logs the total, and ``prewarm`` runs slow first-use
+    work (heavy imports, warm workers, orphan cleanup) on a background
+    thread after startup, each task timed. Readiness checks are registered
+    with ``check``; ``critical`` ones take the service out of rotation when
+    they fail, the others only show up as warnings (an upstream that is down
+    for this instance is down for every instance).
+
+    ``install`` adds ``/health/live`` (the process answers) and
+    ``/health/ready`` (started, required pre-warm done, critical checks
+    pass; 503 otherwise).
+    """
+
+    def __init__(self, name, wait_for_prewarm=False):
+        self.name = name
+        self.wait_for_prewarm = wait_for_prewarm
+        self.process_started = process_started()
+        self.started = time.time()
+        self.finished = None
+        self.phases = {}
+        self.prewarm_tasks = {}
+        self._tasks = []
+        self._checks = []
+        self._warmed = threading.Event()
+        self._lock = threading.Lock()
+
+    def mark(self, phase):
+        self.phases[phase] = round(time.time() - self.process_started, 3)
+
+    def prewarm(self, name, fn, optional=True):
+        """Queue ``fn`` to run in the background once startup finishes.
+        Optional tasks are skipped when pre-warming is turned off; the others
+        are work moved off the startup path and always run."""
+        self._tasks.append((name, fn, optional))
+
+    def check(self, name, fn, critical=True):
+        """``fn()`` returns ``(ok, details)`` for readiness."""
+        self._checks.append((name, fn, critical))
+
+    def finish(self, prewarm=True):
+        self.mark('ready')
+        self.finished = time.time()
+        logger.info(f"{self.name} started in {self.finished - self.process_started:.2f}s "
+                    f"({self.finished - self.started:.2f}s since the first import) {self.phases}")
+        tasks = [(name, fn) for name, fn, optional in self._tasks if prewarm or not optional]
+        if tasks:
+            threading.Thread(target=self._run_prewarm, args=(tasks,), name=f"{self.name}-prewarm", daemon=True).start()
+        else:
+            self._warmed.set()
+
+    def _run_prewarm(self, tasks):
+        for name, fn in tasks:
+            start = time.perf_counter()
+            error = None
+            try:
+                fn()
+            except Exception as e:
+                error = str(e)
+                logger.error(f"Pre-warm {name} failed: {error}")
+            with self._lock:
+                self.prewarm_tasks[name] = {'seconds': round(time.perf_counter() - start, 3), 'error': error}
+        self._warmed.set()
+        logger.info(f"{self.name} pre-warm done: {self.prewarm_tasks}")
+
+    def report(self):
+        with self._lock:
+            prewarm = dict(self.prewarm_tasks)
+        return {
+            'startup_seconds': round(self.finished - self.process_started, 3) if self.finished else None,
+            'phases': dict(self.phases),
+            'uptime_seconds': round(time.time() - self.process_started, 1),
+            'prewarm': prewarm,
+            'prewarm_done': self._warmed.is_set(),
+            'imports': {name: round(s, 3) if s is not None else None for name, s in lazy_modules().items()},
+        }
+
+    def readiness(self):
+        """``(ready, checks)``; checks map name -> {'ok', 'critical', ...details}."""
+        ready = self.finished is not None and (self._warmed.is_set() or not self.wait_for_prewarm)
+        checks = {}
+        for name, fn, critical in self._checks:
+            try:
+                ok, details = fn()
+            except Exception as e:
+                ok, details = False, {'error': str(e)}
+            checks[name] = dict(details, ok=bool(ok), critical=critical)
+            if critical and not ok:
+                ready = False
+        return ready, checks
+
+    def install(self, app):
+        @app.route('/health/live', methods=['GET'])
+        def health_live():
+            return jsonify({'status': 'alive', 'uptime_seconds': round(time.time() - self.process_started, 1)})
+
+        @app.route('/health/ready', methods=['GET'])
+        def health_ready():
+            ready, checks = self.readiness()
+            body = {
+                'status': 'ready' if ready else 'not_ready',
+                'warnings': sorted(name for name, c in checks.items() if not c['ok'] and not c['critical']),
+                'checks': checks,
+                'startup': self.report(),
+            }
+            return jsonify(body), 200 if ready else 503
+
+        return app
+
+    def families(self):
+        """Prometheus families: startup phases, pre-warm tasks and readiness."""
+        ready, _ = self.readiness()
+        with self._lock:
+            prewarm = dict(self.prewarm_tasks)
+        return [
+            ('startup_phase_seconds', 'gauge', 'Seconds from process start to the end of each startup phase',
+             [({'phase': phase}, seconds) for phase, seconds in self.phases.items()]),
+            ('prewarm_seconds', 'gauge', 'Seconds spent on each background pre-warm task',
+             [({'task': task}, t['seconds']) for task, t in prewarm.items()]),
+            ('ready', 'gauge', '1 while the readiness probe passes', [({}, ready)]),
+        ]
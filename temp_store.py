@@ -0,0 +1,338 @@
+import io
+import os
+import time
+import uuid
+import shutil
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class TempQuotaExceeded(Exception):
+    def __init__(self, name, used, quota):
+        super().__init__(f"{name} storage is full ({used / (1024*1024):.1f}MB of {quota / (1024*1024):.1f}MB)")
+        self.used = used
+        self.quota = quota
+
+
+class PayloadTooLarge(Exception):
+    def __init__(self, limit):
+        super().__init__(f"payload exceeds {limit / (1024*1024):.0f}MB")
+        self.limit = limit
+
+
+class TempStore:
+    """Scratch files under ``root`` with a byte quota.
+
+    Every path handed out by ``path`` is indexed with its size, the request
+    that owns it and a pin count, starting pinned once for the caller. Sizes
+    come in through ``resize``; whenever the total goes over ``quota_bytes``
+    the least recently used unpinned files are removed straight away, and
+    ``path`` refuses new files (``TempQuotaExceeded``) while pinned files
+    alone fill the quota. Files moved elsewhere are dropped with ``forget``,
+    files no longer needed with ``discard``.
+
+    The index is the only record of what's in use, so anything else found
+    under ``root`` is an orphan of a previous run and ``reconcile`` deletes
+    it: at construction, or later (e.g. off the startup path) with
+    ``reconcile=False``. With ``per_process`` the files go in ``root/<pid>``
+    instead, so worker processes sharing ``root`` never see each other's
+    files as orphans; ``reconcile`` then also deletes the directories of
+    processes that are gone. The quota is per process either way.
+    """
+
+    def __init__(self, name, root, quota_bytes, remove=None, reconcile=True, per_process=False):
+        self.name = name
+        self.base = root if per_process else None
+        self.root = os.path.join(root, str(os.getpid())) if per_process else root
+        self.quota_bytes = quota_bytes
+        self.remove = remove or _remove
+        self._entries = OrderedDict()  # path -> {'size', 'owner', 'pins', 'created'}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'allocated': 0, 'discarded': 0, 'forgotten': 0, 'evictions': 0, 'evicted_bytes': 0,
+                       'rejected': 0, 'orphans_removed': 0, 'orphan_bytes': 0}
+        os.makedirs(self.root, exist_ok=True)
+        if reconcile:
+            self.reconcile()
+
+    def reconcile(self):
+        """Delete files under ``root`` that aren't in the index, and (per
+        process) the roots of dead processes. Safe while the store is in
+        use: paths are indexed before their files exist."""
+        orphans = []
+        if self.base is not None:
+            orphans.extend(self._dead_roots())
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                try:
+                    orphans.append((entry.path, entry.stat(follow_symlinks=False).st_size))
+                except OSError:
+                    pass  # gone already
+        with self._lock:
+            orphans = [(path, size) for path, size in orphans if path not in self._entries]
+        for path, _ in orphans:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                self.remove(path)
+        orphan_bytes = sum(size for _, size in orphans)
+        with self._lock:
+            self._stats['orphans_removed'] += len(orphans)
+            self._stats['orphan_bytes'] += orphan_bytes
+        if orphans:
+            logger.info(f"{self.name} store: removed {len(orphans)} orphaned files ({orphan_bytes / (1024*1024):.1f}MB)")
+        return len(orphans)
+
+    def _dead_roots(self):
+        # (path, bytes) of sibling <pid> directories whose process has exited
+        dead = []
+        with os.scandir(self.base) as entries:
+            for entry in entries:
+                if not entry.name.isdigit() or not entry.is_dir(follow_symlinks=False) or pid_alive(int(entry.name)):
+                    continue
+                size = 0
+                for dirpath, _, filenames in os.walk(entry.path):
+                    for filename in filenames:
+                        try:
+                            size += os.path.getsize(os.path.join(dirpath, filename))
+                        except OSError:
+                            pass
+                dead.append((entry.path, size))
+        return dead
+
+    def path(self, prefix, suffix='', owner=None):
+        """Reserve a fresh ``<prefix>_<id><suffix>`` path, pinned once."""
+        path = os.path.join(self.root, f"{prefix}_{uuid.uuid4().hex}{suffix}")
+        with self._lock:
+            evicted = self._evict()
+            if self._bytes >= self.quota_bytes:
+                self._stats['rejected'] += 1
+                used = self._bytes
+            else:
+                used = None
+                self._entries[path] = {'size': 0, 'owner': owner, 'pins': 1, 'created': time.time()}
+                self._stats['allocated'] += 1
+        self._remove_all(evicted)
+        if used is not None:
+            raise TempQuotaExceeded(self.name, used, self.quota_bytes)
+        return path
+
+    def buffer(self, prefix, suffix='', owner=None, limit=None, spill_bytes=8 * 1024 * 1024):
+        """A ``SpillBuffer`` that spills to a file from this store."""
+        return SpillBuffer(self, prefix, suffix, owner, limit, spill_bytes)
+
+    def resize(self, path, size=None):
+        """Record the size of ``path`` (stat it if ``size`` is None) and
+        enforce the quota. False if the store is still over quota."""
+        if size is None:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = 0
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                self._bytes += size - entry['size']
+                entry['size'] = size
+                self._entries.move_to_end(path)
+            evicted = self._evict()
+            within = self._bytes <= self.quota_bytes
+        self._remove_all(evicted)
+        return within
+
+    def pin(self, path, count=1):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                entry['pins'] += count
+                self._entries.move_to_end(path)
+
+    def unpin(self, path, count=1):
+        """Drop references; an unpinned file stays until discarded or evicted."""
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                return
+            entry['pins'] = max(0, entry['pins'] - count)
+            evicted = self._evict()
+        self._remove_all(evicted)
+
+    def exists(self, path):
+        with self._lock:
+            return path in self._entries
+
+    def forget(self, path):
+        """Stop tracking ``path`` without deleting it (it was moved elsewhere)."""
+        with self._lock:
+            if self._drop(path):
+                self._stats['forgotten'] += 1
+
+    def discard(self, path):
+        """Stop tracking ``path`` and delete it. Untracked paths are deleted too."""
+        if not path:
+            return
+        with self._lock:
+            if self._drop(path):
+                self._stats['discarded'] += 1
+        self.remove(path)
+
+    def _drop(self, path):
+        # Caller holds the lock
+        entry = self._entries.pop(path, None)
+        if entry is None:
+            return False
+        self._bytes -= entry['size']
+        return True
+
+    def _evict(self):
+        # Caller holds the lock. Oldest unpinned files go first; the caller
+        # deletes the returned paths once the lock is released.
+        evicted = []
+        for path in list(self._entries):
+            if self._bytes <= self.quota_bytes:
+                break
+            entry = self._entries[path]
+            if entry['pins'] == 0:
+                self._drop(path)
+                self._stats['evictions'] += 1
+                self._stats['evicted_bytes'] += entry['size']
+                evicted.append(path)
+        return evicted
+
+    def _remove_all(self, paths):
+        for path in paths:
+            self.remove(path)
+        if paths:
+            logger.info(f"{self.name} store: evicted {len(paths)} files to stay under quota")
+
+    def usage(self):
+        """Current usage against the quota, for health checks."""
+        with self._lock:
+            used, files = self._bytes, len(self._entries)
+            pinned = sum(1 for e in self._entries.values() if e['pins'] > 0)
+        return {
+            'bytes': used,
+            'quota_bytes': self.quota_bytes,
+            'used_ratio': round(used / self.quota_bytes, 4) if self.quota_bytes else 1.0,
+            'files': files,
+            'pinned': pinned,
+        }
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            owners = {}
+            for entry in self._entries.values():
+                owner = owners.setdefault(entry['owner'] or 'unknown', {'files': 0, 'bytes': 0, 'pinned': 0})
+                owner['files'] += 1
+                owner['bytes'] += entry['size']
+                owner['pinned'] += entry['pins'] > 0
+        stats.update(self.usage(), name=self.name, owners=owners)
+        return stats
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # someone else's process
+    return True
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.error(f"Could not remove {path}: {str(e)}")
+
+
+class SpillBuffer:
+    """Write-once byte buffer held in memory up to ``spill_bytes``, then in a
+    file from ``store`` (counted against its quota). Writing past ``limit``
+    raises ``PayloadTooLarge``, so oversized payloads are refused while they
+    arrive instead of after they're saved; spilling past the store's quota
+    raises ``TempQuotaExceeded``.
+
+    ``reader()`` gives a file object over the contents; ``detach()`` hands
+    the spill file over to the caller (e.g. to move it into a cache);
+    ``close()`` throws everything away.
+    """
+
+    def __init__(self, store, prefix, suffix='', owner=None, limit=None, spill_bytes=8 * 1024 * 1024):
+        self.store = store
+        self.prefix = prefix
+        self.suffix = suffix
+        self.owner = owner
+        self.limit = limit
+        self.spill_bytes = spill_bytes
+        self.size = 0
+        self.path = None
+        self._memory = io.BytesIO()
+        self._file = None
+
+    @property
+    def spilled(self):
+        return self.path is not None
+
+    def write(self, data):
+        if self.limit is not None and self.size + len(data) > self.limit:
+            raise PayloadTooLarge(self.limit)
+        if self._file is None and self.size + len(data) > self.spill_bytes:
+            self._spill()
+        (self._file or self._memory).write(data)
+        self.size += len(data)
+        if self._file is not None and not self.store.resize(self.path, self.size):
+            # Eviction couldn't make room for what's spilled so far
+            usage = self.store.usage()
+            raise TempQuotaExceeded(self.store.name, usage['bytes'], usage['quota_bytes'])
+        return len(data)
+
+    def _spill(self):
+        self.path = self.store.path(self.prefix, self.suffix, self.owner)
+        self._file = open(self.path, 'wb')
+        self._file.write(self._memory.getbuffer())
+        self._memory = None
+
+    def _finish(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self.store.resize(self.path, self.size)
+
+    def getvalue(self):
+        """The contents, if they're still in memory."""
+        return None if self.spilled else self._memory.getvalue()
+
+    def reader(self):
+        """A fresh file object positioned at the start of the contents."""
+        self._finish()
+        if self.spilled:
+            return open(self.path, 'rb')
+        return io.BytesIO(self._memory.getbuffer())
+
+    def detach(self):
+        """Stop tracking the spill file and return its path (None if in memory)."""
+        self._finish()
+        path, self.path = self.path, None
+        if path is not None:
+            self.store.forget(path)
+            self._memory = io.BytesIO()  # nothing left to hand out
+        return path
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.path is not None:
+            self.store.discard(self.path)
+            self.path = None
+        self._memory = None
@@ -0,0 +1,179 @@
+import os
+import time
+import json
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """Thread-safe LRU cache with per-entry expiry and optional SQLite backing.
+
+    Entries live in memory up to ``maxsize`` (least recently used evicted first).
+    When ``db_path`` is set every write also goes to SQLite so the cache
+    survives restarts; a memory miss falls back to the database.
+    Values must be JSON serialisable when a database is used.
+    """
+
+    def __init__(self, name, maxsize=1000, ttl=3600, negative_ttl=60, db_path=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.db_path = db_path or None
+        self._data = OrderedDict()  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self._db = None
+        self._writes = 0
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'negative_hits': 0,
+            'disk_hits': 0,
+            'evictions': 0,
+            'expirations': 0,
+        }
+        if self.db_path:
+            self._open_db()
+
+    # --- SQLite backing store ---
+    def _open_db(self):
+        try:
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+            self._db.execute('DELETE FROM cache WHERE expires_at <= ?', (time.time(),))
+            self._db.commit()
+            logger.info(f"{self.name} cache: persistent store at {self.db_path}")
+        except Exception as e:
+            logger.error(f"{self.name} cache: disabling persistent store ({str(e)})")
+            self._db = None
+
+    def _db_get(self, key, now):
+        row = self._db.execute(
+            'SELECT value, expires_at FROM cache WHERE key = ?', (key,)
+        ).fetchone()
+        if not row:
+            return None
+        value, expires_at = row
+        if expires_at <= now:
+            self._db.execute('DELETE FROM cache WHERE key = ?', (key,))
+            self._db.commit()
+            return None
+        return json.loads(value), expires_at
+
+    def _db_set(self, key, value, expires_at):
+        self._db.execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+            (key, json.dumps(value), expires_at)
+        )
+        self._writes += 1
+        # Prune expired rows and cap the table every so often
+        if self._writes % 100 == 0:
+            self._db.execute('DELETE FROM cache WHERE expires_at <= ?', (time.time(),))
+            self._db.execute(
+                'DELETE FROM cache WHERE key NOT IN '
+                '(SELECT key FROM cache ORDER BY expires_at DESC LIMIT ?)',
+                (self.maxsize * 10,)
+            )
+        self._db.commit()
+
+    # --- Public API ---
+    def get(self, key):
+        """Return ``(found, value)``; expired entries count as misses."""
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._data.move_to_end(key)
+                    self._stats['hits'] += 1
+                    if not value:
+                        self._stats['negative_hits'] += 1
+                    return True, value
+                del self._data[key]
+                self._stats['expirations'] += 1
+
+            if self._db is not None:
+                try:
+                    stored = self._db_get(key, now)
+                except Exception as e:
+                    logger.error(f"{self.name} cache: read error for {key}: {str(e)}")
+                    stored = None
+                if stored is not None:
+                    value, expires_at = stored
+                    self._store(key, value, expires_at)
+                    self._stats['hits'] += 1
+                    self._stats['disk_hits'] += 1
+                    if not value:
+                        self._stats['negative_hits'] += 1
+                    return True, value
+
+            self._stats['misses'] += 1
+            return False, None
+
+    def peek(self, key):
+        """``(value, seconds left)`` for a live in-memory entry, else None.
+        Doesn't count as a lookup or refresh its LRU position."""
+        with self._lock:
+            entry = self._data.get(key)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0], entry[1] - time.time()
+
+    def set(self, key, value, ttl=None):
+        """Store ``value``. Empty values use the short negative TTL."""
+        if ttl is None:
+            ttl = self.ttl if value else self.negative_ttl
+        expires_at = time.time() + ttl
+        with self._lock:
+            self._store(key, value, expires_at)
+            if self._db is not None:
+                try:
+                    self._db_set(key, value, expires_at)
+                except Exception as e:
+                    logger.error(f"{self.name} cache: write error for {key}: {str(e)}")
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            if self._db is not None:
+                try:
+                    self._db.execute('DELETE FROM cache WHERE key = ?', (key,))
+                    self._db.commit()
+                except Exception as e:
+                    logger.error(f"{self.name} cache: delete error for {key}: {str(e)}")
+
+    def _store(self, key, value, expires_at):
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._data)
+        lookups = stats['hits'] + stats['misses']
+        stats.update({
+            'name': self.name,
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'negative_ttl': self.negative_ttl,
+            'persistent': self._db is not None,
+            'hit_ratio': round(stats['hits'] / lookups, 4) if lookups else 0.0,
+        })
+        return stats
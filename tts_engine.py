@@ -0,0 +1,143 @@
+import io
+import re
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import STAGE_SECONDS
+from startup import lazy_import
+
+# gTTS pulls in requests and its language tables; imported on first use
+gtts = lazy_import('gtts')
+gtts_lang = lazy_import('gtts.lang')
+GOOGLE_TTS_MAX_CHARS = 100  # gTTS.GOOGLE_TTS_MAX_CHARS
+
+logger = logging.getLogger(__name__)
+
+# Sentence ends, including Devanagari danda and CJK full stops
+SENTENCE_END_RE = re.compile(r'(?<=[.!?;।॥。！？])\s+')
+
+
+class TTSError(Exception):
+    pass
+
+
+def split_text(text, max_chars=100):
+    """Split ``text`` into chunks of at most ``max_chars``, breaking at sentence
+    ends where possible and at spaces otherwise. Short sentences are packed
+    together so the segment count stays low."""
+    pieces = []
+    for sentence in SENTENCE_END_RE.split(text.strip()):
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(' ', 0, max_chars + 1)
+            if cut <= 0:
+                cut = max_chars
+            pieces.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if sentence:
+            pieces.append(sentence)
+
+    chunks = []
+    for piece in pieces:
+        if chunks and len(chunks[-1]) + 1 + len(piece) <= max_chars:
+            chunks[-1] = f"{chunks[-1]} {piece}"
+        else:
+            chunks.append(piece)
+    return chunks
+
+
+class TTSEngine:
+    """Parallel gTTS synthesis.
+
+    Text is split at sentence boundaries into chunks no longer than one gTTS
+    request (``max_chars``), every chunk is synthesized on a shared worker
+    pool, and the MP3 segments come back in order. MP3 frames are
+    self-contained, so the concatenation plays as one file.
+    """
+
+    def __init__(self, workers=4, max_chars=GOOGLE_TTS_MAX_CHARS, timeout=30):
+        self.workers = workers
+        self.max_chars = max_chars
+        self.timeout = timeout
+        self._languages = None
+        self._lookup = None  # lower-cased code -> gTTS code
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tts')
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'segments': 0, 'failed': 0, 'cancelled': 0, 'synth_seconds': 0.0}
+        logger.info(f"TTS engine: workers={workers} chunk={max_chars} chars")
+
+    @property
+    def languages(self):
+        if self._languages is None:
+            self._languages = gtts_lang.tts_langs()
+        return self._languages
+
+    def supports(self, lang):
+        return lang in self.languages
+
+    def canonical(self, lang):
+        """The gTTS code for ``lang`` in any case ('zh-cn' -> 'zh-CN'), or None."""
+        if self._lookup is None:
+            self._lookup = {code.lower(): code for code in self.languages}
+        return self._lookup.get(str(lang).strip().lower().replace('_', '-'))
+
+    def _synthesize(self, chunk, lang, slow):
+        start = time.time()
+        buf = io.BytesIO()
+        gtts.gTTS(text=chunk, lang=lang, slow=slow, lang_check=False, timeout=self.timeout).write_to_fp(buf)
+        elapsed = time.time() - start
+        STAGE_SECONDS.observe(elapsed, 'upstream_http', 'gtts')
+        with self._lock:
+            self._stats['segments'] += 1
+            self._stats['synth_seconds'] += elapsed
+        return buf.getvalue()
+
+    def segments(self, text, lang='en', slow=False):
+        """Yield MP3 bytes per chunk, in order, as soon as each is ready.
+
+        All chunks are queued up front; closing the generator early cancels
+        the ones that haven't started.
+        """
+        if not self.supports(lang):
+            raise TTSError(f"unsupported language: {lang}")
+        chunks = split_text(text, self.max_chars)
+        if not chunks:
+            raise TTSError('nothing to say')
+        with self._lock:
+            self._stats['requests'] += 1
+        futures = [self._pool.submit(self._synthesize, chunk, lang, slow) for chunk in chunks]
+        finished = False
+        try:
+            for future in futures:
+                yield future.result()
+            finished = True
+        except Exception as e:
+            with self._lock:
+                self._stats['failed'] += 1
+            raise TTSError(f"synthesis failed: {str(e)}") from e
+        finally:
+            if not finished:
+                cancelled = sum(1 for f in futures if f.cancel())
+                with self._lock:
+                    self._stats['cancelled'] += cancelled
+
+    def synthesize(self, text, out, lang='en', slow=False):
+        """Write the whole MP3 for ``text`` to the file object ``out``; returns its size."""
+        size = 0
+        segments = self.segments(text, lang, slow)
+        try:
+            for segment in segments:
+                out.write(segment)
+                size += len(segment)
+        finally:
+            segments.close()  # cancels the rest if ``out`` refused a write
+        return size
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['synth_seconds'] = round(stats['synth_seconds'], 2)
+        stats['workers'] = self.workers
+        stats['pending'] = self._pool._work_queue.qsize()
+        return stats
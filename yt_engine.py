@@ -0,0 +1,285 @@
+import os
+import time
+import uuid
+import glob
+import logging
+import threading
+import subprocess
+from concurrent.futures import CancelledError, ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from metrics import timed
+from startup import lazy_import
+
+yt_dlp = lazy_import('yt_dlp')  # ~200ms; imported by the first job or the pre-warm
+
+logger = logging.getLogger(__name__)
+
+
+class EngineError(Exception):
+    pass
+
+
+class EngineTimeout(EngineError):
+    pass
+
+
+class EngineCancelled(EngineError):
+    pass
+
+
+class DownloadJob:
+    """Handle for a queued download; ``result()`` returns ``{'file', 'ext'}``."""
+
+    def __init__(self, url, fmt, timeout):
+        self.url = url
+        self.fmt = fmt
+        self.timeout = timeout
+        self.deadline = None
+        self.future = None
+        self._cancelled = threading.Event()
+        self._expired = threading.Event()
+        self._proc = None
+
+    def cancel(self):
+        self._cancelled.set()
+        self._stop()
+
+    def expire(self):
+        """Stop the download because it ran out of time."""
+        self._expired.set()
+        self._stop()
+
+    def _stop(self):
+        if self.future is not None:
+            self.future.cancel()
+        proc = self._proc
+        if proc is not None:
+            proc.kill()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def expired(self):
+        return self._expired.is_set()
+
+    def result(self, timeout=None):
+        """Wait up to ``timeout`` seconds, queueing included; past that the
+        download is stopped and ``EngineTimeout`` raised."""
+        try:
+            return self.future.result(timeout)
+        except FutureTimeout:
+            self.expire()
+            raise EngineTimeout('download timeout')
+        except CancelledError:
+            if self.expired:
+                raise EngineTimeout('download timeout')
+            raise EngineCancelled('download cancelled')
+
+
+class DownloadEngine:
+    """Bounded pool of yt-dlp workers.
+
+    ``inprocess`` keeps one warm ``yt_dlp.YoutubeDL`` per worker thread and
+    format selector, so extractor imports, format parsing and cookie loading
+    happen once per worker instead of once per request. ``subprocess`` runs
+    the ``yt-dlp`` CLI per job, as the server always did.
+    Jobs time out ``timeout`` seconds after they start running: a watchdog
+    thread kills the CLI or flags the in-process job, which stops at its next
+    progress update or socket timeout. ``download`` waits at most
+    ``wait_timeout`` seconds (default twice ``timeout``), queueing included.
+    """
+
+    BACKENDS = ('inprocess', 'subprocess')
+
+    def __init__(self, output_dir, base_opts, backend='inprocess', workers=4, timeout=180, wait_timeout=None):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"unknown yt-dlp backend: {backend}")
+        self.output_dir = output_dir
+        self.base_opts = base_opts
+        self.backend = backend
+        self.workers = workers
+        self.timeout = timeout
+        self.wait_timeout = wait_timeout or 2 * timeout
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='yt-engine')
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._running = set()
+        self._stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'timeouts': 0, 'cancelled': 0,
+                       'instances': 0, 'running': 0}
+        threading.Thread(target=self._watchdog, name='yt-engine-watchdog', daemon=True).start()
+        logger.info(f"yt-dlp engine: backend={backend} workers={workers} timeout={timeout}s")
+
+    def submit(self, url, fmt):
+        job = DownloadJob(url, fmt, self.timeout)
+        with self._lock:
+            self._stats['submitted'] += 1
+        job.future = self._pool.submit(self._run, job)
+        return job
+
+    def download(self, url, fmt):
+        return self.submit(url, fmt).result(self.wait_timeout)
+
+    def _watchdog(self):
+        while True:
+            time.sleep(1)
+            now = time.time()
+            with self._lock:
+                late = [job for job in self._running if now > job.deadline and not job.expired]
+            for job in late:
+                logger.warning(f"yt-dlp job for {job.url} passed its {job.timeout}s deadline, stopping it")
+                job.expire()
+
+    def warm(self, formats):
+        """Build YoutubeDL instances for ``formats`` on every worker thread."""
+        if self.backend != 'inprocess':
+            return
+        barrier = threading.Barrier(self.workers)
+
+        def _warm():
+            for fmt in formats:
+                self._instance(fmt)
+            try:
+                # Hold the thread so each task lands on a different worker
+                barrier.wait(timeout=10)
+            except threading.BrokenBarrierError:
+                pass
+
+        for _ in range(self.workers):
+            self._pool.submit(_warm)
+
+    def _run(self, job):
+        if job.cancelled:
+            raise EngineCancelled('download cancelled')
+        if job.expired:
+            raise EngineTimeout('download timeout')
+        job.deadline = time.time() + job.timeout
+        with self._lock:
+            self._stats['running'] += 1
+            self._running.add(job)
+        try:
+            if self.backend == 'inprocess':
+                with timed('extract', 'yt-dlp'):
+                    result = self._run_inprocess(job)
+            else:
+                with timed('subprocess', 'yt-dlp'):
+                    result = self._run_subprocess(job)
+        except EngineError as e:
+            with self._lock:
+                key = 'timeouts' if isinstance(e, EngineTimeout) else \
+                    'cancelled' if isinstance(e, EngineCancelled) else 'failed'
+                self._stats[key] += 1
+            raise
+        except Exception:
+            with self._lock:
+                self._stats['failed'] += 1
+            raise
+        finally:
+            with self._lock:
+                self._stats['running'] -= 1
+                self._running.discard(job)
+        with self._lock:
+            self._stats['completed'] += 1
+        return result
+
+    # --- In-process backend ---
+    def _instance(self, fmt):
+        instances = getattr(self._local, 'instances', None)
+        if instances is None:
+            instances = self._local.instances = {}
+        entry = instances.get(fmt)
+        if entry is None:
+            token = uuid.uuid4().hex[:12]
+            opts = dict(self.base_opts)
+            opts.setdefault('socket_timeout', 30)  # bounds hangs before any progress
+            opts.update({
+                'format': fmt,
+                'outtmpl': os.path.join(self.output_dir, f"yt_{token}_%(id)s.%(ext)s"),
+                'progress_hooks': [self._progress_hook],
+            })
+            entry = instances[fmt] = (yt_dlp.YoutubeDL(opts), token)
+            with self._lock:
+                self._stats['instances'] += 1
+        return entry
+
+    def _progress_hook(self, status):
+        job = getattr(self._local, 'job', None)
+        if job is None:
+            return
+        if job.cancelled:
+            raise yt_dlp.utils.DownloadCancelled('download cancelled')
+        if job.expired or time.time() > job.deadline:
+            raise yt_dlp.utils.DownloadCancelled('download timeout')
+
+    def _run_inprocess(self, job):
+        ydl, token = self._instance(job.fmt)
+        self._local.job = job
+        try:
+            info = ydl.extract_info(job.url, download=True)
+        except yt_dlp.utils.DownloadCancelled:
+            self._remove_partials(token)
+            if job.cancelled:
+                raise EngineCancelled('download cancelled')
+            raise EngineTimeout('download timeout')
+        except yt_dlp.utils.YoutubeDLError as e:
+            self._remove_partials(token)
+            logger.error(f"yt-dlp failed: {str(e)}")
+            raise EngineError('download failed')
+        finally:
+            self._local.job = None
+
+        downloads = (info or {}).get('requested_downloads') or []
+        filepath = downloads[0].get('filepath') if downloads else None
+        if not filepath or not os.path.exists(filepath):
+            raise EngineError('file not found')
+        return {'file': filepath, 'ext': filepath.rsplit('.', 1)[-1]}
+
+    def _remove_partials(self, token):
+        for path in glob.glob(os.path.join(self.output_dir, f"yt_{token}_*")):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    # --- Subprocess backend ---
+    def _run_subprocess(self, job):
+        unique_id = uuid.uuid4().hex
+        output_template = os.path.join(self.output_dir, f"yt_{unique_id}")
+        cmd = ['yt-dlp', '--newline', '-f', job.fmt, '--output', f"{output_template}.%(ext)s", job.url]
+        cookiefile = self.base_opts.get('cookiefile')
+        if cookiefile:
+            cmd += ['--cookies', cookiefile]
+        cmd += ['--socket-timeout', str(self.base_opts.get('socket_timeout', 30))]
+
+        # The watchdog kills it once the deadline passes
+        job._proc = proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if job.cancelled or job.expired:
+            proc.kill()  # stopped while it was starting
+        try:
+            stdout, stderr = proc.communicate()
+        finally:
+            job._proc = None
+
+        if job.cancelled:
+            raise EngineCancelled('download cancelled')
+        if job.expired:
+            raise EngineTimeout('download timeout')
+        if proc.returncode != 0:
+            logger.error(f"yt-dlp failed: {stderr.decode(errors='replace')}")
+            raise EngineError('download failed')
+
+        for f in os.listdir(self.output_dir):
+            if f.startswith(f"yt_{unique_id}."):
+                return {'file': os.path.join(self.output_dir, f), 'ext': f.split('.')[-1]}
+        raise EngineError('file not found')
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update({'backend': self.backend, 'workers': self.workers, 'timeout': self.timeout,
+                      'queued': self._pool._work_queue.qsize()})
+        return stats
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)